@@ -47,11 +47,14 @@ export default async function handler(req, res) {
         const phone = message.from;
         const messageText = message.text?.body || '';
 
-        // Preparar payload para el backend de Leapcell
+        // Preparar payload para el backend de Leapcell. message_id hace
+        // idempotente el turno: WhatsApp reintenta el webhook si no recibe 200
+        // y el backend devuelve la respuesta ya generada.
         const payload = {
           phone: phone,
           message: messageText,
-          role: process.env.DEFAULT_ROLE || 'formulario'
+          role: process.env.DEFAULT_ROLE || 'formulario',
+          message_id: message.id
         };
 
         // Enviar al backend de Leapcell
@@ -63,6 +66,11 @@ export default async function handler(req, res) {
           body: JSON.stringify(payload),
         });
 
+        // 409: el mismo mensaje ya se está procesando en otro intento.
+        if (response.status === 409) {
+          return res.status(200).json({ success: true, message: 'Duplicate in progress' });
+        }
+
         if (!response.ok) {
           throw new Error(`Backend responded with ${response.status}`);
         }
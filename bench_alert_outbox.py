@@ -0,0 +1,140 @@
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+import requests
+from werkzeug.serving import make_server
+
+import app as backend
+
+HISTORY = int(os.getenv("BENCH_HISTORY", "100000"))
+PENDING = int(os.getenv("BENCH_PENDING", "2000"))
+CONSUMERS = int(os.getenv("BENCH_CONSUMERS", "4"))
+BATCH = int(os.getenv("BENCH_BATCH", "50"))
+SEND_MS = float(os.getenv("BENCH_SEND_MS", "1"))
+PORT = int(os.getenv("BENCH_PORT", "8767"))
+
+
+def seed(path: str) -> None:
+    # Historial de alertas ya enviadas más las pendientes del momento: el
+    # sondeo debe leer solo las segundas.
+    backend.app.config["DATABASE"] = path
+    backend.init_db()
+    backend.migrate_db()
+    with backend.app.app_context():
+        db = backend.get_db()
+        producer = backend.get_or_create_producer("+51900000001")
+        now = backend.utc_now()
+        db.executemany(
+            """
+            INSERT INTO alerts (producer_id, level, reason, action, message, status, created_at, sent_at)
+            VALUES (?, 'medio', 'bench', 'revisar', '', 'enviada', ?, ?)
+            """,
+            ((producer["id"], now, now) for _ in range(HISTORY)),
+        )
+        db.executemany(
+            """
+            INSERT INTO alerts (producer_id, level, reason, action, message, status, created_at)
+            VALUES (?, 'alto', 'bench', 'revisar', '', 'abierta', ?)
+            """,
+            ((producer["id"], now) for _ in range(PENDING)),
+        )
+        db.commit()
+
+
+def send(alert: dict, sends: Counter, lock: threading.Lock) -> None:
+    # Envío simulado por WhatsApp.
+    time.sleep(SEND_MS / 1000)
+    with lock:
+        sends[alert["id"]] += 1
+
+
+def legacy_consumer(url: str, name: str, sends: Counter, lock: threading.Lock) -> int:
+    session = requests.Session()
+    calls = 0
+    while True:
+        alerts = session.get(f"{url}/alerts/pending", timeout=60).json()["alerts"]
+        calls += 1
+        if not alerts:
+            return calls
+        for alert in alerts[:BATCH]:
+            send(alert, sends, lock)
+            session.post(f"{url}/alerts/{alert['id']}/sent", timeout=60)
+            calls += 1
+
+
+def claim_consumer(url: str, name: str, sends: Counter, lock: threading.Lock) -> int:
+    session = requests.Session()
+    calls = 0
+    while True:
+        alerts = session.post(
+            f"{url}/alerts/claim", json={"consumer": name, "limit": BATCH}, timeout=60
+        ).json()["alerts"]
+        calls += 1
+        if not alerts:
+            return calls
+        for alert in alerts:
+            send(alert, sends, lock)
+        session.post(
+            f"{url}/alerts/ack",
+            json={"consumer": name, "sent": [alert["id"] for alert in alerts]},
+            timeout=60,
+        )
+        calls += 1
+
+
+def run_variant(consumer) -> dict[str, float]:
+    url = f"http://127.0.0.1:{PORT}"
+    sends: Counter = Counter()
+    lock = threading.Lock()
+    calls = []
+    with tempfile.TemporaryDirectory() as tmp:
+        seed(str(Path(tmp) / "bench.db"))
+        server = make_server("127.0.0.1", PORT, backend.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        def worker(name: str) -> None:
+            result = consumer(url, name, sends, lock)
+            with lock:
+                calls.append(result)
+
+        threads = [threading.Thread(target=worker, args=(f"bridge-{i}",)) for i in range(CONSUMERS)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        server.shutdown()
+        server.server_close()
+        backend.close_db_pool()
+    return {
+        "seconds": elapsed,
+        "delivered": len(sends),
+        "duplicates": sum(sends.values()) - len(sends),
+        "calls": sum(calls),
+    }
+
+
+def main() -> None:
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    backend.app.logger.setLevel(logging.CRITICAL)
+    print(
+        f"{HISTORY} alertas enviadas, {PENDING} pendientes, "
+        f"{CONSUMERS} bridges, lote {BATCH}, envío {SEND_MS:.0f} ms"
+    )
+    print(f"{'variante':<22}{'s vaciado':>10}{'entregadas':>12}{'duplicadas':>12}{'requests':>10}")
+    for label, consumer in (("sondeo + /sent", legacy_consumer), ("claim + ack", claim_consumer)):
+        stats = run_variant(consumer)
+        print(
+            f"{label:<22}{stats['seconds']:>10.2f}{stats['delivered']:>12}"
+            f"{stats['duplicates']:>12}{stats['calls']:>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
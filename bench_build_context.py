@@ -0,0 +1,152 @@
+import json
+import os
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import app as backend
+
+PRODUCERS = int(os.getenv("BENCH_PRODUCERS", "50000"))
+MESSAGES_PER_PRODUCER = int(os.getenv("BENCH_MESSAGES_PER_PRODUCER", "6"))
+LOGS_PER_PRODUCER = int(os.getenv("BENCH_LOGS_PER_PRODUCER", "3"))
+TURNS = int(os.getenv("BENCH_TURNS", "200"))
+
+
+def phone(index: int) -> str:
+    return f"+51{900000000 + index}"
+
+
+def seed(db) -> None:
+    now = backend.utc_now()
+    db.executemany(
+        """
+        INSERT INTO producers (
+            phone, name, zone, preferred_language, main_crops, allowed, status,
+            timezone, last_checkin_date, assigned_role, enable_formulario,
+            enable_consulta, enable_intervencion, created_at
+        )
+        VALUES (?, ?, ?, 'es', ?, 1, 'activo', ?, NULL, 'consulta', 1, 1, 1, ?)
+        """,
+        (
+            (phone(i), f"Productor {i}", "Cusco", json.dumps(["papa"]), backend.DEFAULT_TIMEZONE, now)
+            for i in range(PRODUCERS)
+        ),
+    )
+    db.executemany(
+        """
+        INSERT INTO forms (producer_id, status, cultivo, sintoma, inicio_problema, foto_recibida, created_at, updated_at)
+        VALUES (?, 'abierto', 'papa', NULL, NULL, 0, ?, ?)
+        """,
+        ((i + 1, now, now) for i in range(PRODUCERS)),
+    )
+    db.execute(
+        "INSERT INTO plans (name, description, targets_json, created_at) VALUES (?, ?, ?, ?)",
+        ("Plan papa", "Plan de referencia", json.dumps({"humedad": 30}), now),
+    )
+    db.executemany(
+        """
+        INSERT INTO producer_plans (producer_id, plan_id, start_date, status, created_at)
+        VALUES (?, 1, '2024-05-01', 'activo', ?)
+        """,
+        ((i + 1, now) for i in range(0, PRODUCERS, 2)),
+    )
+    db.executemany(
+        """
+        INSERT INTO messages (producer_id, direction, content, status, created_at)
+        VALUES (?, ?, ?, 'entregado', ?)
+        """,
+        (
+            (i + 1, "usuario" if n % 2 == 0 else "asistente", f"mensaje {n}", f"2024-05-01T08:{n:02d}:00")
+            for n in range(MESSAGES_PER_PRODUCER)
+            for i in range(PRODUCERS)
+        ),
+    )
+    db.executemany(
+        """
+        INSERT INTO daily_logs (producer_id, plan_id, log_date, notes, metrics_json, created_at)
+        VALUES (?, NULL, ?, 'sin novedades', ?, ?)
+        """,
+        (
+            (i + 1, f"2024-05-{n + 1:02d}", json.dumps({"humedad": 25 + n}), now)
+            for n in range(LOGS_PER_PRODUCER)
+            for i in range(PRODUCERS)
+        ),
+    )
+    db.executemany(
+        """
+        INSERT INTO producer_tasks (
+            producer_id, template_id, task_name, order_sequence, status,
+            estimated_date, created_at, updated_at
+        )
+        VALUES (?, 1, 'Aporque', 1, 'PENDIENTE', '2024-06-01', ?, ?)
+        """,
+        ((i + 1, now, now) for i in range(PRODUCERS)),
+    )
+    db.commit()
+
+
+def legacy_turn(number: str) -> dict:
+    # Lecturas de un turno antes de la foto única: agent(), build_context()
+    # y apply_model_actions() consultaban cada tabla por separado.
+    producer = backend.get_or_create_producer(number)
+    producer = backend.get_or_create_producer(number)
+    form_state = backend.get_or_create_form(producer["id"])
+    active_plan = backend.get_active_plan(producer["id"])
+    logs = backend.recent_daily_logs(producer["id"])
+    context = {
+        "producer": producer,
+        "form_state": form_state,
+        "recent_chat": backend.recent_chat(producer["id"]),
+        "active_task": backend.get_active_task(producer["id"]),
+        "daily_logs": logs,
+        "active_plan": active_plan,
+        "plan_evaluation": backend.evaluate_plan_progress(active_plan, logs),
+    }
+    producer = backend.get_or_create_producer(number)
+    backend.get_or_create_form(producer["id"])
+    return context
+
+
+def snapshot_turn(number: str) -> dict:
+    snapshot = backend.load_turn_snapshot(number)
+    return backend.build_context("consulta", number, "hola", snapshot)
+
+
+def measure(db, label: str, turn, numbers: list[str]) -> None:
+    statements = 0
+
+    def count(_statement: str) -> None:
+        nonlocal statements
+        statements += 1
+
+    db.set_trace_callback(count)
+    start = time.perf_counter()
+    for number in numbers:
+        turn(number)
+    elapsed = time.perf_counter() - start
+    db.set_trace_callback(None)
+    print(
+        f"{label:<12}{statements / len(numbers):>16.1f}"
+        f"{1000 * elapsed / len(numbers):>14.3f}"
+    )
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        backend.app.config["DATABASE"] = str(Path(tmp) / "bench.db")
+        backend.init_db()
+        backend.migrate_db()
+        with backend.app.app_context():
+            db = backend.get_db()
+            start = time.perf_counter()
+            seed(db)
+            print(f"{PRODUCERS} productores sembrados en {time.perf_counter() - start:.1f} s")
+            numbers = [phone(random.randrange(PRODUCERS)) for _ in range(TURNS)]
+            print(f"{'variante':<12}{'sentencias/turno':>16}{'ms/turno':>14}")
+            measure(db, "separadas", legacy_turn, numbers)
+            measure(db, "foto única", snapshot_turn, numbers)
+
+
+if __name__ == "__main__":
+    main()
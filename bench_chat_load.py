@@ -0,0 +1,86 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# BENCH_TARGETS="serial=http://localhost:8001,batch=http://localhost:8002"
+TARGETS = os.getenv("BENCH_TARGETS", "serial=http://localhost:8001")
+CONCURRENCY = int(os.getenv("BENCH_CONCURRENCY", "8"))
+REQUESTS = int(os.getenv("BENCH_REQUESTS", "32"))
+MAX_TOKENS = int(os.getenv("BENCH_MAX_TOKENS", "64"))
+
+SYSTEM_PROMPT = (
+    "Responde usando SOLO la información del contexto. "
+    "Si falta información, pide una sola aclaración. "
+    "Devuelve SOLO JSON válido con las claves: "
+    "role, respuesta_chat, acciones{actualizar_formulario,alerta,log}, "
+    "estado{formulario_completo,confianza}."
+)
+MESSAGES = [
+    "buenos días, ya regué la papa",
+    "hoy vi hojas amarillas en el maíz",
+    "¿cuándo riego la papa?",
+    "todo bien, sin novedades",
+]
+
+
+def payload(index: int) -> dict:
+    return {
+        "system": SYSTEM_PROMPT,
+        "context": {
+            "role": "consulta",
+            "producer": {"id": index, "zone": "Cusco", "main_crops": ["papa", "maiz"]},
+            "weekly_summary": "7d: sin datos suficientes registrados.",
+            "last_user_message": MESSAGES[index % len(MESSAGES)],
+        },
+        "max_tokens": MAX_TOKENS,
+    }
+
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def run_target(url: str) -> dict[str, float]:
+    session = requests.Session()
+
+    def one(index: int) -> tuple[float, int]:
+        start = time.perf_counter()
+        response = session.post(f"{url.rstrip('/')}/chat", json=payload(index), timeout=600)
+        response.raise_for_status()
+        usage = response.json().get("usage") or {}
+        return time.perf_counter() - start, int(usage.get("completion_tokens", 0))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as pool:
+        results = list(pool.map(one, range(REQUESTS)))
+    elapsed = time.perf_counter() - start
+    latencies = [latency for latency, _ in results]
+    tokens = sum(count for _, count in results)
+    return {
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "tokens_per_sec": tokens / elapsed,
+        "requests_per_sec": REQUESTS / elapsed,
+    }
+
+
+def main() -> None:
+    print(
+        f"{REQUESTS} peticiones, concurrencia {CONCURRENCY}, max_tokens {MAX_TOKENS}"
+    )
+    print(f"{'modo':<10}{'p50 s':>10}{'p99 s':>10}{'tok/s':>10}{'req/s':>10}")
+    for target in TARGETS.split(","):
+        label, url = target.split("=", 1)
+        stats = run_target(url)
+        print(
+            f"{label:<10}{stats['p50']:>10.2f}{stats['p99']:>10.2f}"
+            f"{stats['tokens_per_sec']:>10.1f}{stats['requests_per_sec']:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import json
+import os
+import time
+
+import app as backend
+
+REPEATS = int(os.getenv("BENCH_REPEATS", "3"))
+
+
+def fixture(role: str) -> dict:
+    # Contexto como lo arma build_context en un turno típico: productor con
+    # plan activo, tres bitácoras, seis líneas de chat y una tarea abierta.
+    producer = {
+        "id": 7,
+        "phone": "+51900000007",
+        "name": "Rosa Quispe",
+        "zone": "Cusco",
+        "preferred_language": "es",
+        "main_crops": json.dumps(["papa", "maiz"]),
+        "allowed": 1,
+        "status": "activo",
+        "timezone": backend.DEFAULT_TIMEZONE,
+        "last_checkin_date": "2024-05-02",
+        "assigned_role": role,
+        "enable_formulario": 1,
+        "enable_consulta": 1,
+        "enable_intervencion": 1,
+        "created_at": "2024-04-01T10:00:00+00:00",
+    }
+    logs = [
+        {
+            "id": day,
+            "plan_id": 1,
+            "log_date": f"2024-05-{day:02d}",
+            "notes": "Revisión de campo, algunas hojas amarillas en la parte baja.",
+            "metrics": {"humedad": 28 + day, "temperatura": 17.5, "plagas": "pocas"},
+            "created_at": f"2024-05-{day:02d}T18:00:00+00:00",
+        }
+        for day in range(1, 4)
+    ]
+    context = {
+        "role": role,
+        "producer": producer,
+        "form_state": {
+            "id": 7,
+            "producer_id": 7,
+            "status": "abierto",
+            "cultivo": "papa",
+            "sintoma": "hojas amarillas",
+            "inicio_problema": None,
+            "foto_recibida": 0,
+            "created_at": "2024-05-01T10:00:00+00:00",
+            "updated_at": "2024-05-03T09:00:00+00:00",
+        },
+        "recent_chat": [
+            "usuario: hola, tengo problemas con la papa",
+            "asistente: ¿Qué síntomas ves en las hojas?",
+            "usuario: están amarillas abajo",
+            "asistente: ¿Desde cuándo lo notas?",
+            "usuario: unos cuatro días",
+            "asistente: ¿Puedes enviar una foto?",
+        ],
+        "active_task": {
+            "id": 12,
+            "task_name": "Aporque",
+            "status": "PENDIENTE",
+            "estimated_date": "2024-06-01",
+            "progress_pct": None,
+            "blocker_reason": None,
+            "order_sequence": 2,
+        },
+        "daily_logs": logs,
+        "active_plan": {
+            "assignment_id": 3,
+            "id": 1,
+            "name": "Plan papa",
+            "description": "Plan de referencia para papa en sierra sur.",
+            "targets": {"humedad": 30},
+            "start_date": "2024-05-01",
+        },
+        "plan_evaluation": {"humedad": {"target": 30, "last": 31, "ok": True}},
+        "daily_prompt_needed": role == "formulario",
+        "weekly_summary": None,
+        "last_user_message": "ya les eché agua pero siguen igual",
+    }
+    if role != "formulario":
+        context["weekly_summary"] = "7d: sin datos suficientes registrados."
+    if role == "intervencion":
+        context["recent_chat"] = []
+    return context
+
+
+def encoded(context: dict, compact: bool) -> str:
+    backend.COMPACT_CONTEXT_ENABLED = compact
+    return backend.serialize_context(context)
+
+
+def prompt_eval_ms(llm, system_prompt: str, user_content: str) -> float:
+    # Un solo token de salida: el tiempo es casi todo evaluación del prompt.
+    best = float("inf")
+    for _ in range(REPEATS):
+        llm.reset()
+        start = time.perf_counter()
+        llm.create_chat_completion(
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_content},
+            ],
+            temperature=0,
+            max_tokens=1,
+        )
+        best = min(best, time.perf_counter() - start)
+    return 1000 * best
+
+
+def main() -> None:
+    llm = backend.get_local_llm()
+    print(f"{'rol':<14}{'variante':<10}{'bytes':>8}{'tokens':>8}{'ms prompt':>12}")
+    for role in ("formulario", "consulta", "intervencion"):
+        context = fixture(role)
+        system_prompt = backend.PROMPTS[role]
+        for label, compact in (("completo", False), ("compacto", True)):
+            text = encoded(context, compact)
+            tokens = len(llm.tokenize(text.encode("utf-8"), add_bos=False))
+            elapsed = prompt_eval_ms(llm, system_prompt, text)
+            print(
+                f"{role:<14}{label:<10}{len(text.encode('utf-8')):>8}"
+                f"{tokens:>8}{elapsed:>12.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import requests
+from werkzeug.serving import make_server
+
+import app as backend
+
+SECONDS = float(os.getenv("BENCH_SECONDS", "10"))
+AGENT_CLIENTS = int(os.getenv("BENCH_AGENT_CLIENTS", "4"))
+POLL_CLIENTS = int(os.getenv("BENCH_POLL_CLIENTS", "4"))
+PORT = int(os.getenv("BENCH_PORT", "8766"))
+
+# journal_mode, synchronous, tamaño del pool (0 = conexión por request).
+VARIANTS = [
+    ("rollback, sin pool", "DELETE", "FULL", 0),
+    ("WAL + pool", "WAL", "NORMAL", 8),
+]
+
+
+def stub_run_mml(role: str, context: dict) -> dict:
+    # Modelo simulado: cada tercer turno genera una alerta para que el
+    # sondeo del puente tenga filas que leer.
+    alert = None
+    if len(context["last_user_message"]) % 3 == 0:
+        alert = {"nivel": "medio", "motivo": "bench", "accion_recomendada": "revisar"}
+    return {
+        "role": role,
+        "respuesta_chat": "Entendido.",
+        "acciones": {"actualizar_formulario": {}, "alerta": alert, "log": None},
+        "estado": {"formulario_completo": False, "confianza": 0.5},
+    }
+
+
+def seed(path: str) -> list[str]:
+    phones = [f"+5190000{index:04d}" for index in range(AGENT_CLIENTS)]
+    backend.app.config["DATABASE"] = path
+    backend.init_db()
+    backend.migrate_db()
+    with backend.app.app_context():
+        for phone in phones:
+            producer = backend.get_or_create_producer(phone)
+            backend.get_db().execute(
+                "UPDATE producers SET allowed = 1 WHERE id = ?", (producer["id"],)
+            )
+            backend.get_db().commit()
+    return phones
+
+
+def run_variant(journal_mode: str, synchronous: str, pool_size: int) -> dict[str, float]:
+    backend.SQLITE_JOURNAL_MODE = journal_mode
+    backend.SQLITE_SYNCHRONOUS = synchronous
+    backend.DB_POOL_SIZE = pool_size
+    backend.close_db_pool()
+    url = f"http://127.0.0.1:{PORT}"
+    counts = {"agent": 0, "poll": 0, "errors": 0}
+    lock = threading.Lock()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        phones = seed(str(Path(tmp) / "bench.db"))
+        server = make_server("127.0.0.1", PORT, backend.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        deadline = time.perf_counter() + SECONDS
+
+        def agent_client(phone: str) -> None:
+            session = requests.Session()
+            turn = 0
+            while time.perf_counter() < deadline:
+                turn += 1
+                response = session.post(
+                    f"{url}/agent",
+                    json={"phone": phone, "role": "consulta", "message": "m" * turn},
+                    timeout=60,
+                )
+                with lock:
+                    counts["agent" if response.ok else "errors"] += 1
+
+        def poll_client() -> None:
+            session = requests.Session()
+            while time.perf_counter() < deadline:
+                response = session.get(f"{url}/alerts/pending", timeout=60)
+                with lock:
+                    counts["poll" if response.ok else "errors"] += 1
+
+        threads = [threading.Thread(target=agent_client, args=(phone,)) for phone in phones]
+        threads += [threading.Thread(target=poll_client) for _ in range(POLL_CLIENTS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        server.shutdown()
+        server.server_close()
+        backend.close_db_pool()
+    return {key: value / SECONDS for key, value in counts.items()} | {
+        "errors_total": counts["errors"]
+    }
+
+
+def main() -> None:
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    backend.app.logger.setLevel(logging.CRITICAL)
+    backend.run_mml = stub_run_mml
+    print(
+        f"{SECONDS:.0f} s, {AGENT_CLIENTS} clientes /agent, "
+        f"{POLL_CLIENTS} clientes /alerts/pending"
+    )
+    print(f"{'variante':<22}{'/agent/s':>10}{'polls/s':>10}{'errores':>10}")
+    for label, journal_mode, synchronous, pool_size in VARIANTS:
+        stats = run_variant(journal_mode, synchronous, pool_size)
+        print(
+            f"{label:<22}{stats['agent']:>10.1f}{stats['poll']:>10.1f}"
+            f"{stats['errors_total']:>10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
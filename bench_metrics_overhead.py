@@ -0,0 +1,83 @@
+import os
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import app as backend
+import metrics
+
+TURNS = int(os.getenv("BENCH_TURNS", "50"))
+OBSERVATIONS = int(os.getenv("BENCH_OBSERVATIONS", "200000"))
+PHONE = "+51900000001"
+ROLE = "consulta"
+
+
+def observe_cost_us() -> float:
+    # Costo de una observación: lock, recorrido de buckets y suma.
+    family = backend.HistogramFamily(
+        "bench_seconds", "bench", ("stage", "role"), backend.STAGE_SECONDS_BUCKETS
+    )
+    start = time.perf_counter()
+    for index in range(OBSERVATIONS):
+        family.observe(index % 1000 / 1000, "model", ROLE)
+    return 1e6 * (time.perf_counter() - start) / OBSERVATIONS
+
+
+def observations_per_turn(client) -> int:
+    before = sum(
+        child.count for family in backend.METRIC_FAMILIES for child in family.children.values()
+    )
+    client.post("/agent", json={"phone": PHONE, "message": "hola", "role": ROLE})
+    after = sum(
+        child.count for family in backend.METRIC_FAMILIES for child in family.children.values()
+    )
+    return after - before
+
+
+def turn_latencies(client, enabled: bool) -> list[float]:
+    metrics.METRICS_ENABLED = enabled
+    latencies = []
+    for turn in range(TURNS):
+        start = time.perf_counter()
+        client.post("/agent", json={"phone": PHONE, "message": f"mensaje {turn}", "role": ROLE})
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main() -> None:
+    # Sin cache de respuestas ni ventana de agrupación: cada turno pasa por
+    # el modelo y no espera.
+    backend.RESPONSE_CACHE_ROLES = set()
+    backend.AGENT_SYNC_COALESCE_MS = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        backend.app.config["DATABASE"] = str(Path(tmp) / "bench.db")
+        backend.init_db()
+        backend.migrate_db()
+        client = backend.app.test_client()
+        with backend.app.app_context():
+            backend.ensure_agent_defaults()
+            producer = backend.get_or_create_producer(PHONE)
+            db = backend.get_db()
+            db.execute("UPDATE producers SET allowed = 1 WHERE id = ?", (producer["id"],))
+            db.commit()
+            backend.get_local_llm()
+        cost = observe_cost_us()
+        per_turn = observations_per_turn(client)
+        print(
+            f"observe: {cost:.2f} µs, {per_turn} observaciones/turno "
+            f"= {cost * per_turn:.1f} µs/turno"
+        )
+        print(f"{TURNS} turnos /agent, rol {ROLE}")
+        print(f"{'variante':<14}{'ms media':>10}{'ms p50':>10}")
+        for label, enabled in (("sin métricas", False), ("con métricas", True)):
+            latencies = turn_latencies(client, enabled)
+            print(
+                f"{label:<14}{1000 * statistics.mean(latencies):>10.2f}"
+                f"{1000 * statistics.median(latencies):>10.2f}"
+            )
+        backend.close_db_pool()
+
+
+if __name__ == "__main__":
+    main()
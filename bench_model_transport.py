@@ -0,0 +1,92 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+from werkzeug.serving import make_server
+
+import app as backend
+import model_api
+
+CALLS = int(os.getenv("BENCH_CALLS", "500"))
+PORT = int(os.getenv("BENCH_PORT", "8765"))
+CANNED = json.dumps(
+    {
+        "role": "consulta",
+        "respuesta_chat": "Riega por la mañana.",
+        "acciones": {"actualizar_formulario": {}, "alerta": None, "log": None},
+        "estado": {"formulario_completo": True, "confianza": 0.8},
+    },
+    ensure_ascii=False,
+)
+
+
+def stub_complete(messages, role, max_tokens, schema=None):
+    # Servidor de modelo simulado: mide solo transporte y (de)serialización.
+    return {"content": CANNED, "usage": {"completion_tokens": 0}}
+
+
+def sample_context() -> dict:
+    return {
+        "role": "consulta",
+        "producer": {"id": 1, "zone": "Cusco", "main_crops": ["papa", "maiz"]},
+        "recent_chat": [f"usuario: mensaje {i} sobre el riego de la papa" for i in range(6)],
+        "daily_logs": [
+            {
+                "log_date": f"2024-05-{day:02d}",
+                "notes": "Revisión de campo sin novedades importantes.",
+                "metrics": {"humedad": 30 + day, "temperatura": 18.5, "plagas": "ninguna"},
+            }
+            for day in range(1, 4)
+        ],
+        "weekly_summary": "7d: sin datos suficientes registrados.",
+        "last_user_message": "¿cuándo riego la papa?",
+    }
+
+
+def legacy_call(url: str, context: dict, schema: dict) -> None:
+    payload = {
+        "system": backend.PROMPTS["consulta"],
+        "context": context,
+        "max_tokens": 300,
+        "schema": schema,
+    }
+    response = requests.post(f"{url}/chat", json=payload, timeout=120)
+    response.raise_for_status()
+    json.loads(response.json()["content"])
+
+
+def measure(label: str, call) -> None:
+    call()
+    start = time.perf_counter()
+    for _ in range(CALLS):
+        call()
+    per_call = (time.perf_counter() - start) / CALLS
+    print(f"{label:<28}{per_call * 1e6:>12.0f}")
+
+
+def main() -> None:
+    model_api.complete = stub_complete
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", PORT, model_api.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{PORT}"
+    backend.MODEL_API_URL = url
+    context = sample_context()
+    schema = backend.mml_output_schema("consulta")
+    prompt = backend.PROMPTS["consulta"]
+
+    print(f"{CALLS} llamadas por variante")
+    print(f"{'variante':<28}{'µs/llamada':>12}")
+    measure("requests.post + json", lambda: legacy_call(url, context, schema))
+    backend.MODEL_API_WIRE = "json"
+    measure("sesión pool + json", lambda: backend.call_model_api(prompt, context, 300, schema))
+    backend.MODEL_API_WIRE = "frame"
+    measure("sesión pool + frame", lambda: backend.call_model_api(prompt, context, 300, schema))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
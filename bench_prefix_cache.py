@@ -0,0 +1,81 @@
+import json
+import os
+import time
+
+from app import PROMPTS, get_local_llm, load_prefix_state
+
+RUNS = int(os.getenv("BENCH_RUNS", "5"))
+MAX_TOKENS = int(os.getenv("BENCH_MAX_TOKENS", "8"))
+
+
+def sample_context(role: str) -> dict:
+    return {
+        "role": role,
+        "producer": {
+            "id": 1,
+            "phone": "+51999999999",
+            "zone": "Cusco - San Sebastián",
+            "preferred_language": "es",
+            "main_crops": ["papa", "maiz"],
+        },
+        "form_state": {
+            "cultivo": "papa",
+            "sintoma": "hojas amarillas",
+            "inicio_problema": None,
+            "foto_recibida": False,
+        },
+        "recent_chat": [
+            "usuario: mi papa esta amarilla",
+            "asistente: ¿Desde cuándo lo notas?",
+        ],
+        "weekly_summary": "7d: sin datos suficientes registrados.",
+        "last_user_message": "hace 3 dias",
+    }
+
+
+def time_to_first_token(llm, role: str, system_prompt: str, context: dict, cached: bool) -> float:
+    start = time.perf_counter()
+    if cached:
+        load_prefix_state(llm, role, system_prompt)
+    else:
+        llm.reset()
+    stream = llm.create_chat_completion(
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": json.dumps(context, ensure_ascii=False)},
+        ],
+        temperature=0.2,
+        max_tokens=MAX_TOKENS,
+        stream=True,
+    )
+    first = None
+    for chunk in stream:
+        if first is None and chunk["choices"][0]["delta"].get("content"):
+            first = time.perf_counter() - start
+    return first if first is not None else time.perf_counter() - start
+
+
+def main() -> None:
+    llm = get_local_llm()
+    roles = list(PROMPTS)
+    for role in roles:
+        load_prefix_state(llm, role, PROMPTS[role])
+    print(f"{'role':<14}{'sin cache ms':>14}{'con cache ms':>14}{'ahorro ms':>12}")
+    for role, system_prompt in PROMPTS.items():
+        context = sample_context(role)
+        cold: list[float] = []
+        warm: list[float] = []
+        other = roles[(roles.index(role) + 1) % len(roles)]
+        for _ in range(RUNS):
+            cold.append(time_to_first_token(llm, role, system_prompt, context, False))
+            # Como en producción, el turno anterior fue de otro rol y hay que
+            # restaurar el estado guardado de este.
+            load_prefix_state(llm, other, PROMPTS[other])
+            warm.append(time_to_first_token(llm, role, system_prompt, context, True))
+        cold_ms = 1000 * sum(cold) / len(cold)
+        warm_ms = 1000 * sum(warm) / len(warm)
+        print(f"{role:<14}{cold_ms:>14.1f}{warm_ms:>14.1f}{cold_ms - warm_ms:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import logging
+import os
+import statistics
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import requests
+from werkzeug.serving import make_server
+
+import app as backend
+
+SECONDS = float(os.getenv("BENCH_SECONDS", "10"))
+MODEL_MS = float(os.getenv("BENCH_MODEL_MS", "200"))
+PRODUCERS = int(os.getenv("BENCH_PRODUCERS", "4"))
+SPAM_THREADS = int(os.getenv("BENCH_SPAM_THREADS", "4"))
+THINK_MS = float(os.getenv("BENCH_THINK_MS", "1500"))
+PORT = int(os.getenv("BENCH_PORT", "8768"))
+
+
+def stub_run_mml(role: str, context: dict) -> dict:
+    # Un solo slot de modelo que tarda MODEL_MS por turno, como el Llama local.
+    time.sleep(MODEL_MS / 1000)
+    return {
+        "role": role,
+        "respuesta_chat": "Entendido.",
+        "acciones": {"actualizar_formulario": {}, "alerta": None, "log": None},
+        "estado": {"formulario_completo": False, "confianza": 0.5},
+    }
+
+
+def seed(path: str, phones: list[str]) -> None:
+    backend.app.config["DATABASE"] = path
+    backend.init_db()
+    backend.migrate_db()
+    with backend.app.app_context():
+        backend.ensure_agent_defaults()
+        for phone in phones:
+            producer = backend.get_or_create_producer(phone)
+            backend.get_db().execute(
+                "UPDATE producers SET allowed = 1 WHERE id = ?", (producer["id"],)
+            )
+        backend.get_db().commit()
+
+
+def run_variant(enabled: bool) -> dict[str, float]:
+    # Un número manda mensajes sin pausa desde varios hilos; los demás
+    # escriben como una persona. Se mide la espera de estos últimos.
+    backend.RATE_LIMIT_ENABLED = enabled
+    backend.RATE_LIMITER = backend.RateLimiter(
+        backend.RATE_LIMIT_PER_MINUTE, backend.RATE_LIMIT_BURST, backend.RATE_LIMIT_MAX_INFLIGHT
+    )
+    backend.MODEL_SCHEDULER = backend.ModelScheduler(
+        1, backend.MODEL_QUEUE_MAX_DEPTH, dict(backend.MODEL_ROLE_WEIGHTS)
+    )
+    url = f"http://127.0.0.1:{PORT}"
+    spammer = "+51999999999"
+    phones = [f"+5190000{index:04d}" for index in range(PRODUCERS)]
+    latencies: list[float] = []
+    counts = {"spam_model": 0, "spam_limited": 0, "errors": 0}
+    lock = threading.Lock()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        seed(str(Path(tmp) / "bench.db"), phones + [spammer])
+        server = make_server("127.0.0.1", PORT, backend.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        deadline = time.perf_counter() + SECONDS
+
+        def send(session: requests.Session, phone: str) -> dict | None:
+            response = session.post(
+                f"{url}/agent",
+                json={"phone": phone, "role": "consulta", "message": "hola"},
+                timeout=120,
+            )
+            if not response.ok:
+                with lock:
+                    counts["errors"] += 1
+                return None
+            return response.json()["model_output"]
+
+        def spam() -> None:
+            session = requests.Session()
+            while time.perf_counter() < deadline:
+                output = send(session, spammer)
+                if output is not None:
+                    with lock:
+                        counts["spam_limited" if "rate_limited" in output else "spam_model"] += 1
+
+        def producer(phone: str) -> None:
+            session = requests.Session()
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                if send(session, phone) is not None:
+                    with lock:
+                        latencies.append(time.perf_counter() - start)
+                time.sleep(THINK_MS / 1000)
+
+        threads = [threading.Thread(target=spam) for _ in range(SPAM_THREADS)]
+        threads += [threading.Thread(target=producer, args=(phone,)) for phone in phones]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        server.shutdown()
+        server.server_close()
+        backend.close_db_pool()
+    ordered = sorted(latencies)
+    return counts | {
+        "turns": len(latencies),
+        "p50": statistics.median(ordered) if ordered else 0.0,
+        "p99": ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))] if ordered else 0.0,
+    }
+
+
+def main() -> None:
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    backend.app.logger.setLevel(logging.CRITICAL)
+    backend.run_mml = stub_run_mml
+    backend.RESPONSE_CACHE_ROLES = set()
+    print(
+        f"{SECONDS:.0f} s, modelo {MODEL_MS:.0f} ms, {PRODUCERS} productores, "
+        f"1 número con {SPAM_THREADS} hilos sin pausa, "
+        f"límite {backend.RATE_LIMIT_PER_MINUTE:g}/min ráfaga {backend.RATE_LIMIT_BURST:g}"
+    )
+    print(
+        f"{'variante':<14}{'turnos':>8}{'ms p50':>10}{'ms p99':>10}"
+        f"{'spam→modelo':>13}{'spam fijo':>11}{'errores':>9}"
+    )
+    for label, enabled in (("sin límite", False), ("con límite", True)):
+        stats = run_variant(enabled)
+        print(
+            f"{label:<14}{stats['turns']:>8}{1000 * stats['p50']:>10.0f}{1000 * stats['p99']:>10.0f}"
+            f"{stats['spam_model']:>13}{stats['spam_limited']:>11}{stats['errors']:>9}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import os
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import app as backend
+
+PRODUCERS = int(os.getenv("BENCH_PRODUCERS", "4"))
+TURNS = int(os.getenv("BENCH_TURNS", "6"))
+ROLE = os.getenv("BENCH_ROLE", "formulario")
+
+QUESTIONS = [
+    "hola, tengo problemas con la papa",
+    "las hojas de abajo están amarillas",
+    "empezó hace unos cuatro días",
+    "ya les eché agua pero siguen igual",
+    "¿les pongo algún abono?",
+    "mañana te mando una foto",
+]
+
+
+def context(producer_id: int, turn: int, chat: list[str]) -> dict:
+    # Contexto de un turno de la conversación: lo estable del productor
+    # (perfil, formulario, tarea) se repite y cambian el chat y el mensaje.
+    return {
+        "role": ROLE,
+        "producer": {
+            "id": producer_id,
+            "name": f"Productor {producer_id}",
+            "zone": "Cusco",
+            "preferred_language": "es",
+            "main_crops": '["papa", "maiz"]',
+        },
+        "form_state": {"cultivo": "papa", "sintoma": "hojas amarillas", "foto_recibida": 0},
+        "active_task": {"id": producer_id, "task_name": "Aporque", "status": "PENDIENTE"},
+        "daily_prompt_needed": False,
+        "weekly_summary": "7d: papa—hojas amarillas (2 veces); bitácoras 3, humedad prom 31.0 (28–34).",
+        "recent_chat": chat[-6:],
+        "last_user_message": QUESTIONS[turn % len(QUESTIONS)],
+    }
+
+
+def conversation_round(enabled: bool) -> list[float]:
+    # Los productores se turnan, así que el estado de uno nunca queda cargado
+    # para su turno siguiente: sin cache se vuelve al prefijo del rol.
+    backend.SESSION_CACHE_ENABLED = enabled
+    backend.SESSION_CACHE = backend.LlamaSessionCache(
+        backend.SESSION_CACHE_MAX_MB * 2**20,
+        backend.SESSION_CACHE_DISK_MB * 2**20,
+        backend.SESSION_CACHE_DIR,
+    )
+    chats: dict[int, list[str]] = {producer_id: [] for producer_id in range(1, PRODUCERS + 1)}
+    latencies = []
+    for turn in range(TURNS):
+        for producer_id, chat in chats.items():
+            turn_context = context(producer_id, turn, chat)
+            start = time.perf_counter()
+            output = backend.run_mml(ROLE, backend.fit_turn_context(ROLE, turn_context))
+            latencies.append(time.perf_counter() - start)
+            chat.append(f"usuario: {turn_context['last_user_message']}")
+            chat.append(f"asistente: {output.get('respuesta_chat', '')}")
+    return latencies
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        backend.app.config["DATABASE"] = str(Path(tmp) / "bench.db")
+        backend.SESSION_CACHE_DIR = Path(tmp) / "sessions"
+        backend.init_db()
+        backend.migrate_db()
+        with backend.app.app_context():
+            backend.get_local_llm()
+            print(f"{PRODUCERS} productores x {TURNS} turnos, rol {ROLE}")
+            print(f"{'variante':<14}{'ms media':>10}{'ms p50':>10}{'ms 1er turno':>14}")
+            for label, enabled in (("sin cache", False), ("con cache", True)):
+                latencies = conversation_round(enabled)
+                print(
+                    f"{label:<14}{1000 * statistics.mean(latencies):>10.1f}"
+                    f"{1000 * statistics.median(latencies):>10.1f}"
+                    f"{1000 * statistics.mean(latencies[:PRODUCERS]):>14.1f}"
+                )
+            print(backend.SESSION_CACHE.stats())
+        backend.close_db_pool()
+
+
+if __name__ == "__main__":
+    main()
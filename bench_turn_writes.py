@@ -0,0 +1,136 @@
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import app as backend
+
+TURNS = int(os.getenv("BENCH_TURNS", "200"))
+PHONE = "+51900000001"
+
+
+def model_output(task_id: int) -> dict:
+    # Turno completo de formulario: toca todas las tablas que escribe un turno.
+    return {
+        "role": "formulario",
+        "respuesta_chat": "Anotado, gracias.",
+        "acciones": {
+            "actualizar_formulario": {"cultivo": "papa", "sintoma": "hojas amarillas"},
+            "alerta": {"nivel": "medio", "motivo": "bench", "accion_recomendada": "revisar"},
+            "log": None,
+            "bitacora": {"fecha": "2024-05-02", "notas": "riego", "metricas": {"humedad": 30}},
+            "actualizar_tarea": {"task_id": task_id, "status": "EN_PROGRESO", "avance": 50},
+        },
+        "estado": {"formulario_completo": False, "confianza": 0.7},
+    }
+
+
+def seed() -> int:
+    db = backend.get_db()
+    producer = backend.get_or_create_producer(PHONE)
+    backend.get_or_create_form(producer["id"])
+    now = backend.utc_now()
+    row = db.execute(
+        """
+        INSERT INTO producer_tasks (
+            producer_id, template_id, task_name, order_sequence, status,
+            estimated_date, created_at, updated_at
+        )
+        VALUES (?, 1, 'Aporque', 1, 'PENDIENTE', '2024-06-01', ?, ?)
+        """,
+        (producer["id"], now, now),
+    )
+    db.commit()
+    return row.lastrowid
+
+
+def legacy_write_phase(snapshot: backend.TurnSnapshot, output: dict) -> None:
+    # Escrituras de un turno antes de la transacción única: un commit por paso.
+    db = backend.get_db()
+    producer_id = snapshot.producer["id"]
+    insert_message = """
+        INSERT INTO messages (producer_id, direction, content, status, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    """
+    db.execute(insert_message, (producer_id, "usuario", snapshot.message, "recibido", backend.utc_now()))
+    db.commit()
+    actions = output["acciones"]
+    updates = actions["actualizar_formulario"]
+    db.execute(
+        "UPDATE forms SET cultivo = ?, sintoma = ?, updated_at = ? WHERE id = ?",
+        (updates["cultivo"], updates["sintoma"], backend.utc_now(), snapshot.form_state["id"]),
+    )
+    db.commit()
+    alert = actions["alerta"]
+    db.execute(
+        """
+        INSERT INTO alerts (producer_id, level, reason, action, message, status, created_at)
+        VALUES (?, ?, ?, ?, ?, 'abierta', ?)
+        """,
+        (
+            producer_id,
+            alert["nivel"],
+            alert["motivo"],
+            alert["accion_recomendada"],
+            output["respuesta_chat"],
+            backend.utc_now(),
+        ),
+    )
+    db.commit()
+    bitacora = actions["bitacora"]
+    backend.save_daily_log(
+        producer_id, None, None, bitacora["fecha"], bitacora["notas"], bitacora["metricas"]
+    )
+    tarea = actions["actualizar_tarea"]
+    backend.update_task_status(tarea["task_id"], tarea["status"], tarea["avance"], None)
+    db.execute(insert_message, (producer_id, "asistente", output["respuesta_chat"], "enviado", backend.utc_now()))
+    db.commit()
+
+
+def single_write_phase(snapshot: backend.TurnSnapshot, output: dict) -> None:
+    backend.finish_agent_turn(snapshot, output)
+
+
+def measure(label: str, write_phase, output: dict) -> None:
+    db = backend.get_db()
+    commits = 0
+
+    def count(statement: str) -> None:
+        nonlocal commits
+        commits += statement.strip().upper() == "COMMIT"
+
+    elapsed = 0.0
+    for turn in range(TURNS):
+        snapshot = backend.load_turn_snapshot(PHONE)
+        snapshot.message = f"mensaje {turn}"
+        snapshot.received_at = backend.utc_now()
+        db.set_trace_callback(count)
+        start = time.perf_counter()
+        write_phase(snapshot, json.loads(json.dumps(output)))
+        elapsed += time.perf_counter() - start
+        db.set_trace_callback(None)
+    print(f"{label:<14}{commits / TURNS:>18.1f}{1000 * elapsed / TURNS:>16.3f}")
+
+
+def main() -> None:
+    # Con synchronous=FULL cada commit es al menos un fsync, también en WAL.
+    backend.SQLITE_SYNCHRONOUS = os.getenv("BENCH_SYNCHRONOUS", "FULL")
+    with tempfile.TemporaryDirectory() as tmp:
+        backend.app.config["DATABASE"] = str(Path(tmp) / "bench.db")
+        backend.init_db()
+        backend.migrate_db()
+        with backend.app.app_context():
+            output = model_output(seed())
+            print(
+                f"{TURNS} turnos, journal {backend.SQLITE_JOURNAL_MODE}, "
+                f"synchronous {backend.SQLITE_SYNCHRONOUS}"
+            )
+            print(f"{'variante':<14}{'commits/turno':>18}{'ms escritura':>16}")
+            measure("un commit/paso", legacy_write_phase, output)
+            measure("transacción", single_write_phase, output)
+        backend.close_db_pool()
+
+
+if __name__ == "__main__":
+    main()
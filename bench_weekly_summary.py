@@ -0,0 +1,164 @@
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import app as backend
+
+PRODUCERS = int(os.getenv("BENCH_PRODUCERS", "5000"))
+HISTORY_DAYS = int(os.getenv("BENCH_HISTORY_DAYS", "30"))
+MESSAGES_PER_DAY = int(os.getenv("BENCH_MESSAGES_PER_DAY", "4"))
+TURNS = int(os.getenv("BENCH_TURNS", "500"))
+
+
+def phone(index: int) -> str:
+    return f"+51{900000000 + index}"
+
+
+def stamp(days_ago: int, minute: int = 0) -> str:
+    moment = datetime.now(timezone.utc) - timedelta(days=days_ago, minutes=minute)
+    return moment.isoformat()
+
+
+def seed(db) -> None:
+    now = backend.utc_now()
+    db.executemany(
+        """
+        INSERT INTO producers (
+            phone, name, zone, preferred_language, main_crops, allowed, status,
+            timezone, assigned_role, enable_formulario, enable_consulta,
+            enable_intervencion, created_at
+        )
+        VALUES (?, ?, 'Cusco', 'es', ?, 1, 'activo', ?, 'consulta', 1, 1, 1, ?)
+        """,
+        (
+            (phone(i), f"Productor {i}", json.dumps(["papa"]), backend.DEFAULT_TIMEZONE, now)
+            for i in range(PRODUCERS)
+        ),
+    )
+    db.executemany(
+        """
+        INSERT INTO forms (producer_id, status, cultivo, sintoma, foto_recibida, created_at, updated_at)
+        VALUES (?, 'abierto', 'papa', 'hojas amarillas', 0, ?, ?)
+        """,
+        ((i + 1, now, stamp(i % HISTORY_DAYS)) for i in range(PRODUCERS)),
+    )
+    db.executemany(
+        """
+        INSERT INTO messages (producer_id, direction, content, status, created_at)
+        VALUES (?, 'usuario', 'mensaje', 'recibido', ?)
+        """,
+        (
+            (i + 1, stamp(day, n))
+            for i in range(PRODUCERS)
+            for day in range(HISTORY_DAYS)
+            for n in range(MESSAGES_PER_DAY)
+        ),
+    )
+    db.executemany(
+        """
+        INSERT INTO daily_logs (producer_id, log_date, notes, metrics_json, created_at)
+        VALUES (?, ?, 'riego', ?, ?)
+        """,
+        (
+            (i + 1, stamp(day)[:10], json.dumps({"humedad": random.randint(20, 40)}), stamp(day))
+            for i in range(PRODUCERS)
+            for day in range(HISTORY_DAYS)
+        ),
+    )
+    db.executemany(
+        """
+        INSERT INTO alerts (producer_id, level, reason, action, message, status, created_at)
+        VALUES (?, ?, 'bench', 'revisar', '', 'enviada', ?)
+        """,
+        (
+            (i + 1, random.choice(["bajo", "medio", "alto"]), stamp(day))
+            for i in range(PRODUCERS)
+            for day in range(0, HISTORY_DAYS, 5)
+        ),
+    )
+    db.executemany(
+        """
+        INSERT INTO producer_tasks (
+            producer_id, template_id, task_name, order_sequence, status,
+            estimated_date, completion_date, created_at, updated_at
+        )
+        VALUES (?, 1, 'Aporque', ?, 'COMPLETADO', ?, ?, ?, ?)
+        """,
+        (
+            (i + 1, day, stamp(day)[:10], stamp(day)[:10], now, now)
+            for i in range(PRODUCERS)
+            for day in range(0, HISTORY_DAYS, 10)
+        ),
+    )
+    db.commit()
+
+
+def incremental_summary(number: str) -> str:
+    snapshot = backend.load_turn_snapshot(number)
+    return backend.summarize_week(snapshot.weekly_days)
+
+
+def recomputed_summary(number: str) -> str:
+    snapshot = backend.load_turn_snapshot(number)
+    since, _ = backend.weekly_window()
+    return backend.summarize_week(backend.recompute_weekly_days(snapshot.producer["id"], since))
+
+
+def measure(label: str, turn, numbers: list[str]) -> None:
+    start = time.perf_counter()
+    for number in numbers:
+        turn(number)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<22}{1000 * elapsed / len(numbers):>12.3f}")
+
+
+def measure_writes(numbers: list[str]) -> None:
+    # Costo que el resumen agrega a cada escritura del turno.
+    db = backend.get_db()
+    ids = [backend.load_turn_snapshot(number).producer["id"] for number in numbers]
+    start = time.perf_counter()
+    for producer_id in ids:
+        with backend.write_transaction():
+            backend.record_weekly_event(producer_id, {"bitacoras": 1}, metrics={"humedad": 30})
+    elapsed = time.perf_counter() - start
+    db.rollback()
+    print(f"{'escritura incremental':<22}{1000 * elapsed / len(ids):>12.3f}")
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        backend.app.config["DATABASE"] = str(Path(tmp) / "bench.db")
+        backend.init_db()
+        backend.migrate_db()
+        with backend.app.app_context():
+            db = backend.get_db()
+            start = time.perf_counter()
+            seed(db)
+            print(
+                f"{PRODUCERS} productores, {HISTORY_DAYS} días de historial "
+                f"sembrados en {time.perf_counter() - start:.1f} s"
+            )
+            start = time.perf_counter()
+            stats = backend.compact_weekly_summaries(rebuild=True)
+            print(
+                f"compactación --rebuild: {stats['rebuilt']} resúmenes "
+                f"en {time.perf_counter() - start:.1f} s"
+            )
+            start = time.perf_counter()
+            backend.compact_weekly_summaries()
+            print(f"compactación nocturna: {time.perf_counter() - start:.1f} s")
+            numbers = [phone(random.randrange(PRODUCERS)) for _ in range(TURNS)]
+            assert incremental_summary(numbers[0]) == recomputed_summary(numbers[0])
+            print(f"{'variante':<22}{'ms/turno':>12}")
+            measure("recalcular al vuelo", recomputed_summary, numbers)
+            measure("resumen incremental", incremental_summary, numbers)
+            measure_writes(numbers)
+        backend.close_db_pool()
+
+
+if __name__ == "__main__":
+    main()
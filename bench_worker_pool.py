@@ -0,0 +1,63 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+CORES = int(os.getenv("BENCH_CORES", str(os.cpu_count() or 1)))
+REQUESTS = int(os.getenv("BENCH_REQUESTS", "32"))
+MAX_TOKENS = int(os.getenv("BENCH_MAX_TOKENS", "64"))
+
+SYSTEM_PROMPT = (
+    "Responde usando SOLO la información del contexto. "
+    "Devuelve SOLO JSON válido con las claves: "
+    "role, respuesta_chat, acciones{actualizar_formulario,alerta,log}, "
+    "estado{formulario_completo,confianza}."
+)
+
+
+def splits(cores: int) -> list[tuple[int, int]]:
+    layouts = []
+    workers = 1
+    while workers <= cores:
+        layouts.append((workers, cores // workers))
+        workers *= 2
+    return layouts
+
+
+def run_layout(workers: int, threads: int) -> tuple[float, float]:
+    # Los procesos hijos leen N_THREADS al importar model_api.
+    os.environ["N_THREADS"] = str(threads)
+    from model_api import WorkerPool
+
+    pool = WorkerPool(workers)
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": '{"role": "consulta", "last_user_message": "¿cuándo riego la papa?"}'},
+    ]
+    # Una petición por worker para que todos terminen de cargar el modelo.
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda _: pool.submit(messages, "consulta", 1, None), range(workers)))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers * 2) as executor:
+        results = list(
+            executor.map(
+                lambda _: pool.submit(messages, "consulta", MAX_TOKENS, None),
+                range(REQUESTS),
+            )
+        )
+    elapsed = time.perf_counter() - start
+    pool.close()
+    tokens = sum(result["usage"].get("completion_tokens", 0) for result in results)
+    return REQUESTS / elapsed, tokens / elapsed
+
+
+def main() -> None:
+    print(f"{CORES} núcleos, {REQUESTS} peticiones, max_tokens {MAX_TOKENS}")
+    print(f"{'workers':>8}{'hilos':>8}{'req/s':>10}{'tok/s':>10}")
+    for workers, threads in splits(CORES):
+        requests_per_sec, tokens_per_sec = run_layout(workers, threads)
+        print(f"{workers:>8}{threads:>8}{requests_per_sec:>10.2f}{tokens_per_sec:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import re
+import sys
+import tempfile
+from pathlib import Path
+
+import app as backend
+
+# Tablas que crecen con el uso; ninguna consulta del turno ni del reclamo de
+# alertas debe recorrerlas completas.
+HOT_TABLES = {
+    "producers",
+    "messages",
+    "forms",
+    "producer_tasks",
+    "daily_logs",
+    "producer_plans",
+    "alerts",
+}
+FULL_SCAN = re.compile(r"^SCAN (\w+)(?! USING (?:COVERING )?INDEX)")
+
+PHONE = "+51900000001"
+
+
+def exercise_hot_paths() -> None:
+    client = backend.app.test_client()
+    producer = backend.get_or_create_producer(PHONE)
+    backend.get_or_create_form(producer["id"])
+    backend.load_turn_snapshot(PHONE)
+    backend.get_active_plan(producer["id"])
+    backend.recent_daily_logs(producer["id"])
+    backend.recent_chat(producer["id"])
+    backend.get_active_task(producer["id"])
+    client.get("/alerts/pending")
+    client.post("/alerts/claim", json={"consumer": "plans", "limit": 10})
+    client.get("/outbox/pending")
+    backend.pending_since(0, 0)
+
+
+def captured_selects() -> list[str]:
+    statements: list[str] = []
+
+    def capture(statement: str) -> None:
+        if statement.lstrip().upper().startswith(("SELECT", "WITH", "UPDATE")):
+            statements.append(statement)
+
+    original = backend.get_db
+
+    def traced_db():
+        db = original()
+        db.set_trace_callback(capture)
+        return db
+
+    backend.get_db = traced_db
+    try:
+        with backend.app.app_context():
+            exercise_hot_paths()
+    finally:
+        backend.get_db = original
+    return list(dict.fromkeys(statements))
+
+
+def main() -> int:
+    with tempfile.TemporaryDirectory() as tmp:
+        backend.app.config["DATABASE"] = str(Path(tmp) / "plans.db")
+        backend.init_db()
+        backend.migrate_db()
+        statements = captured_selects()
+        with backend.app.app_context():
+            db = backend.get_db()
+            failures = 0
+            for statement in statements:
+                plan = [row["detail"] for row in db.execute(f"EXPLAIN QUERY PLAN {statement}")]
+                scans = [
+                    detail
+                    for detail in plan
+                    if (match := FULL_SCAN.match(detail)) and match.group(1) in HOT_TABLES
+                ]
+                status = "FALLA" if scans else "ok"
+                failures += bool(scans)
+                print(f"[{status}] {' '.join(statement.split())[:100]}")
+                for detail in plan:
+                    print(f"        {detail}")
+    print(f"{len(statements)} consultas, {failures} con recorrido completo")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+import os
+import threading
+import time
+
+# Histogramas de /metrics, compartidos por el backend (app.py) y el servicio
+# del modelo (model_api.py). Cada servicio despliega su propia copia de este
+# archivo junto al suyo.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+
+
+class Histogram:
+    # Buckets acumulativos al estilo Prometheus: counts[i] cuenta las
+    # observaciones <= bounds[i]; la última posición es +Inf.
+    def __init__(self, bounds: tuple[float, ...]) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self.lock:
+            self.count += 1
+            self.sum += value
+            for index, bound in enumerate(self.bounds):
+                if value <= bound:
+                    self.counts[index] += 1
+            self.counts[-1] += 1
+
+    def quantile(self, q: float) -> float | str | None:
+        # Cota superior del bucket donde cae el cuantil.
+        with self.lock:
+            if not self.count:
+                return None
+            target = q * self.count
+            for bound, count in zip(self.bounds, self.counts):
+                if count >= target:
+                    return bound
+            return "+Inf"
+
+    def stats(self) -> dict[str, Any]:
+        with self.lock:
+            buckets = [[bound, count] for bound, count in zip(self.bounds, self.counts)]
+            buckets.append(["+Inf", self.counts[-1]])
+            count, total = self.count, self.sum
+        return {
+            "count": count,
+            "sum": round(total, 4),
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": buckets,
+        }
+
+
+STAGE_SECONDS_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120
+)
+TOKEN_COUNT_BUCKETS = (8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+def prometheus_labels(labels: dict[str, str]) -> str:
+    pairs = ",".join(
+        '{}="{}"'.format(
+            name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        for name, value in labels.items()
+    )
+    return f"{{{pairs}}}" if pairs else ""
+
+
+def render_histogram(name: str, labels: dict[str, str], histogram: Histogram) -> list[str]:
+    # Los counts de Histogram ya son acumulativos, como los espera Prometheus.
+    with histogram.lock:
+        counts, count, total = list(histogram.counts), histogram.count, histogram.sum
+    lines = [
+        f"{name}_bucket{prometheus_labels(labels | {'le': str(bound)})} {bucket}"
+        for bound, bucket in zip(histogram.bounds, counts)
+    ]
+    lines.append(f"{name}_bucket{prometheus_labels(labels | {'le': '+Inf'})} {counts[-1]}")
+    lines.append(f"{name}_sum{prometheus_labels(labels)} {total}")
+    lines.append(f"{name}_count{prometheus_labels(labels)} {count}")
+    return lines
+
+
+class HistogramFamily:
+    # Una métrica de /metrics: un Histogram por combinación de etiquetas,
+    # creado en la primera observación. Observar cuesta un lock y un recorrido
+    # de los buckets, así que puede quedar activo en producción.
+    def __init__(
+        self, name: str, help_text: str, labels: tuple[str, ...], bounds: tuple[float, ...]
+    ) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.bounds = bounds
+        self.children: dict[tuple[str, ...], Histogram] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str) -> None:
+        if not METRICS_ENABLED:
+            return
+        child = self.children.get(label_values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(label_values, Histogram(self.bounds))
+        child.observe(value)
+
+    @contextmanager
+    def time(self, *label_values: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            children = sorted(self.children.items())
+        for label_values, child in children:
+            lines += render_histogram(self.name, dict(zip(self.labels, label_values)), child)
+        return lines
@@ -1,11 +1,34 @@
 from __future__ import annotations
 
+import codecs
+import hashlib
+import itertools
 import json
+import multiprocessing
 import os
+import queue
+import random
+import struct
+import threading
+import time
+from contextlib import closing, contextmanager
 from pathlib import Path
+from typing import Any, Iterator
 
-from flask import Flask, jsonify, request
-from llama_cpp import Llama
+import llama_cpp
+from flask import Flask, Response, jsonify, request, stream_with_context
+from llama_cpp import Llama, LlamaGrammar, LlamaState
+from llama_cpp import _internals
+from llama_cpp.llama_chat_format import Jinja2ChatFormatter
+from werkzeug.exceptions import BadRequest
+from werkzeug.serving import is_running_from_reloader
+
+from metrics import (
+    STAGE_SECONDS_BUCKETS,
+    TOKEN_COUNT_BUCKETS,
+    TOKENS_PER_SECOND_BUCKETS,
+    HistogramFamily,
+)
 
 BASE_DIR = Path(__file__).resolve().parent
 MODEL_PATH = os.getenv(
@@ -13,47 +36,938 @@ MODEL_PATH = os.getenv(
 )
 N_CTX = int(os.getenv("N_CTX", "2048"))
 N_THREADS = int(os.getenv("N_THREADS", "1"))
+PREFIX_CACHE_ENABLED = os.getenv("PREFIX_CACHE_ENABLED", "1") == "1"
+# serial: una completion a la vez; batch: agrupa peticiones concurrentes en un
+# mismo llama_decode con varias secuencias.
+MODEL_MODE = os.getenv("MODEL_MODE", "serial")
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "4"))
+BATCH_MAX_WAIT_MS = int(os.getenv("BATCH_MAX_WAIT_MS", "25"))
+BATCH_N_BATCH = int(os.getenv("BATCH_N_BATCH", "512"))
+# Modo pool: MODEL_WORKERS procesos con N_THREADS hilos cada uno. Todos mapean
+# el mismo GGUF con mmap, así que los pesos se comparten vía page cache.
+MODEL_WORKERS = int(os.getenv("MODEL_WORKERS", "2"))
+# Segundos sin respuesta de un worker con peticiones en curso antes de darlo por
+# colgado: sus peticiones fallan y el proceso se reemplaza.
+MODEL_WORKER_TIMEOUT = float(os.getenv("MODEL_WORKER_TIMEOUT", "300"))
+MODEL_FRAME_CONTENT_TYPE = "application/x-mml-frame"
+# Carga del modelo y calentamiento al arrancar, antes de recibir tráfico
+# (/health/ready responde 503 mientras tanto). MODEL_MLOCK fija los pesos en RAM.
+MODEL_EAGER_LOAD = os.getenv("MODEL_EAGER_LOAD", "0") == "1"
+MODEL_MLOCK = os.getenv("MODEL_MLOCK", "0") == "1"
+WARMUP_MAX_TOKENS = int(os.getenv("WARMUP_MAX_TOKENS", "8"))
+WARMUP_PROMPT = "Responde en una palabra."
 
 app = Flask(__name__)
 _LLM: Llama | None = None
+_LLM_LOCK = threading.Lock()
+_LLM_LOAD_LOCK = threading.Lock()
+_TOKENIZER: Llama | None = None
+# role -> (huella del prompt, estado KV con el prompt de sistema ya evaluado)
+_PREFIX_STATES: dict[str, tuple[str, LlamaState]] = {}
+_ACTIVE_PREFIX: tuple[str, str] | None = None
+# role -> (huella del esquema, gramática GBNF compilada)
+_GRAMMARS: dict[str, tuple[str, LlamaGrammar]] = {}
+# sin_cargar | cargando | listo | error, con los tiempos de carga y calentamiento.
+_READINESS: dict[str, Any] = {"status": "sin_cargar"}
+_READINESS_LOCK = threading.Lock()
+
+
+REQUEST_SECONDS = HistogramFamily(
+    "model_api_request_seconds",
+    "Duración de cada petición, de la llegada a la última respuesta.",
+    ("route", "role"),
+    STAGE_SECONDS_BUCKETS,
+)
+STAGE_SECONDS = HistogramFamily(
+    "model_api_stage_seconds",
+    "Duración de cada etapa de una petición.",
+    ("stage", "role"),
+    STAGE_SECONDS_BUCKETS,
+)
+MODEL_TOKENS = HistogramFamily(
+    "model_api_tokens",
+    "Tokens por petición: prompt, prompt evaluado (sin prefijo en cache) y generados.",
+    ("role", "kind"),
+    TOKEN_COUNT_BUCKETS,
+)
+TOKENS_PER_SECOND = HistogramFamily(
+    "model_api_tokens_per_second",
+    "Velocidad de evaluación del prompt y de generación.",
+    ("role", "phase"),
+    TOKENS_PER_SECOND_BUCKETS,
+)
+METRIC_FAMILIES = [REQUEST_SECONDS, STAGE_SECONDS, MODEL_TOKENS, TOKENS_PER_SECOND]
+
+
+def llama_perf(llm: Llama) -> tuple[float, float, int, int] | None:
+    # Contadores acumulados del contexto de llama.cpp; se restan antes y
+    # después de cada completion. None si la versión no los expone.
+    try:
+        data = llama_cpp.llama_perf_context(llm.ctx)
+    except AttributeError:
+        return None
+    return data.t_p_eval_ms, data.t_eval_ms, data.n_p_eval, data.n_eval
+
+
+def perf_usage(
+    before: tuple[float, float, int, int] | None, after: tuple[float, float, int, int] | None
+) -> dict[str, float]:
+    if before is None or after is None:
+        return {}
+    return {
+        "prompt_eval_ms": after[0] - before[0],
+        "eval_ms": after[1] - before[1],
+        "prompt_eval_tokens": after[2] - before[2],
+        "eval_tokens": after[3] - before[3],
+    }
+
+
+def observe_usage(role: str, usage: dict[str, Any]) -> None:
+    for kind in ("prompt", "prompt_eval", "completion"):
+        if usage.get(f"{kind}_tokens"):
+            MODEL_TOKENS.observe(usage[f"{kind}_tokens"], role, kind)
+    completion = usage.get("completion_tokens") or usage.get("eval_tokens") or 0
+    for phase, elapsed_ms, tokens in (
+        ("prompt_eval", usage.get("prompt_eval_ms"), usage.get("prompt_eval_tokens") or 0),
+        ("generation", usage.get("eval_ms"), completion),
+    ):
+        if elapsed_ms:
+            STAGE_SECONDS.observe(elapsed_ms / 1000, phase, role)
+            if tokens:
+                TOKENS_PER_SECOND.observe(1000 * tokens / elapsed_ms, role, phase)
 
 
 def get_llm() -> Llama:
     global _LLM
-    if _LLM is None:
+    with _LLM_LOAD_LOCK:
+        if _LLM is None:
+            if not Path(MODEL_PATH).exists():
+                raise RuntimeError(f"No se encontró el modelo local en {MODEL_PATH}.")
+            _LLM = Llama(
+                model_path=MODEL_PATH,
+                n_ctx=N_CTX,
+                n_threads=N_THREADS,
+                use_mmap=True,
+                use_mlock=MODEL_MLOCK,
+            )
+    return _LLM
+
+
+def get_tokenizer() -> Llama:
+    # Solo el vocabulario: sirve en cualquier modo, también en pool, donde el
+    # proceso principal no carga los pesos.
+    global _TOKENIZER
+    if _TOKENIZER is None:
         if not Path(MODEL_PATH).exists():
             raise RuntimeError(f"No se encontró el modelo local en {MODEL_PATH}.")
-        _LLM = Llama(
-            model_path=MODEL_PATH,
-            n_ctx=N_CTX,
-            n_threads=N_THREADS,
+        _TOKENIZER = Llama(model_path=MODEL_PATH, vocab_only=True, verbose=False)
+    return _TOKENIZER
+
+
+def load_prefix_state(llm: Llama, role: str, system_prompt: str) -> None:
+    # El prompt de sistema cambia solo cuando se edita el agente en el backend;
+    # la huella detecta ese cambio y vuelve a evaluar el prefijo del rol.
+    global _ACTIVE_PREFIX
+    if not PREFIX_CACHE_ENABLED:
+        return
+    fingerprint = hashlib.sha1(system_prompt.encode("utf-8")).hexdigest()
+    if _ACTIVE_PREFIX == (role, fingerprint):
+        return
+    cached = _PREFIX_STATES.get(role)
+    if cached and cached[0] == fingerprint:
+        llm.load_state(cached[1])
+    else:
+        llm.reset()
+        llm.create_chat_completion(
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": ""},
+            ],
+            temperature=0,
+            max_tokens=1,
         )
-    return _LLM
+        _PREFIX_STATES[role] = (fingerprint, llm.save_state())
+    _ACTIVE_PREFIX = (role, fingerprint)
+
+
+class _Sequence:
+    def __init__(
+        self,
+        tokens: list[int],
+        max_tokens: int,
+        temperature: float,
+        grammar: LlamaGrammar | None,
+        output: queue.Queue,
+    ) -> None:
+        self.tokens = tokens
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.grammar = grammar
+        self.output = output
+        self.seq_id = -1
+        self.n_past = 0
+        # Tokens del prompt que ya estaban en el KV del seq_id asignado.
+        self.cached_tokens = 0
+        self.pending: list[int] = list(tokens)
+        self.generated: list[int] = []
+        self.logits_index: int | None = None
+        self.sampler: _internals.LlamaSampler | None = None
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        # Admisión y primer token muestreado: separan en usage el tiempo de
+        # prompt del de generación (compartidos con el resto del lote).
+        self.admitted_at = 0.0
+        self.first_token_at = 0.0
+        # Lo marca el generador de submit al cerrarse antes de terminar.
+        self.cancelled = False
+
+
+class BatchScheduler:
+    # Batching continuo: cada paso de llama_decode lleva el siguiente token de
+    # todas las secuencias activas y, si hay espacio, trozos del prompt de las
+    # peticiones recién admitidas. Una petición nueva no espera a que termine
+    # el lote anterior, solo a que quede un seq_id libre.
+    # El contexto de una secuencia que trae el Llama se libera: el scheduler
+    # usa uno solo, de max_size secuencias, y del Llama solo toma pesos y
+    # vocabulario. Cada seq_id conserva su KV al terminar: una petición nueva
+    # toma el libre con el prefijo común más largo (prompt de sistema y
+    # contexto estable) y solo evalúa el resto, como hace el modo serial.
+
+    def __init__(self, llm: Llama, max_size: int, max_wait_ms: int) -> None:
+        self.llm = llm
+        self.max_size = max_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests: queue.Queue[_Sequence] = queue.Queue()
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = N_CTX * max_size
+        params.n_batch = BATCH_N_BATCH
+        params.n_ubatch = BATCH_N_BATCH
+        params.n_threads = N_THREADS
+        params.n_threads_batch = N_THREADS
+        params.n_seq_max = max_size
+        llm._ctx.close()
+        self.ctx = _internals.LlamaContext(model=llm._model, params=params, verbose=False)
+        llm._ctx = self.ctx
+        self.batch = _internals.LlamaBatch(
+            n_tokens=BATCH_N_BATCH, embd=0, n_seq_max=max_size, verbose=False
+        )
+        self.formatter = chat_formatter(llm)
+        self.free_ids = list(range(max_size))
+        # seq_id -> tokens que hay en su KV.
+        self.cached: list[list[int]] = [[] for _ in range(max_size)]
+        self.active: list[_Sequence] = []
+        self.thread = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+        self.thread.start()
+
+    def submit(
+        self,
+        messages: list[dict[str, str]],
+        max_tokens: int,
+        temperature: float,
+        grammar: LlamaGrammar | None = None,
+    ) -> Iterator[str | dict[str, int]]:
+        formatted = self.formatter(messages=messages)
+        tokens = self.llm.tokenize(
+            formatted.prompt.encode("utf-8"),
+            add_bos=not formatted.added_special,
+            special=True,
+        )
+        if len(tokens) + max_tokens > N_CTX:
+            raise BadRequest(f"El prompt ({len(tokens)} tokens) no cabe en N_CTX={N_CTX}.")
+        return self._results(_Sequence(tokens, max_tokens, temperature, grammar, queue.Queue()))
+
+    def _results(self, seq: _Sequence) -> Iterator[str | dict[str, int]]:
+        self.requests.put(seq)
+        try:
+            while True:
+                item = seq.output.get()
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+                if isinstance(item, dict):
+                    return
+        finally:
+            # Cliente desconectado: el scheduler suelta la secuencia en el
+            # siguiente paso en vez de generar hasta max_tokens.
+            seq.cancelled = True
+
+    def _admit(self, block: bool) -> None:
+        deadline = None
+        while self.free_ids:
+            try:
+                if block and not self.active:
+                    seq = self.requests.get()
+                    deadline = time.monotonic() + self.max_wait
+                elif deadline is not None:
+                    seq = self.requests.get(timeout=max(0.0, deadline - time.monotonic()))
+                else:
+                    seq = self.requests.get_nowait()
+            except queue.Empty:
+                return
+            if seq.cancelled:
+                continue
+            seq.seq_id = max(self.free_ids, key=lambda i: common_prefix(self.cached[i], seq.tokens))
+            self.free_ids.remove(seq.seq_id)
+            # Al menos el último token del prompt se evalúa, para tener logits.
+            seq.n_past = min(
+                common_prefix(self.cached[seq.seq_id], seq.tokens), len(seq.tokens) - 1
+            )
+            seq.pending = seq.tokens[seq.n_past :]
+            seq.cached_tokens = seq.n_past
+            self.ctx.kv_cache_seq_rm(seq.seq_id, seq.n_past, -1)
+            seq.sampler = new_sampler(self.llm, seq.temperature, seq.grammar)
+            seq.admitted_at = time.perf_counter()
+            self.active.append(seq)
+
+    def _fill_batch(self) -> None:
+        raw = self.batch.batch
+        raw.n_tokens = 0
+        for seq in self.active:
+            seq.logits_index = None
+            if seq.pending:
+                room = BATCH_N_BATCH - raw.n_tokens
+                chunk, seq.pending = seq.pending[:room], seq.pending[room:]
+                last = not seq.pending
+            else:
+                if raw.n_tokens >= BATCH_N_BATCH:
+                    continue
+                chunk, last = [seq.generated[-1]], True
+            for offset, token in enumerate(chunk):
+                j = raw.n_tokens
+                raw.token[j] = token
+                raw.pos[j] = seq.n_past
+                raw.n_seq_id[j] = 1
+                raw.seq_id[j][0] = seq.seq_id
+                raw.logits[j] = last and offset == len(chunk) - 1
+                raw.n_tokens += 1
+                seq.n_past += 1
+            if last and chunk:
+                seq.logits_index = raw.n_tokens - 1
+
+    def _finish(self, seq: _Sequence, error: Exception | None = None) -> None:
+        if error is None:
+            self.cached[seq.seq_id] = (seq.tokens + seq.generated)[: seq.n_past]
+        else:
+            self.ctx.kv_cache_seq_rm(seq.seq_id, -1, -1)
+            self.cached[seq.seq_id] = []
+        self.free_ids.append(seq.seq_id)
+        self.active.remove(seq)
+        seq.sampler = None
+        if seq.cancelled:
+            return
+        if error is not None:
+            seq.output.put(error)
+            return
+        tail = seq.decoder.decode(b"", final=True)
+        if tail:
+            seq.output.put(tail)
+        first_token_at = seq.first_token_at or time.perf_counter()
+        seq.output.put(
+            {
+                "prompt_tokens": len(seq.tokens),
+                "completion_tokens": len(seq.generated),
+                "total_tokens": len(seq.tokens) + len(seq.generated),
+                "prompt_eval_tokens": len(seq.tokens) - seq.cached_tokens,
+                "prompt_eval_ms": 1000 * (first_token_at - seq.admitted_at),
+                "eval_ms": 1000 * (time.perf_counter() - first_token_at),
+            }
+        )
+
+    def _step(self) -> None:
+        for seq in list(self.active):
+            if seq.cancelled:
+                self._finish(seq)
+        if not self.active:
+            return
+        self._fill_batch()
+        self.ctx.decode(self.batch)
+        for seq in list(self.active):
+            if seq.logits_index is None:
+                continue
+            token = seq.sampler.sample(self.ctx, seq.logits_index)
+            seq.first_token_at = seq.first_token_at or time.perf_counter()
+            if is_end_token(self.llm, token):
+                self._finish(seq)
+                continue
+            seq.generated.append(token)
+            piece = seq.decoder.decode(self.llm.detokenize([token]))
+            if piece:
+                seq.output.put(piece)
+            if len(seq.generated) >= seq.max_tokens:
+                self._finish(seq)
+
+    def _run(self) -> None:
+        while True:
+            self._admit(block=True)
+            try:
+                self._step()
+            except Exception as exc:
+                for seq in list(self.active):
+                    self._finish(seq, exc)
+
+
+_SCHEDULER: BatchScheduler | None = None
+_SCHEDULER_LOCK = threading.Lock()
+
+
+def get_scheduler() -> BatchScheduler:
+    global _SCHEDULER
+    with _SCHEDULER_LOCK:
+        if _SCHEDULER is None:
+            _SCHEDULER = BatchScheduler(get_llm(), BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS)
+    return _SCHEDULER
+
+
+def chat_formatter(llm: Llama) -> Jinja2ChatFormatter:
+    template = llm.metadata.get("tokenizer.chat_template")
+    if not template:
+        raise RuntimeError("El modelo no incluye tokenizer.chat_template.")
+    eos_id = llm.token_eos()
+    bos_id = llm.token_bos()
+    return Jinja2ChatFormatter(
+        template=template,
+        eos_token=llm._model.token_get_text(eos_id) if eos_id != -1 else "",
+        bos_token=llm._model.token_get_text(bos_id) if bos_id != -1 else "",
+        stop_token_ids=[eos_id],
+    )
+
+
+def new_sampler(
+    llm: Llama, temperature: float, grammar: LlamaGrammar | None
+) -> _internals.LlamaSampler:
+    # Mismos valores por defecto que Llama.create_chat_completion.
+    sampler = _internals.LlamaSampler()
+    if grammar is not None:
+        sampler.add_grammar(llm._model, grammar)
+    if temperature <= 0:
+        sampler.add_greedy()
+        return sampler
+    sampler.add_top_k(40)
+    sampler.add_top_p(0.95, 1)
+    sampler.add_min_p(0.05, 1)
+    sampler.add_temp(temperature)
+    sampler.add_dist(random.randint(0, 2**31 - 1))
+    return sampler
+
+
+def common_prefix(a: list[int], b: list[int]) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def is_end_token(llm: Llama, token: int) -> bool:
+    return llama_cpp.llama_vocab_is_eog(llm._model.vocab, token)
+
+
+def _pool_worker(
+    index: int, requests_q: multiprocessing.Queue, responses_q: multiprocessing.Queue
+) -> None:
+    get_llm()
+    while True:
+        item = requests_q.get()
+        if item is None:
+            return
+        request_id, messages, role, max_tokens, schema, streaming = item
+        try:
+            grammar = get_grammar(role, schema)
+            if streaming:
+                for piece in stream_serial(messages, role, max_tokens, grammar):
+                    if isinstance(piece, dict):
+                        responses_q.put((request_id, index, "done", piece))
+                    else:
+                        responses_q.put((request_id, index, "chunk", piece))
+            else:
+                result = complete_serial(messages, role, max_tokens, grammar)
+                responses_q.put((request_id, index, "done", result))
+        except Exception as exc:
+            responses_q.put((request_id, index, "error", str(exc)))
+
+
+class WorkerPool:
+    # Enruta cada petición al proceso con menos peticiones en curso; a igual
+    # carga prefiere el que atendió el mismo rol por última vez, porque ya
+    # tiene cargado el prefijo KV de ese rol.
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.context = multiprocessing.get_context("spawn")
+        self.responses: multiprocessing.Queue = self.context.Queue()
+        self.queues: list[multiprocessing.Queue] = []
+        self.processes: list[multiprocessing.Process] = []
+        self.inflight = [0] * size
+        # request_id de las peticiones enviadas a cada worker y sin terminar.
+        self.assigned: list[set[int]] = [set() for _ in range(size)]
+        self.last_role: list[str | None] = [None] * size
+        # Último momento en que cada worker dio señales (respuesta o fragmento).
+        self.progress = [time.monotonic()] * size
+        self.waiters: dict[int, queue.Queue] = {}
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        for index in range(size):
+            self.queues.append(self.context.Queue())
+            self.processes.append(self._start(index))
+        threading.Thread(target=self._dispatch, name="pool-dispatch", daemon=True).start()
+
+    def _start(self, index: int) -> multiprocessing.Process:
+        process = self.context.Process(
+            target=_pool_worker,
+            args=(index, self.queues[index], self.responses),
+            name=f"model-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        return process
+
+    def _dispatch(self) -> None:
+        while True:
+            request_id, index, kind, data = self.responses.get()
+            with self.lock:
+                self.progress[index] = time.monotonic()
+                if kind == "chunk":
+                    waiter = self.waiters.get(request_id)
+                elif request_id in self.assigned[index]:
+                    self.assigned[index].discard(request_id)
+                    self.inflight[index] -= 1
+                    waiter = self.waiters.pop(request_id, None)
+                else:
+                    # Ya se dio por perdida al reiniciar el worker.
+                    waiter = None
+            if waiter:
+                waiter.put((kind, data))
+
+    def _restart(self, index: int, process: multiprocessing.Process) -> None:
+        # Solo el primero que ve muerto o colgado este Process lo reemplaza;
+        # falla todas las peticiones que tenía ese worker, no solo la de quien
+        # lo detectó.
+        with self.lock:
+            if self.processes[index] is not process:
+                return
+            if process.is_alive():
+                if time.monotonic() - self.progress[index] < MODEL_WORKER_TIMEOUT:
+                    return
+                process.kill()
+                error = (
+                    f"El worker {index} del modelo no respondió en "
+                    f"{MODEL_WORKER_TIMEOUT:g} s."
+                )
+            else:
+                error = f"El worker {index} del modelo terminó inesperadamente."
+            for request_id in self.assigned[index]:
+                waiter = self.waiters.pop(request_id, None)
+                if waiter:
+                    waiter.put(("error", error))
+            self.inflight[index] -= len(self.assigned[index])
+            self.assigned[index].clear()
+            # Cola nueva: lo que quedó sin leer en la anterior ya se respondió.
+            self.queues[index] = self.context.Queue()
+            self.processes[index] = self._start(index)
+            self.progress[index] = time.monotonic()
+        process.join(timeout=5)
+
+    def _send(
+        self,
+        messages: list[dict[str, str]],
+        role: str,
+        max_tokens: int,
+        schema: dict[str, Any] | None,
+        streaming: bool,
+    ) -> Iterator[tuple[str, Any]]:
+        waiter: queue.Queue = queue.Queue()
+        with self.lock:
+            index = min(
+                range(self.size),
+                key=lambda i: (self.inflight[i], self.last_role[i] != role),
+            )
+            request_id = next(self.ids)
+            if not self.inflight[index]:
+                # Inactivo hasta ahora: el plazo corre desde esta petición.
+                self.progress[index] = time.monotonic()
+            self.inflight[index] += 1
+            self.assigned[index].add(request_id)
+            self.last_role[index] = role
+            self.waiters[request_id] = waiter
+            self.queues[index].put((request_id, messages, role, max_tokens, schema, streaming))
+        while True:
+            try:
+                kind, data = waiter.get(timeout=1.0)
+            except queue.Empty:
+                process = self.processes[index]
+                if (
+                    not process.is_alive()
+                    or time.monotonic() - self.progress[index] >= MODEL_WORKER_TIMEOUT
+                ):
+                    self._restart(index, process)
+                continue
+            if kind == "error":
+                raise RuntimeError(data)
+            yield kind, data
+            if kind == "done":
+                return
+
+    def submit(
+        self,
+        messages: list[dict[str, str]],
+        role: str,
+        max_tokens: int,
+        schema: dict[str, Any] | None,
+    ) -> dict[str, Any]:
+        for _, result in self._send(messages, role, max_tokens, schema, False):
+            return result
+        raise RuntimeError("El worker no devolvió resultado.")
+
+    def stream(
+        self,
+        messages: list[dict[str, str]],
+        role: str,
+        max_tokens: int,
+        schema: dict[str, Any] | None,
+    ) -> Iterator[str | dict[str, int]]:
+        for _, data in self._send(messages, role, max_tokens, schema, True):
+            yield data
+
+    def close(self) -> None:
+        for requests_q in self.queues:
+            requests_q.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+
+
+_POOL: WorkerPool | None = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool() -> WorkerPool:
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = WorkerPool(MODEL_WORKERS)
+    return _POOL
+
+
+def complete(
+    messages: list[dict[str, str]],
+    role: str,
+    max_tokens: int,
+    schema: dict[str, Any] | None = None,
+) -> dict[str, Any]:
+    if MODEL_MODE == "pool":
+        return get_pool().submit(messages, role, max_tokens, schema)
+    grammar = get_grammar(role, schema)
+    if MODEL_MODE == "batch":
+        pieces: list[str] = []
+        usage: dict[str, int] = {}
+        for item in get_scheduler().submit(messages, max_tokens, 0.2, grammar):
+            if isinstance(item, dict):
+                usage = item
+            else:
+                pieces.append(item)
+        return {"content": "".join(pieces), "usage": usage}
+    return complete_serial(messages, role, max_tokens, grammar)
+
+
+def stream(
+    messages: list[dict[str, str]],
+    role: str,
+    max_tokens: int,
+    schema: dict[str, Any] | None = None,
+) -> Iterator[str | dict[str, int]]:
+    # Produce fragmentos de texto y, al final, un dict con el uso de tokens.
+    # No es un generador: en modo batch el prompt se valida al llamarla, antes
+    # de empezar la respuesta.
+    if MODEL_MODE == "pool":
+        return get_pool().stream(messages, role, max_tokens, schema)
+    grammar = get_grammar(role, schema)
+    if MODEL_MODE == "batch":
+        return get_scheduler().submit(messages, max_tokens, 0.2, grammar)
+    return stream_serial(messages, role, max_tokens, grammar)
+
+
+def complete_serial(
+    messages: list[dict[str, str]],
+    role: str,
+    max_tokens: int,
+    grammar: LlamaGrammar | None = None,
+) -> dict[str, Any]:
+    llm = get_llm()
+    with _LLM_LOCK:
+        load_prefix_state(llm, role, messages[0]["content"])
+        before = llama_perf(llm)
+        response = llm.create_chat_completion(
+            messages=messages,
+            temperature=0.2,
+            max_tokens=max_tokens,
+            grammar=grammar,
+        )
+        usage = response.get("usage", {}) | perf_usage(before, llama_perf(llm))
+    content = response["choices"][0]["message"]["content"] or ""
+    return {"content": content, "usage": usage}
+
+
+def stream_serial(
+    messages: list[dict[str, str]],
+    role: str,
+    max_tokens: int,
+    grammar: LlamaGrammar | None = None,
+) -> Iterator[str | dict[str, int]]:
+    llm = get_llm()
+    # Los fragmentos del stream no son tokens (uno puede juntar varios o
+    # esperar a completar un carácter) y el stream no trae usage: se cuentan
+    # los tokens generados que quedaron evaluados en el contexto.
+    prompt_end = None
+    finish_reason = None
+    with _LLM_LOCK:
+        load_prefix_state(llm, role, messages[0]["content"])
+        before = llama_perf(llm)
+        for chunk in llm.create_chat_completion(
+            messages=messages,
+            temperature=0.2,
+            max_tokens=max_tokens,
+            grammar=grammar,
+            stream=True,
+        ):
+            if prompt_end is None:
+                # Llega con el prompt evaluado y el primer token muestreado,
+                # todavía sin evaluar.
+                prompt_end = llm.n_tokens
+            choice = chunk["choices"][0]
+            finish_reason = choice.get("finish_reason") or finish_reason
+            piece = choice["delta"].get("content")
+            if piece:
+                yield piece
+        usage = perf_usage(before, llama_perf(llm))
+        # El último token muestreado no se evalúa: si fue el de fin de
+        # generación no cuenta (como en el usage de /chat); si se cortó por
+        # max_tokens, sí.
+        completion_tokens = llm.n_tokens - (prompt_end or llm.n_tokens)
+        completion_tokens += finish_reason == "length"
+    yield {"completion_tokens": completion_tokens} | usage
+
+
+def get_grammar(role: str, schema: dict[str, Any] | None) -> LlamaGrammar | None:
+    if not schema:
+        return None
+    raw = json.dumps(schema, sort_keys=True)
+    fingerprint = hashlib.sha1(raw.encode("utf-8")).hexdigest()
+    cached = _GRAMMARS.get(role)
+    if cached and cached[0] == fingerprint:
+        return cached[1]
+    grammar = LlamaGrammar.from_json_schema(raw, verbose=False)
+    _GRAMMARS[role] = (fingerprint, grammar)
+    return grammar
+
+
+def load_model() -> float:
+    start = time.perf_counter()
+    if MODEL_MODE == "pool":
+        get_pool()
+    elif MODEL_MODE == "batch":
+        get_scheduler()
+    else:
+        get_llm()
+    elapsed = time.perf_counter() - start
+    app.logger.info(
+        "modelo cargado en %.2f s (modo %s, mlock %s)", elapsed, MODEL_MODE, MODEL_MLOCK
+    )
+    return elapsed
+
+
+def warm_up(prompts: dict[str, str]) -> dict[str, dict[str, float]]:
+    # Una generación corta por prompt: lee los pesos desde el mmap y deja el
+    # prefijo KV de cada rol listo para su primer turno.
+    timings: dict[str, dict[str, float]] = {}
+    for role, prompt in prompts.items():
+        messages = [
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": "hola"},
+        ]
+        start = time.perf_counter()
+        first_token = None
+        for item in stream(messages, role, WARMUP_MAX_TOKENS):
+            if first_token is None and not isinstance(item, dict):
+                first_token = time.perf_counter() - start
+        total = time.perf_counter() - start
+        if first_token is None:
+            first_token = total
+        timings[role] = {
+            "first_token_ms": round(1000 * first_token, 1),
+            "total_ms": round(1000 * total, 1),
+        }
+        app.logger.info(
+            "calentamiento %s: primer token en %.0f ms, total %.0f ms",
+            role,
+            1000 * first_token,
+            1000 * total,
+        )
+    return timings
+
+
+def start_model() -> None:
+    # Solo calienta un prompt genérico: los prompts de cada rol viven en la
+    # base del backend (editables desde /admin) y es el backend quien los
+    # manda a /warmup al arrancar con MODEL_EAGER_LOAD=1.
+    with _READINESS_LOCK:
+        _READINESS["status"] = "cargando"
+    try:
+        load_seconds = load_model()
+        timings = warm_up({"warmup": WARMUP_PROMPT})
+    except Exception as exc:
+        app.logger.exception("no se pudo cargar el modelo")
+        with _READINESS_LOCK:
+            _READINESS.update(status="error", error=str(exc))
+        return
+    with _READINESS_LOCK:
+        _READINESS.update(status="listo", load_seconds=round(load_seconds, 2))
+        _READINESS.setdefault("warmup", {}).update(timings)
 
 
 @app.get("/health")
+@app.get("/health/live")
 def health() -> dict[str, str]:
     return {"status": "ok"}
 
 
-@app.post("/chat")
-def chat() -> dict[str, str]:
+@app.get("/health/ready")
+def health_ready() -> Any:
+    # Sin carga anticipada el modelo se carga en la primera petición, como
+    # antes, y el servicio se da por listo salvo que la carga haya fallado.
+    with _READINESS_LOCK:
+        state = dict(_READINESS)
+    ready = state["status"] == "listo" or (
+        not MODEL_EAGER_LOAD and state["status"] != "error"
+    )
+    return jsonify(state | {"ready": ready}), 200 if ready else 503
+
+
+@app.post("/warmup")
+def warmup() -> Any:
     payload = request.get_json(force=True)
-    system_prompt = payload.get("system", "")
-    context = payload.get("context", {})
-    max_tokens = int(payload.get("max_tokens", 300))
+    prompts = payload.get("prompts")
+    if not isinstance(prompts, dict) or not all(
+        isinstance(prompt, str) for prompt in prompts.values()
+    ):
+        raise BadRequest("prompts debe ser un objeto rol -> prompt")
+    timings = warm_up(prompts)
+    with _READINESS_LOCK:
+        _READINESS.setdefault("warmup", {}).update(timings)
+    return jsonify({"warmup": timings})
+
+
+def decode_model_frame(data: bytes) -> tuple[dict[str, Any], str]:
+    # [u32 largo][cabecera JSON][u32 largo][contexto ya serializado], big-endian.
+    try:
+        (head_len,) = struct.unpack_from(">I", data, 0)
+        header = json.loads(data[4 : 4 + head_len])
+        (body_len,) = struct.unpack_from(">I", data, 4 + head_len)
+        body = data[8 + head_len : 8 + head_len + body_len]
+        if len(body) != body_len:
+            raise ValueError("frame truncado")
+        return header, body.decode("utf-8")
+    except (struct.error, ValueError) as exc:
+        raise BadRequest(f"Frame inválido: {exc}") from exc
+
+
+def parse_chat_request() -> tuple[list[dict[str, str]], str, int, dict[str, Any] | None]:
+    if request.mimetype == MODEL_FRAME_CONTENT_TYPE:
+        # El backend ya serializó el contexto; se pasa tal cual al modelo.
+        payload, user_content = decode_model_frame(request.get_data())
+        role = str(payload.get("role") or "default")
+    else:
+        payload = request.get_json(force=True)
+        context = payload.get("context", {})
+        user_content = json.dumps(context, ensure_ascii=False, separators=(",", ":"))
+        role = str(context.get("role") or "default")
     messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": json.dumps(context, ensure_ascii=False)},
+        {"role": "system", "content": payload.get("system", "")},
+        {"role": "user", "content": user_content},
     ]
-    llm = get_llm()
-    response = llm.create_chat_completion(
-        messages=messages,
-        temperature=0.2,
-        max_tokens=max_tokens,
-    )
-    content = response["choices"][0]["message"]["content"] or ""
-    return {"content": content}
+    max_tokens = int(payload.get("max_tokens", 300))
+    return messages, role, max_tokens, payload.get("schema")
+
+
+def sse_event(data: dict[str, Any], event: str | None = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.post("/chat")
+def chat() -> dict[str, Any]:
+    started = time.perf_counter()
+    messages, role, max_tokens, schema = parse_chat_request()
+    STAGE_SECONDS.observe(time.perf_counter() - started, "parse_request", role)
+    result = complete(messages, role, max_tokens, schema)
+    observe_usage(role, result.get("usage") or {})
+    REQUEST_SECONDS.observe(time.perf_counter() - started, "/chat", role)
+    return result
+
+
+@app.post("/tokenize")
+def tokenize() -> dict[str, Any]:
+    texts = request.get_json(force=True).get("texts", [])
+    tokenizer = get_tokenizer()
+    counts = [
+        len(tokenizer.tokenize(str(text).encode("utf-8"), add_bos=False, special=False))
+        for text in texts
+    ]
+    return {"counts": counts}
+
+
+@app.post("/chat/stream")
+def chat_stream() -> Response:
+    started = time.perf_counter()
+    messages, role, max_tokens, schema = parse_chat_request()
+    STAGE_SECONDS.observe(time.perf_counter() - started, "parse_request", role)
+    items = stream(messages, role, max_tokens, schema)
+
+    def events() -> Iterator[str]:
+        first_token = True
+        # closing: si el cliente se desconecta se cierra también la generación.
+        with closing(items):
+            try:
+                for item in items:
+                    if isinstance(item, dict):
+                        observe_usage(role, item)
+                        REQUEST_SECONDS.observe(
+                            time.perf_counter() - started, "/chat/stream", role
+                        )
+                        yield sse_event({"usage": item}, "done")
+                    else:
+                        if first_token:
+                            STAGE_SECONDS.observe(
+                                time.perf_counter() - started, "first_token", role
+                            )
+                            first_token = False
+                        yield sse_event({"delta": item})
+            except Exception as exc:
+                yield sse_event({"error": str(exc)}, "error")
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream")
+
+
+@app.get("/metrics")
+def metrics() -> Response:
+    lines: list[str] = []
+    for family in METRIC_FAMILIES:
+        lines += family.render()
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+def serves_requests() -> bool:
+    # Con `python model_api.py` (debug) el proceso que sirve es el hijo del
+    # recargador; el padre solo vigila archivos. Los workers del modo pool
+    # importan este módulo sin servir (spawn les pone su nombre antes de
+    # importarlo). Con gunicorn o `flask run` se importa una vez por proceso
+    # que sirve.
+    if multiprocessing.current_process().name != "MainProcess":
+        return False
+    return __name__ != "__main__" or is_running_from_reloader()
+
+
+# Al importar, y no solo bajo __main__: así carga igual con cualquier servidor.
+if MODEL_EAGER_LOAD and serves_requests():
+    threading.Thread(target=start_model, name="model-warmup", daemon=True).start()
 
 
 if __name__ == "__main__":
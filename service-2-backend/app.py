@@ -1,16 +1,56 @@
 from __future__ import annotations
 
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass
 from datetime import date, datetime, timedelta, timezone
+from functools import wraps
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable, Iterator
 from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
+import atexit
+import click
+import copy
+import hashlib
 import json
+import llama_cpp
+import mmap
+import numpy as np
 import os
+import re
 import sqlite3
+import struct
+import threading
+import time
+import unicodedata
 import requests
-from flask import Flask, g, jsonify, redirect, render_template, request, url_for
-from llama_cpp import Llama
+from flask import (
+    Flask,
+    Response,
+    g,
+    jsonify,
+    make_response,
+    redirect,
+    render_template,
+    request,
+    stream_with_context,
+    url_for,
+)
+from llama_cpp import Llama, LlamaGrammar, LlamaState
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from werkzeug.serving import is_running_from_reloader
+
+from metrics import (
+    STAGE_SECONDS_BUCKETS,
+    TOKEN_COUNT_BUCKETS,
+    TOKENS_PER_SECOND_BUCKETS,
+    Histogram,
+    HistogramFamily,
+    prometheus_labels,
+    render_histogram,
+)
 
 BASE_DIR = Path(__file__).resolve().parent
 INSTANCE_DIR = BASE_DIR / "instance"
@@ -44,6 +84,128 @@ N_THREADS = int(os.getenv("N_THREADS", "1"))
 DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "America/Lima")
 DAILY_CHECKIN_HOUR = int(os.getenv("DAILY_CHECKIN_HOUR", "8"))
 MODEL_API_URL = os.getenv("MODEL_API_URL")
+MODEL_API_POOL_SIZE = int(os.getenv("MODEL_API_POOL_SIZE", "8"))
+MODEL_API_RETRIES = int(os.getenv("MODEL_API_RETRIES", "2"))
+MODEL_API_BACKOFF = float(os.getenv("MODEL_API_BACKOFF", "0.5"))
+# json: payload JSON clásico; frame: cabecera JSON y contexto ya serializado,
+# cada uno precedido por su longitud (ver encode_model_frame).
+MODEL_API_WIRE = os.getenv("MODEL_API_WIRE", "json")
+MODEL_FRAME_CONTENT_TYPE = "application/x-mml-frame"
+PREFIX_CACHE_ENABLED = os.getenv("PREFIX_CACHE_ENABLED", "1") == "1"
+# Al arrancar: carga y calienta el modelo local por rol, o espera a que
+# MODEL_API_URL esté listo y le pide calentar los prompts de cada rol.
+# /health/ready responde 503 hasta terminar.
+MODEL_EAGER_LOAD = os.getenv("MODEL_EAGER_LOAD", "0") == "1"
+MODEL_MLOCK = os.getenv("MODEL_MLOCK", "0") == "1"
+WARMUP_MAX_TOKENS = int(os.getenv("WARMUP_MAX_TOKENS", "8"))
+MODEL_API_READY_TIMEOUT = int(os.getenv("MODEL_API_READY_TIMEOUT", "600"))
+# Estado KV de llama.cpp por productor (solo con el modelo local): memoria
+# para los más recientes y archivos en disco para los que no caben.
+SESSION_CACHE_ENABLED = os.getenv("SESSION_CACHE_ENABLED", "0") == "1"
+SESSION_CACHE_MAX_MB = int(os.getenv("SESSION_CACHE_MAX_MB", "512"))
+SESSION_CACHE_DISK_MB = int(os.getenv("SESSION_CACHE_DISK_MB", "4096"))
+SESSION_CACHE_DIR = Path(
+    os.getenv("SESSION_CACHE_DIR", str(INSTANCE_DIR / "llama_sessions"))
+)
+GRAMMAR_ENABLED = os.getenv("GRAMMAR_ENABLED", "1") == "1"
+RESPONSE_CACHE_ROLES = {
+    role.strip()
+    for role in os.getenv("RESPONSE_CACHE_ROLES", "consulta").split(",")
+    if role.strip()
+}
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "512"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "20000"))
+SQLITE_WAL_AUTOCHECKPOINT = int(os.getenv("SQLITE_WAL_AUTOCHECKPOINT", "1000"))
+AGENT_WORKERS = int(os.getenv("AGENT_WORKERS", "2"))
+AGENT_JOB_MAX_ATTEMPTS = int(os.getenv("AGENT_JOB_MAX_ATTEMPTS", "3"))
+AGENT_JOB_BACKOFF = float(os.getenv("AGENT_JOB_BACKOFF", "2.0"))
+AGENT_JOB_LEASE_SECONDS = int(os.getenv("AGENT_JOB_LEASE_SECONDS", "600"))
+AGENT_JOB_POLL_SECONDS = float(os.getenv("AGENT_JOB_POLL_SECONDS", "1.0"))
+# Outbox de alertas: cada consumidor reclama un lote con lease; lo no
+# confirmado al vencer el lease se vuelve a entregar, hasta
+# ALERT_MAX_DELIVERIES entregas.
+ALERT_CLAIM_MAX = int(os.getenv("ALERT_CLAIM_MAX", "100"))
+ALERT_LEASE_SECONDS = int(os.getenv("ALERT_LEASE_SECONDS", "60"))
+ALERT_MAX_DELIVERIES = int(os.getenv("ALERT_MAX_DELIVERIES", "5"))
+# Ventana de silencio para juntar mensajes seguidos de un productor en un
+# solo turno (0 = sin agrupar), y espera máxima desde el primero.
+AGENT_COALESCE_MS = int(os.getenv("AGENT_COALESCE_MS", "3000"))
+AGENT_COALESCE_MAX_MS = int(os.getenv("AGENT_COALESCE_MAX_MS", "10000"))
+# Lo mismo delante de /agent y /agent/stream, en memoria del proceso: la
+# primera petición espera la ventana y responde por todas.
+AGENT_SYNC_COALESCE_MS = int(os.getenv("AGENT_SYNC_COALESCE_MS", str(AGENT_COALESCE_MS)))
+# /push/stream: sin novedades envía un comentario cada PUSH_HEARTBEAT_SECONDS
+# y vuelve a consultar (cubre escrituras de otros procesos).
+PUSH_HEARTBEAT_SECONDS = float(os.getenv("PUSH_HEARTBEAT_SECONDS", "15"))
+PUSH_BATCH = int(os.getenv("PUSH_BATCH", "100"))
+# Idempotencia de /agent, /agent/stream e /ingest por id del mensaje de
+# WhatsApp: el resultado se guarda IDEMPOTENCY_TTL_SECONDS (WhatsApp reintenta
+# webhooks hasta 7 días). Una clave en proceso sin terminar se libera tras
+# IDEMPOTENCY_LEASE_SECONDS, por si se cayó el proceso que la tomó.
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "604800"))
+IDEMPOTENCY_LEASE_SECONDS = int(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "600"))
+IDEMPOTENCY_PURGE_SECONDS = int(os.getenv("IDEMPOTENCY_PURGE_SECONDS", "3600"))
+# Llamadas al modelo en curso a la vez: 1 con el Llama local; más si
+# MODEL_API_URL apunta a un model_api en modo batch o pool.
+MODEL_SLOTS = int(os.getenv("MODEL_SLOTS", "1"))
+MODEL_QUEUE_MAX_DEPTH = int(os.getenv("MODEL_QUEUE_MAX_DEPTH", "16"))
+MODEL_QUEUE_DEADLINE_MS = int(os.getenv("MODEL_QUEUE_DEADLINE_MS", "120000"))
+# Límite por productor (token bucket): RATE_LIMIT_BURST turnos seguidos y
+# después RATE_LIMIT_PER_MINUTE por minuto; pasado el límite responde
+# RATE_LIMIT_REPLY sin llamar al modelo. RATE_LIMIT_MAX_INFLIGHT acota los
+# turnos esperando o usando el modelo a la vez (0 = sin tope). Con
+# RATE_LIMIT_BACKEND=sqlite el estado se comparte entre procesos.
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "20"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "10"))
+RATE_LIMIT_MAX_INFLIGHT = int(os.getenv("RATE_LIMIT_MAX_INFLIGHT", "32"))
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_REPLY = os.getenv(
+    "RATE_LIMIT_REPLY",
+    "Recibí muchos mensajes seguidos. Dame un momento y escríbeme de nuevo en un minuto.",
+)
+RATE_LIMIT_BUSY_REPLY = os.getenv(
+    "RATE_LIMIT_BUSY_REPLY",
+    "Estoy atendiendo a muchos productores a la vez. Escríbeme de nuevo en unos minutos.",
+)
+COMPACT_CONTEXT_ENABLED = os.getenv("COMPACT_CONTEXT_ENABLED", "1") == "1"
+CONTEXT_BUDGET_ENABLED = os.getenv("CONTEXT_BUDGET_ENABLED", "1") == "1"
+# Tokens máximos del mensaje de usuario (0 = N_CTX menos prompt de sistema,
+# max_tokens de la respuesta y CONTEXT_TOKEN_MARGIN).
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "0"))
+CONTEXT_TOKEN_MARGIN = int(os.getenv("CONTEXT_TOKEN_MARGIN", "64"))
+TOKEN_COUNT_CACHE_SIZE = int(os.getenv("TOKEN_COUNT_CACHE_SIZE", "4096"))
+# Resumen de chat fuera de línea: mensajes que quedan crudos en el contexto,
+# mínimo de mensajes viejos para llamar al modelo, mensajes por llamada y
+# horas locales (DEFAULT_TIMEZONE) en que corre sin --force.
+CHAT_SUMMARY_KEEP = int(os.getenv("CHAT_SUMMARY_KEEP", "6"))
+CHAT_SUMMARY_MIN_MESSAGES = int(os.getenv("CHAT_SUMMARY_MIN_MESSAGES", "12"))
+CHAT_SUMMARY_BATCH = int(os.getenv("CHAT_SUMMARY_BATCH", "40"))
+CHAT_SUMMARY_MAX_TOKENS = int(os.getenv("CHAT_SUMMARY_MAX_TOKENS", "160"))
+CHAT_SUMMARY_HOURS = os.getenv("CHAT_SUMMARY_HOURS", "0-5")
+MODEL_ROLE_WEIGHTS = {
+    role.strip(): float(weight)
+    for role, weight in (
+        item.split("=", 1)
+        for item in os.getenv(
+            "MODEL_ROLE_WEIGHTS", "formulario=4,consulta=4,intervencion=1"
+        ).split(",")
+        if "=" in item
+    )
+}
+
+CHAT_SUMMARY_PROMPT = (
+    "Resume la conversación entre un productor y el asistente agrónomo en cinco "
+    "líneas como máximo. Conserva cultivos, síntomas, fechas, recomendaciones "
+    "dadas y pendientes. Si hay un resumen anterior, intégralo. "
+    "Devuelve solo el texto del resumen."
+)
 
 PROMPTS = {
     "formulario": (
@@ -70,20 +232,731 @@ PROMPTS = {
 }
 
 
+# Acciones que cada rol puede devolver (ver docs/contrato-mml.md).
+ROLE_ACTIONS = {
+    "formulario": (
+        "actualizar_formulario",
+        "alerta",
+        "log",
+        "bitacora",
+        "actualizar_tarea",
+    ),
+    "consulta": ("actualizar_formulario", "alerta", "log"),
+    "intervencion": ("actualizar_formulario", "alerta", "log"),
+}
+
+NULLABLE_STRING = {"anyOf": [{"type": "string"}, {"type": "null"}]}
+NULLABLE_INTEGER = {"anyOf": [{"type": "integer"}, {"type": "null"}]}
+
+ACTION_SCHEMAS: dict[str, dict[str, Any]] = {
+    "actualizar_formulario": {
+        "type": "object",
+        "properties": {
+            "cultivo": NULLABLE_STRING,
+            "sintoma": NULLABLE_STRING,
+            "inicio_problema": NULLABLE_STRING,
+            "foto_recibida": {"type": "boolean"},
+        },
+        "additionalProperties": False,
+    },
+    "alerta": {
+        "anyOf": [
+            {"type": "null"},
+            {
+                "type": "object",
+                "properties": {
+                    "nivel": {"enum": ["bajo", "medio", "alto"]},
+                    "motivo": {"type": "string"},
+                    "accion_recomendada": {"type": "string"},
+                },
+                "required": ["nivel", "motivo", "accion_recomendada"],
+                "additionalProperties": False,
+            },
+        ]
+    },
+    "log": NULLABLE_STRING,
+    "bitacora": {
+        "anyOf": [
+            {"type": "null"},
+            {
+                "type": "object",
+                "properties": {
+                    "fecha": NULLABLE_STRING,
+                    "notas": {"type": "string"},
+                    "metricas": {"type": "object"},
+                    "log_type_id": NULLABLE_INTEGER,
+                },
+                "required": ["fecha", "notas", "metricas"],
+                "additionalProperties": False,
+            },
+        ]
+    },
+    "actualizar_tarea": {
+        "anyOf": [
+            {"type": "null"},
+            {
+                "type": "object",
+                "properties": {
+                    "task_id": {"type": "integer"},
+                    "status": {
+                        "enum": ["PENDIENTE", "EN_PROGRESO", "BLOQUEADO", "COMPLETADO"]
+                    },
+                    "avance": NULLABLE_INTEGER,
+                    "motivo": NULLABLE_STRING,
+                },
+                "required": ["task_id", "status"],
+                "additionalProperties": False,
+            },
+        ]
+    },
+}
+
+
+def mml_output_schema(role: str) -> dict[str, Any]:
+    actions = ROLE_ACTIONS[role]
+    return {
+        "type": "object",
+        "properties": {
+            "role": {"enum": [role]},
+            "respuesta_chat": {"type": "string"},
+            "acciones": {
+                "type": "object",
+                "properties": {name: ACTION_SCHEMAS[name] for name in actions},
+                "required": list(actions),
+                "additionalProperties": False,
+            },
+            "estado": {
+                "type": "object",
+                "properties": {
+                    "formulario_completo": {"type": "boolean"},
+                    "confianza": {"type": "number"},
+                },
+                "required": ["formulario_completo", "confianza"],
+                "additionalProperties": False,
+            },
+        },
+        "required": ["role", "respuesta_chat", "acciones", "estado"],
+        "additionalProperties": False,
+    }
+
+
+# Campos del contexto que determinan la respuesta de cada rol. recent_chat no
+# entra en la clave: incluye el propio mensaje y casi nunca se repite.
+RESPONSE_CACHE_FIELDS = {
+    "formulario": ("producer", "form_state", "active_task"),
+    "consulta": ("producer", "weekly_summary"),
+    "intervencion": ("producer", "weekly_summary", "daily_logs"),
+}
+# Datos del productor que entran en la clave. consulta responde igual a
+# productores con el mismo perfil y resumen, así que no lleva el id.
+PRODUCER_PROFILE_FIELDS = {
+    "formulario": ("id", "zone", "preferred_language", "main_crops"),
+    "consulta": ("zone", "preferred_language", "main_crops"),
+    "intervencion": ("id", "zone", "preferred_language", "main_crops"),
+}
+SIDE_EFFECT_ACTIONS = ("alerta", "bitacora", "actualizar_tarea")
+
+
+class ResponseCache:
+    # LRU con TTL. Cada entrada guarda la versión del formulario y del plan
+    # activo con que se generó; si cambiaron, la entrada se descarta aunque
+    # la clave coincida.
+
+    def __init__(self, max_entries: int, ttl_seconds: int) -> None:
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries: OrderedDict[str, tuple[float, tuple, dict[str, Any], float]] = (
+            OrderedDict()
+        )
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.saved_seconds = 0.0
+
+    def get(self, key: str, version: tuple) -> dict[str, Any] | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            stored_at, stored_version, output, generation_seconds = entry
+            if time.monotonic() - stored_at > self.ttl_seconds or stored_version != version:
+                del self.entries[key]
+                self.stale += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.saved_seconds += generation_seconds
+            return copy.deepcopy(output)
+
+    def put(
+        self, key: str, version: tuple, output: dict[str, Any], generation_seconds: float
+    ) -> None:
+        with self.lock:
+            self.entries[key] = (
+                time.monotonic(),
+                version,
+                copy.deepcopy(output),
+                generation_seconds,
+            )
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear_role(self, role: str) -> int:
+        # Las claves empiezan por "rol:"; ver response_cache_key.
+        with self.lock:
+            keys = [key for key in self.entries if key.startswith(f"{role}:")]
+            for key in keys:
+                del self.entries[key]
+            return len(keys)
+
+    def stats(self) -> dict[str, Any]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "saved_seconds": round(self.saved_seconds, 2),
+            }
+
+
+RESPONSE_CACHE = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+
+def normalize_message(text: str) -> str:
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    stripped = "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return " ".join(re.sub(r"[^\w\s]", " ", stripped).split())
+
+
+def response_cache_key(role: str, context: dict[str, Any]) -> str | None:
+    if role not in RESPONSE_CACHE_ROLES:
+        return None
+    fields: dict[str, Any] = {}
+    for name in RESPONSE_CACHE_FIELDS[role]:
+        value = context.get(name)
+        if name == "producer" and value:
+            value = {key: value.get(key) for key in PRODUCER_PROFILE_FIELDS[role]}
+        fields[name] = value
+    digest = hashlib.sha1(
+        json.dumps(fields, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    ).hexdigest()
+    return f"{role}:{normalize_message(context['last_user_message'])}:{digest}"
+
+
+def response_cache_version(role: str, context: dict[str, Any]) -> tuple:
+    # Formulario y plan son del productor: sin él en la clave no versionan.
+    if "id" not in PRODUCER_PROFILE_FIELDS[role]:
+        return ()
+    form = context.get("form_state") or {}
+    plan = context.get("active_plan") or {}
+    return (form.get("id"), form.get("updated_at"), plan.get("assignment_id"))
+
+
+def is_cacheable_output(model_output: dict[str, Any]) -> bool:
+    # Solo respuestas sin efectos: repetir una alerta o una bitácora desde la
+    # cache duplicaría registros.
+    actions = model_output.get("acciones") or {}
+    if actions.get("actualizar_formulario"):
+        return False
+    return not any(actions.get(name) for name in SIDE_EFFECT_ACTIONS)
+
+
+WAIT_SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+QUEUE_LENGTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64)
+
+
+AGENT_REQUEST_SECONDS = HistogramFamily(
+    "agent_request_seconds",
+    "Duración total del turno por ruta (/agent, /agent/stream, job) y rol.",
+    ("route", "role"),
+    STAGE_SECONDS_BUCKETS,
+)
+AGENT_STAGE_SECONDS = HistogramFamily(
+    "agent_stage_seconds",
+    "Duración de cada etapa del turno: snapshot, build_context, fit_context, "
+    "serialize, model, prompt_eval, generation, parse, apply_actions.",
+    ("stage", "role"),
+    STAGE_SECONDS_BUCKETS,
+)
+AGENT_MODEL_TOKENS = HistogramFamily(
+    "agent_model_tokens",
+    "Tokens por llamada al modelo: prompt, prompt_eval (evaluados sin cache) y completion.",
+    ("role", "kind"),
+    TOKEN_COUNT_BUCKETS,
+)
+AGENT_TOKENS_PER_SECOND = HistogramFamily(
+    "agent_model_tokens_per_second",
+    "Velocidad de llama.cpp en evaluación del prompt y en generación.",
+    ("role", "phase"),
+    TOKENS_PER_SECOND_BUCKETS,
+)
+METRIC_FAMILIES = [
+    AGENT_REQUEST_SECONDS,
+    AGENT_STAGE_SECONDS,
+    AGENT_MODEL_TOKENS,
+    AGENT_TOKENS_PER_SECOND,
+]
+
+
+def llama_perf(llm: Llama) -> tuple[float, float, int, int] | None:
+    # Contadores acumulados del contexto de llama.cpp: ms y tokens de
+    # evaluación del prompt y de generación. None si la versión no los expone.
+    try:
+        data = llama_cpp.llama_perf_context(llm.ctx)
+    except AttributeError:
+        return None
+    return data.t_p_eval_ms, data.t_eval_ms, data.n_p_eval, data.n_eval
+
+
+def perf_usage(
+    before: tuple[float, float, int, int] | None, after: tuple[float, float, int, int] | None
+) -> dict[str, float]:
+    if before is None or after is None:
+        return {}
+    return {
+        "prompt_eval_ms": after[0] - before[0],
+        "eval_ms": after[1] - before[1],
+        "prompt_eval_tokens": after[2] - before[2],
+        "eval_tokens": after[3] - before[3],
+    }
+
+
+def observe_model_usage(role: str, usage: dict[str, Any]) -> None:
+    # usage: el de llama.cpp o model_api, más los tiempos de perf_usage.
+    for kind in ("prompt", "prompt_eval", "completion"):
+        if usage.get(f"{kind}_tokens"):
+            AGENT_MODEL_TOKENS.observe(usage[f"{kind}_tokens"], role, kind)
+    completion = usage.get("completion_tokens") or usage.get("eval_tokens") or 0
+    for phase, elapsed_ms, tokens in (
+        ("prompt_eval", usage.get("prompt_eval_ms"), usage.get("prompt_eval_tokens") or 0),
+        ("generation", usage.get("eval_ms"), completion),
+    ):
+        if elapsed_ms:
+            AGENT_STAGE_SECONDS.observe(elapsed_ms / 1000, phase, role)
+            if tokens:
+                AGENT_TOKENS_PER_SECOND.observe(1000 * tokens / elapsed_ms, role, phase)
+
+
+class RateLimitedError(Exception):
+    def __init__(self, reason: str, reply: str) -> None:
+        super().__init__(reason)
+        self.reason = reason
+        self.reply = reply
+
+
+class RateLimiter:
+    # Token bucket por productor y tope global de turnos en curso, en
+    # memoria del proceso. Un bucket lleno equivale a no tener entrada, así
+    # que los de productores inactivos se descartan al crecer el dict.
+    MAX_BUCKETS = 4096
+
+    def __init__(self, per_minute: float, burst: float, max_inflight: int) -> None:
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.max_inflight = max_inflight
+        self.lock = threading.Lock()
+        self.buckets: dict[int, tuple[float, float]] = {}
+        self.inflight = 0
+        self.admitted = 0
+        self.limited = 0
+        self.busy = 0
+        self.limited_by_producer: Counter[int] = Counter()
+
+    def _refilled(self, tokens: float, updated: float, now: float) -> float:
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def _take(self, producer_id: int) -> bool:
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(producer_id, (self.burst, now))
+            tokens = self._refilled(tokens, updated, now)
+            if tokens < 1:
+                return False
+            self.buckets[producer_id] = (tokens - 1, now)
+            if len(self.buckets) > self.MAX_BUCKETS:
+                self.buckets = {
+                    key: value
+                    for key, value in self.buckets.items()
+                    if self._refilled(*value, now) < self.burst
+                }
+            return True
+
+    def _acquire(self) -> Any:
+        with self.lock:
+            if self.max_inflight and self.inflight >= self.max_inflight:
+                return None
+            self.inflight += 1
+            return True
+
+    def _release(self, token: Any) -> None:
+        with self.lock:
+            self.inflight -= 1
+
+    def _inflight(self) -> int:
+        return self.inflight
+
+    def _count(self, outcome: str, producer_id: int) -> None:
+        with self.lock:
+            if outcome == "admitted":
+                self.admitted += 1
+            elif outcome == "limited":
+                self.limited += 1
+                self.limited_by_producer[producer_id] += 1
+            else:
+                self.busy += 1
+
+    @contextmanager
+    def admit(self, producer_id: int) -> Iterator[None]:
+        # El tope global va primero: un turno rechazado por carga no gasta
+        # el bucket del productor.
+        if not RATE_LIMIT_ENABLED:
+            yield
+            return
+        token = self._acquire()
+        if token is None:
+            self._count("busy", producer_id)
+            raise RateLimitedError("global", RATE_LIMIT_BUSY_REPLY)
+        try:
+            if not self._take(producer_id):
+                self._count("limited", producer_id)
+                raise RateLimitedError("productor", RATE_LIMIT_REPLY)
+            self._count("admitted", producer_id)
+            yield
+        finally:
+            self._release(token)
+
+    def stats(self) -> dict[str, Any]:
+        inflight = self._inflight()
+        with self.lock:
+            return {
+                "enabled": RATE_LIMIT_ENABLED,
+                "backend": RATE_LIMIT_BACKEND,
+                "per_minute": self.rate * 60,
+                "burst": self.burst,
+                "max_inflight": self.max_inflight,
+                "inflight": inflight,
+                "admitted": self.admitted,
+                "limited": self.limited,
+                "busy": self.busy,
+                "top_limited": [
+                    {"producer_id": producer_id, "limited": count}
+                    for producer_id, count in self.limited_by_producer.most_common(5)
+                ],
+            }
+
+
+class SQLiteRateLimiter(RateLimiter):
+    # Mismo límite con el estado en la base, para varios workers (gunicorn).
+    # Los contadores de stats siguen siendo del proceso. Un turno en curso
+    # de un worker caído deja de contar tras AGENT_JOB_LEASE_SECONDS.
+    def _take(self, producer_id: int) -> bool:
+        with write_transaction() as db:
+            row = db.execute(
+                """
+                INSERT INTO rate_limit_buckets (producer_id, tokens, updated_at)
+                VALUES (:producer_id, :burst - 1, :now)
+                ON CONFLICT (producer_id) DO UPDATE SET
+                    tokens = MIN(:burst, tokens + (:now - updated_at) * :rate) - 1,
+                    updated_at = :now
+                WHERE MIN(:burst, tokens + (:now - updated_at) * :rate) >= 1
+                RETURNING tokens
+                """,
+                {
+                    "producer_id": producer_id,
+                    "burst": self.burst,
+                    "rate": self.rate,
+                    "now": time.time(),
+                },
+            ).fetchone()
+        return row is not None
+
+    def _acquire(self) -> Any:
+        now = time.time()
+        with write_transaction() as db:
+            db.execute("DELETE FROM rate_limit_inflight WHERE expires_at < ?", (now,))
+            row = db.execute(
+                """
+                INSERT INTO rate_limit_inflight (expires_at)
+                SELECT :expires_at
+                WHERE :max_inflight = 0
+                   OR (SELECT COUNT(*) FROM rate_limit_inflight) < :max_inflight
+                RETURNING id
+                """,
+                {"expires_at": now + AGENT_JOB_LEASE_SECONDS, "max_inflight": self.max_inflight},
+            ).fetchone()
+        return row["id"] if row else None
+
+    def _release(self, token: Any) -> None:
+        with write_transaction() as db:
+            db.execute("DELETE FROM rate_limit_inflight WHERE id = ?", (token,))
+
+    def _inflight(self) -> int:
+        return get_db().execute("SELECT COUNT(*) FROM rate_limit_inflight").fetchone()[0]
+
+
+RATE_LIMITER = (SQLiteRateLimiter if RATE_LIMIT_BACKEND == "sqlite" else RateLimiter)(
+    RATE_LIMIT_PER_MINUTE, RATE_LIMIT_BURST, RATE_LIMIT_MAX_INFLIGHT
+)
+
+
+def rate_limited_output(role: str, exc: RateLimitedError) -> dict[str, Any]:
+    # Respuesta fija con la forma del contrato y sin acciones.
+    return {
+        "role": role,
+        "respuesta_chat": exc.reply,
+        "acciones": {"actualizar_formulario": {}, "alerta": None, "log": None},
+        "estado": {"formulario_completo": False, "confianza": 0.0},
+        "rate_limited": exc.reason,
+    }
+
+
+class ModelQueueError(Exception):
+    def __init__(self, message: str, status: int) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class ModelScheduler:
+    # Una cola FIFO por rol delante del modelo. Cuando se libera un slot pasa
+    # la cabeza del rol con menor "pass": cada despacho suma 1/peso, así un
+    # rol con peso 4 recibe cuatro turnos por cada uno de un rol con peso 1
+    # mientras ambos tengan cola (stride scheduling).
+    def __init__(self, slots: int, max_depth: int, weights: dict[str, float]) -> None:
+        self.slots = max(1, slots)
+        self.max_depth = max_depth
+        self.weights = weights
+        self.cond = threading.Condition()
+        self.running = 0
+        self.vtime = 0.0
+        self.queues: dict[str, deque] = {role: deque() for role in weights}
+        self.passes = {role: 0.0 for role in weights}
+        self.dispatched = {role: 0 for role in weights}
+        self.shed = {role: 0 for role in weights}
+        self.expired = {role: 0 for role in weights}
+        self.wait_seconds = {role: Histogram(WAIT_SECONDS_BUCKETS) for role in weights}
+        self.queue_length = {role: Histogram(QUEUE_LENGTH_BUCKETS) for role in weights}
+
+    def _next_role(self) -> str | None:
+        waiting = [role for role, queue in self.queues.items() if queue]
+        if not waiting:
+            return None
+        return min(waiting, key=lambda role: (self.passes[role], -self.weights[role]))
+
+    def _add_role(self, role: str) -> None:
+        # Rol sin peso configurado (p. ej. agregado desde el panel).
+        self.weights[role] = 1.0
+        self.queues[role] = deque()
+        self.passes[role] = self.vtime
+        for counters in (self.dispatched, self.shed, self.expired):
+            counters[role] = 0
+        self.wait_seconds[role] = Histogram(WAIT_SECONDS_BUCKETS)
+        self.queue_length[role] = Histogram(QUEUE_LENGTH_BUCKETS)
+
+    def acquire(self, role: str, deadline: float | None) -> None:
+        ticket = object()
+        enqueued = time.monotonic()
+        with self.cond:
+            if role not in self.queues:
+                self._add_role(role)
+            queue = self.queues[role]
+            self.queue_length[role].observe(len(queue))
+            if len(queue) >= self.max_depth:
+                self.shed[role] += 1
+                raise ModelQueueError(f"cola del modelo llena para {role}", 429)
+            if not queue:
+                # Un rol que estuvo inactivo no acumula crédito atrasado.
+                self.passes[role] = max(self.passes[role], self.vtime)
+            queue.append(ticket)
+            while not (
+                self.running < self.slots
+                and queue[0] is ticket
+                and self._next_role() == role
+            ):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    # Quien llamó ya dejó de esperar: no tiene sentido generar.
+                    queue.remove(ticket)
+                    self.expired[role] += 1
+                    self.cond.notify_all()
+                    raise ModelQueueError("tiempo de espera del modelo agotado", 504)
+                self.cond.wait(remaining)
+            queue.popleft()
+            self.running += 1
+            self.vtime = self.passes[role]
+            self.passes[role] += 1 / self.weights[role]
+            self.dispatched[role] += 1
+        self.wait_seconds[role].observe(time.monotonic() - enqueued)
+
+    def release(self) -> None:
+        with self.cond:
+            self.running -= 1
+            self.cond.notify_all()
+
+    @contextmanager
+    def slot(self, role: str, deadline: float | None = None) -> Iterator[None]:
+        self.acquire(role, deadline)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict[str, Any]:
+        with self.cond:
+            roles = {
+                role: {
+                    "weight": self.weights[role],
+                    "queued": len(queue),
+                    "dispatched": self.dispatched[role],
+                    "shed": self.shed[role],
+                    "expired": self.expired[role],
+                }
+                for role, queue in self.queues.items()
+            }
+            running = self.running
+        for role, data in roles.items():
+            data["wait_seconds"] = self.wait_seconds[role].stats()
+            data["queue_length"] = self.queue_length[role].stats()
+        return {"slots": self.slots, "running": running, "roles": roles}
+
+
+MODEL_SCHEDULER = ModelScheduler(MODEL_SLOTS, MODEL_QUEUE_MAX_DEPTH, MODEL_ROLE_WEIGHTS)
+
+
+def request_deadline() -> float | None:
+    # X-Deadline-Ms: cuánto más esperará el cliente, en ms. Sin cabecera se
+    # usa MODEL_QUEUE_DEADLINE_MS (0 = sin límite).
+    raw = request.headers.get("X-Deadline-Ms")
+    budget_ms = int(raw) if raw and raw.isdigit() else MODEL_QUEUE_DEADLINE_MS
+    if budget_ms <= 0:
+        return None
+    return time.monotonic() + budget_ms / 1000
+
+
 def utc_now() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
+def open_db(path: str) -> sqlite3.Connection:
+    db = sqlite3.connect(
+        path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000, check_same_thread=False
+    )
+    db.row_factory = sqlite3.Row
+    # journal_mode queda guardado en el archivo; el resto vale por conexión.
+    db.execute(f"PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}")
+    db.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+    db.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+    db.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    db.execute(f"PRAGMA cache_size = -{SQLITE_CACHE_SIZE_KB}")
+    db.execute(f"PRAGMA wal_autocheckpoint = {SQLITE_WAL_AUTOCHECKPOINT}")
+    return db
+
+
+class ConnectionPool:
+    # Conexiones abiertas que se prestan a un hilo por request y vuelven al
+    # terminar; el servidor de desarrollo crea un hilo por request, así que
+    # una cache por hilo no llegaría a reutilizarse.
+    def __init__(self, path: str, size: int) -> None:
+        self.path = path
+        self.size = size
+        self.idle: list[sqlite3.Connection] = []
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+
+    def acquire(self) -> sqlite3.Connection:
+        with self.lock:
+            if self.idle:
+                self.reused += 1
+                return self.idle.pop()
+            self.opened += 1
+        return open_db(self.path)
+
+    def release(self, db: sqlite3.Connection) -> None:
+        if db.in_transaction:
+            db.rollback()
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(db)
+                return
+        db.close()
+
+    def stats(self) -> dict[str, Any]:
+        with self.lock:
+            return {
+                "size": self.size,
+                "idle": len(self.idle),
+                "opened": self.opened,
+                "reused": self.reused,
+                "journal_mode": SQLITE_JOURNAL_MODE.lower(),
+            }
+
+    def close(self) -> None:
+        with self.lock:
+            idle, self.idle = self.idle, []
+        if idle and SQLITE_JOURNAL_MODE.upper() == "WAL":
+            # Al apagar, vacía el WAL en la base y lo deja en cero bytes.
+            idle[0].execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        for db in idle:
+            db.close()
+
+
+_DB_POOL: ConnectionPool | None = None
+_DB_POOL_LOCK = threading.Lock()
+
+
+def get_db_pool() -> ConnectionPool:
+    global _DB_POOL
+    path = app.config["DATABASE"]
+    with _DB_POOL_LOCK:
+        if _DB_POOL is None or _DB_POOL.path != path:
+            if _DB_POOL is not None:
+                _DB_POOL.close()
+            _DB_POOL = ConnectionPool(path, DB_POOL_SIZE)
+        return _DB_POOL
+
+
+def close_db_pool() -> None:
+    global _DB_POOL
+    with _DB_POOL_LOCK:
+        if _DB_POOL is not None:
+            _DB_POOL.close()
+            _DB_POOL = None
+
+
+atexit.register(close_db_pool)
+
+
 def get_db() -> sqlite3.Connection:
     if "db" not in g:
-        g.db = sqlite3.connect(app.config["DATABASE"])
-        g.db.row_factory = sqlite3.Row
+        g.db_pool = get_db_pool()
+        g.db = g.db_pool.acquire()
     return g.db
 
 
+@contextmanager
+def write_transaction() -> Iterator[sqlite3.Connection]:
+    # IMMEDIATE toma el lock de escritura al empezar: si otro turno escribe,
+    # se espera aquí (busy_timeout) y no a mitad de la transacción.
+    db = get_db()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield db
+    except BaseException:
+        db.rollback()
+        raise
+    db.commit()
+
+
 def init_db() -> None:
     INSTANCE_DIR.mkdir(exist_ok=True)
-    db = sqlite3.connect(app.config["DATABASE"])
+    db = open_db(app.config["DATABASE"])
     db.executescript(
         """
         CREATE TABLE IF NOT EXISTS producers (
@@ -218,168 +1091,395 @@ def init_db() -> None:
     db.close()
 
 
-def migrate_db() -> None:
-    db = sqlite3.connect(app.config["DATABASE"])
-    db.row_factory = sqlite3.Row
-    columns = {
-        row["name"] for row in db.execute("PRAGMA table_info(producers)").fetchall()
-    }
-    if "name" not in columns:
-        db.execute("ALTER TABLE producers ADD COLUMN name TEXT")
-    if "allowed" not in columns:
-        db.execute("ALTER TABLE producers ADD COLUMN allowed INTEGER NOT NULL DEFAULT 0")
-    if "status" not in columns:
-        db.execute(
-            "ALTER TABLE producers ADD COLUMN status TEXT NOT NULL DEFAULT 'activo'"
-        )
-    if "timezone" not in columns:
-        db.execute(
-            "ALTER TABLE producers ADD COLUMN timezone TEXT NOT NULL DEFAULT 'America/Lima'"
-        )
-    if "last_checkin_date" not in columns:
-        db.execute("ALTER TABLE producers ADD COLUMN last_checkin_date TEXT")
-    if "assigned_role" not in columns:
-        db.execute("ALTER TABLE producers ADD COLUMN assigned_role TEXT")
-    if "enable_formulario" not in columns:
-        db.execute(
-            "ALTER TABLE producers ADD COLUMN enable_formulario INTEGER NOT NULL DEFAULT 1"
-        )
-    if "enable_consulta" not in columns:
-        db.execute(
-            "ALTER TABLE producers ADD COLUMN enable_consulta INTEGER NOT NULL DEFAULT 1"
-        )
-    if "enable_intervencion" not in columns:
-        db.execute(
-            "ALTER TABLE producers ADD COLUMN enable_intervencion INTEGER NOT NULL DEFAULT 1"
-        )
-
-    alert_columns = {
-        row["name"] for row in db.execute("PRAGMA table_info(alerts)").fetchall()
+# Tablas que llegaron después de la primera versión del MVP.
+LEGACY_TABLES_SQL = """
+CREATE TABLE IF NOT EXISTS log_types (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    description TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS plans (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    description TEXT NOT NULL,
+    targets_json TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS producer_plans (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    producer_id INTEGER NOT NULL,
+    plan_id INTEGER NOT NULL,
+    start_date TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    FOREIGN KEY (producer_id) REFERENCES producers (id),
+    FOREIGN KEY (plan_id) REFERENCES plans (id)
+);
+
+CREATE TABLE IF NOT EXISTS daily_logs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    producer_id INTEGER NOT NULL,
+    plan_id INTEGER,
+    log_type_id INTEGER,
+    log_date TEXT NOT NULL,
+    notes TEXT NOT NULL,
+    metrics_json TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    FOREIGN KEY (producer_id) REFERENCES producers (id),
+    FOREIGN KEY (plan_id) REFERENCES plans (id),
+    FOREIGN KEY (log_type_id) REFERENCES log_types (id)
+);
+
+CREATE TABLE IF NOT EXISTS plan_templates (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    crop_type TEXT NOT NULL,
+    tasks_json TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS producer_tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    producer_id INTEGER NOT NULL,
+    template_id INTEGER NOT NULL,
+    task_name TEXT NOT NULL,
+    order_sequence INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    estimated_date TEXT,
+    completion_date TEXT,
+    progress_pct INTEGER,
+    blocker_reason TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    FOREIGN KEY (producer_id) REFERENCES producers (id),
+    FOREIGN KEY (template_id) REFERENCES plan_templates (id)
+);
+"""
+
+
+def add_missing_columns(
+    db: sqlite3.Connection, table: str, columns: dict[str, str]
+) -> None:
+    existing = {
+        row["name"] for row in db.execute(f"PRAGMA table_info({table})").fetchall()
     }
-    if "message" not in alert_columns:
-        db.execute("ALTER TABLE alerts ADD COLUMN message TEXT NOT NULL DEFAULT ''")
-    if "sent_at" not in alert_columns:
-        db.execute("ALTER TABLE alerts ADD COLUMN sent_at TEXT")
+    for name, definition in columns.items():
+        if name not in existing:
+            db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+
+def migration_legacy_schema(db: sqlite3.Connection) -> None:
+    # Lleva bases creadas por versiones anteriores al esquema de init_db().
+    add_missing_columns(
+        db,
+        "producers",
+        {
+            "name": "TEXT",
+            "allowed": "INTEGER NOT NULL DEFAULT 0",
+            "status": "TEXT NOT NULL DEFAULT 'activo'",
+            "timezone": "TEXT NOT NULL DEFAULT 'America/Lima'",
+            "last_checkin_date": "TEXT",
+            "assigned_role": "TEXT",
+            "enable_formulario": "INTEGER NOT NULL DEFAULT 1",
+            "enable_consulta": "INTEGER NOT NULL DEFAULT 1",
+            "enable_intervencion": "INTEGER NOT NULL DEFAULT 1",
+        },
+    )
+    add_missing_columns(
+        db, "alerts", {"message": "TEXT NOT NULL DEFAULT ''", "sent_at": "TEXT"}
+    )
+    add_missing_columns(
+        db, "messages", {"status": "TEXT NOT NULL DEFAULT 'entregado'"}
+    )
+    for statement in LEGACY_TABLES_SQL.split(";"):
+        if statement.strip():
+            db.execute(statement)
+    add_missing_columns(db, "daily_logs", {"log_type_id": "INTEGER"})
 
-    message_columns = {
-        row["name"] for row in db.execute("PRAGMA table_info(messages)").fetchall()
-    }
-    if "status" not in message_columns:
-        db.execute(
-            "ALTER TABLE messages ADD COLUMN status TEXT NOT NULL DEFAULT 'entregado'"
-        )
-    daily_log_columns = {
-        row["name"] for row in db.execute("PRAGMA table_info(daily_logs)").fetchall()
-    }
-    if "log_type_id" not in daily_log_columns:
-        db.execute("ALTER TABLE daily_logs ADD COLUMN log_type_id INTEGER")
 
-    db.executescript(
+def migration_hot_path_indexes(db: sqlite3.Connection) -> None:
+    # Un índice por consulta del turno y del sondeo de alertas; el orden de
+    # las columnas sigue WHERE y luego ORDER BY (ver check_query_plans.py).
+    db.execute(
         """
-        CREATE TABLE IF NOT EXISTS log_types (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            description TEXT NOT NULL,
-            created_at TEXT NOT NULL
-        );
-
-        CREATE TABLE IF NOT EXISTS plans (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            description TEXT NOT NULL,
-            targets_json TEXT NOT NULL,
-            created_at TEXT NOT NULL
-        );
-
-        CREATE TABLE IF NOT EXISTS producer_plans (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            producer_id INTEGER NOT NULL,
-            plan_id INTEGER NOT NULL,
-            start_date TEXT NOT NULL,
-            status TEXT NOT NULL,
-            created_at TEXT NOT NULL,
-            FOREIGN KEY (producer_id) REFERENCES producers (id),
-            FOREIGN KEY (plan_id) REFERENCES plans (id)
-        );
-
-        CREATE TABLE IF NOT EXISTS daily_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            producer_id INTEGER NOT NULL,
-            plan_id INTEGER,
-            log_type_id INTEGER,
-            log_date TEXT NOT NULL,
-            notes TEXT NOT NULL,
-            metrics_json TEXT NOT NULL,
-            created_at TEXT NOT NULL,
-            FOREIGN KEY (producer_id) REFERENCES producers (id),
-            FOREIGN KEY (plan_id) REFERENCES plans (id),
-            FOREIGN KEY (log_type_id) REFERENCES log_types (id)
-        );
+        CREATE INDEX IF NOT EXISTS idx_messages_producer_created
+        ON messages (producer_id, created_at)
+        """
+    )
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_forms_producer_status_created
+        ON forms (producer_id, status, created_at)
+        """
+    )
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_producer_tasks_producer_status_order
+        ON producer_tasks (producer_id, status, order_sequence)
+        """
+    )
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_daily_logs_producer_date
+        ON daily_logs (producer_id, log_date, created_at)
+        """
+    )
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_producer_plans_producer_status_start
+        ON producer_plans (producer_id, status, start_date)
+        """
+    )
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_alerts_status_sent_created
+        ON alerts (status, sent_at, created_at)
+        """
+    )
 
-        CREATE TABLE IF NOT EXISTS plan_templates (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            crop_type TEXT NOT NULL,
-            tasks_json TEXT NOT NULL,
-            created_at TEXT NOT NULL
-        );
 
-        CREATE TABLE IF NOT EXISTS producer_tasks (
+def migration_agent_jobs(db: sqlite3.Connection) -> None:
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS agent_jobs (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             producer_id INTEGER NOT NULL,
-            template_id INTEGER NOT NULL,
-            task_name TEXT NOT NULL,
-            order_sequence INTEGER NOT NULL,
+            phone TEXT NOT NULL,
+            role TEXT NOT NULL,
+            message TEXT NOT NULL,
             status TEXT NOT NULL,
-            estimated_date TEXT,
-            completion_date TEXT,
-            progress_pct INTEGER,
-            blocker_reason TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            available_at TEXT NOT NULL,
+            locked_at TEXT,
+            last_error TEXT,
+            reply_message_id INTEGER,
             created_at TEXT NOT NULL,
             updated_at TEXT NOT NULL,
-            FOREIGN KEY (producer_id) REFERENCES producers (id),
-            FOREIGN KEY (template_id) REFERENCES plan_templates (id)
-        );
+            FOREIGN KEY (producer_id) REFERENCES producers (id)
+        )
+        """
+    )
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_agent_jobs_status_available
+        ON agent_jobs (status, available_at)
+        """
+    )
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_agent_jobs_producer_status
+        ON agent_jobs (producer_id, status)
+        """
+    )
+    # Respuestas generadas por la cola que el puente todavía no envió.
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_messages_outbox
+        ON messages (created_at)
+        WHERE direction = 'asistente' AND status = 'pendiente'
         """
     )
-
-    db.commit()
-    db.close()
 
 
-def ensure_agent_defaults() -> None:
-    db = get_db()
-    existing = {
-        row["role"] for row in db.execute("SELECT role FROM agent_configs").fetchall()
-    }
-    for role, prompt in PROMPTS.items():
-        if role not in existing:
-            description = f"Agente {role} (configuración inicial)"
-            db.execute(
-                """
-                INSERT INTO agent_configs (role, enabled, description, prompt, max_tokens)
-                VALUES (?, ?, ?, ?, ?)
-                """,
-                (role, 1, description, prompt, 300),
-            )
-    db.commit()
+def migration_agent_job_coalescing(db: sqlite3.Connection) -> None:
+    add_missing_columns(
+        db, "agent_jobs", {"merged_count": "INTEGER NOT NULL DEFAULT 0"}
+    )
 
 
-def get_or_create_producer(phone: str) -> dict[str, Any]:
-    db = get_db()
-    row = db.execute("SELECT * FROM producers WHERE phone = ?", (phone,)).fetchone()
-    if row:
-        return dict(row)
-    now = utc_now()
+def migration_weekly_summary(db: sqlite3.Connection) -> None:
     db.execute(
         """
-        INSERT INTO producers (
-            phone, name, zone, preferred_language, main_crops, allowed, status,
-            timezone, last_checkin_date, assigned_role, enable_formulario,
-            enable_consulta, enable_intervencion, created_at
+        CREATE TABLE IF NOT EXISTS producer_weekly_summary (
+            producer_id INTEGER PRIMARY KEY,
+            days_json TEXT NOT NULL,
+            updated_at TEXT NOT NULL
         )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-        (
+        """
+    )
+
+
+def migration_chat_summaries(db: sqlite3.Connection) -> None:
+    # last_message_id es la marca de agua: el resumen cubre todos los
+    # mensajes del productor hasta ese id.
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            producer_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            last_message_id INTEGER NOT NULL,
+            messages_summarized INTEGER NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            generation_ms INTEGER NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+        """
+    )
+
+
+def migration_alert_leases(db: sqlite3.Connection) -> None:
+    # lease_until = '' significa nunca reclamada: queda antes que cualquier
+    # fecha y el reclamo es un solo rango del índice parcial, que solo lleva
+    # las alertas sin enviar.
+    add_missing_columns(
+        db,
+        "alerts",
+        {
+            "lease_until": "TEXT NOT NULL DEFAULT ''",
+            "claimed_by": "TEXT",
+            "delivery_attempts": "INTEGER NOT NULL DEFAULT 0",
+        },
+    )
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_alerts_outbox
+        ON alerts (lease_until, id)
+        WHERE status = 'abierta' AND sent_at IS NULL
+        """
+    )
+
+
+def migration_inbound_keys(db: sqlite3.Connection) -> None:
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS inbound_keys (
+            key TEXT NOT NULL,
+            route TEXT NOT NULL,
+            status TEXT NOT NULL,
+            response_status INTEGER,
+            response_json TEXT,
+            duplicates INTEGER NOT NULL DEFAULT 0,
+            lease_until TEXT NOT NULL,
+            expires_at TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            PRIMARY KEY (key, route)
+        )
+        """
+    )
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_inbound_keys_expires
+        ON inbound_keys (expires_at)
+        """
+    )
+
+
+def migration_inbound_key_saved(db: sqlite3.Connection) -> None:
+    # Un turno fallido guarda el mensaje y libera la clave; el reintento no
+    # debe guardarlo otra vez.
+    add_missing_columns(db, "inbound_keys", {"message_saved": "INTEGER NOT NULL DEFAULT 0"})
+
+
+def migration_rate_limits(db: sqlite3.Connection) -> None:
+    # Solo se usan con RATE_LIMIT_BACKEND=sqlite; tiempos en segundos epoch.
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+            producer_id INTEGER PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS rate_limit_inflight (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            expires_at REAL NOT NULL
+        )
+        """
+    )
+
+
+# Cada paso corre una sola vez, en su propia transacción, y queda registrado
+# en schema_version. Los pasos nuevos se agregan al final con la versión
+# siguiente; nunca se edita uno ya publicado.
+MIGRATIONS: list[tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "columnas y tablas del MVP", migration_legacy_schema),
+    (2, "índices de consultas frecuentes", migration_hot_path_indexes),
+    (3, "cola de turnos y outbox", migration_agent_jobs),
+    (4, "mensajes agrupados por turno", migration_agent_job_coalescing),
+    (5, "resumen de 7 días por productor", migration_weekly_summary),
+    (6, "resumen de conversaciones largas", migration_chat_summaries),
+    (7, "outbox de alertas con lease", migration_alert_leases),
+    (8, "claves de idempotencia de mensajes entrantes", migration_inbound_keys),
+    (9, "límite de turnos compartido entre procesos", migration_rate_limits),
+    (10, "mensaje ya guardado por clave de idempotencia", migration_inbound_key_saved),
+]
+
+
+def migrate_db() -> None:
+    db = open_db(app.config["DATABASE"])
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        )
+        """
+    )
+    current = db.execute(
+        "SELECT COALESCE(MAX(version), 0) FROM schema_version"
+    ).fetchone()[0]
+    for version, description, step in MIGRATIONS:
+        if version <= current:
+            continue
+        db.execute("BEGIN")
+        try:
+            step(db)
+            db.execute(
+                """
+                INSERT INTO schema_version (version, description, applied_at)
+                VALUES (?, ?, ?)
+                """,
+                (version, description, utc_now()),
+            )
+            db.commit()
+        except Exception:
+            db.rollback()
+            db.close()
+            raise
+    db.close()
+
+
+def ensure_agent_defaults() -> None:
+    db = get_db()
+    existing = {
+        row["role"] for row in db.execute("SELECT role FROM agent_configs").fetchall()
+    }
+    for role, prompt in PROMPTS.items():
+        if role not in existing:
+            description = f"Agente {role} (configuración inicial)"
+            db.execute(
+                """
+                INSERT INTO agent_configs (role, enabled, description, prompt, max_tokens)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (role, 1, description, prompt, 300),
+            )
+    db.commit()
+
+
+def get_or_create_producer(phone: str) -> dict[str, Any]:
+    db = get_db()
+    row = db.execute("SELECT * FROM producers WHERE phone = ?", (phone,)).fetchone()
+    if row:
+        return dict(row)
+    now = utc_now()
+    db.execute(
+        """
+        INSERT INTO producers (
+            phone, name, zone, preferred_language, main_crops, allowed, status,
+            timezone, last_checkin_date, assigned_role, enable_formulario,
+            enable_consulta, enable_intervencion, created_at
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
             phone,
             None,
             None,
@@ -548,6 +1648,7 @@ def update_task_status(
     status: str,
     progress_pct: int | None,
     blocker_reason: str | None,
+    commit: bool = True,
 ) -> None:
     db = get_db()
     task = db.execute(
@@ -569,6 +1670,9 @@ def update_task_status(
         (status, progress_pct, blocker_reason, completion_date, utc_now(), task_id),
     )
 
+    if status == "COMPLETADO" and task.get("status") != "COMPLETADO":
+        record_weekly_event(task["producer_id"], {"tareas_completadas": 1})
+
     if status == "COMPLETADO" and task.get("estimated_date"):
         try:
             estimated = date.fromisoformat(task["estimated_date"])
@@ -596,7 +1700,8 @@ def update_task_status(
                         task["order_sequence"],
                     ),
                 )
-    db.commit()
+    if commit:
+        db.commit()
 
 
 def get_active_plan(producer_id: int) -> dict[str, Any] | None:
@@ -653,6 +1758,7 @@ def save_daily_log(
     log_date: str,
     notes: str,
     metrics: dict[str, Any],
+    commit: bool = True,
 ) -> None:
     db = get_db()
     db.execute(
@@ -676,7 +1782,244 @@ def save_daily_log(
         "UPDATE producers SET last_checkin_date = ? WHERE id = ?",
         (log_date, producer_id),
     )
-    db.commit()
+    record_weekly_event(producer_id, {"bitacoras": 1}, metrics=metrics)
+    if commit:
+        db.commit()
+
+
+# Resumen de 7 días: una fila por productor con un balde por día (UTC) en
+# days_json. Cada escritura suma a su balde; leerlo es una búsqueda por llave
+# y sumar a lo más siete baldes. Los baldes viejos se descartan al escribir y
+# en la compactación nocturna (flask compact-weekly-summary).
+WEEKLY_SUMMARY_DAYS = 7
+WEEKLY_SUMMARY_EMPTY = "7d: sin datos suficientes registrados."
+
+
+def weekly_window() -> tuple[str, str]:
+    today = date.fromisoformat(utc_now()[:10])
+    since = today - timedelta(days=WEEKLY_SUMMARY_DAYS - 1)
+    return since.isoformat(), today.isoformat()
+
+
+def merge_weekly_bucket(total: dict[str, Any], bucket: dict[str, Any]) -> None:
+    for key, value in bucket.items():
+        if key == "sintomas":
+            symptoms = total.setdefault("sintomas", {})
+            for name, count in value.items():
+                symptoms[name] = symptoms.get(name, 0) + count
+        elif key == "metricas":
+            # [n, suma, mínimo, máximo] por métrica.
+            metrics = total.setdefault("metricas", {})
+            for name, (count, amount, low, high) in value.items():
+                if name in metrics:
+                    n, total_amount, current_low, current_high = metrics[name]
+                    metrics[name] = [
+                        n + count,
+                        total_amount + amount,
+                        min(current_low, low),
+                        max(current_high, high),
+                    ]
+                else:
+                    metrics[name] = [count, amount, low, high]
+        else:
+            total[key] = total.get(key, 0) + value
+
+
+def weekly_event_bucket(
+    counts: dict[str, int],
+    symptom: str | None = None,
+    metrics: dict[str, Any] | None = None,
+) -> dict[str, Any]:
+    bucket: dict[str, Any] = dict(counts)
+    if symptom:
+        bucket["sintomas"] = {symptom: 1}
+    numeric = {
+        name: [1, value, value, value]
+        for name, value in (metrics or {}).items()
+        if isinstance(value, (int, float)) and not isinstance(value, bool)
+    }
+    if numeric:
+        bucket["metricas"] = numeric
+    return bucket
+
+
+def store_weekly_days(producer_id: int, days: dict[str, Any]) -> None:
+    get_db().execute(
+        """
+        INSERT INTO producer_weekly_summary (producer_id, days_json, updated_at)
+        VALUES (?, ?, ?)
+        ON CONFLICT(producer_id) DO UPDATE
+        SET days_json = excluded.days_json, updated_at = excluded.updated_at
+        """,
+        (producer_id, json.dumps(days, ensure_ascii=False, sort_keys=True), utc_now()),
+    )
+
+
+def record_weekly_event(
+    producer_id: int,
+    counts: dict[str, int],
+    symptom: str | None = None,
+    metrics: dict[str, Any] | None = None,
+) -> None:
+    # Se llama después de la escritura del evento, dentro de su misma
+    # transacción: el lock de escritura ya está tomado.
+    row = get_db().execute(
+        "SELECT days_json FROM producer_weekly_summary WHERE producer_id = ?",
+        (producer_id,),
+    ).fetchone()
+    since, today = weekly_window()
+    days = {
+        day: bucket
+        for day, bucket in json.loads(row["days_json"] if row else "{}").items()
+        if day >= since
+    }
+    merge_weekly_bucket(days.setdefault(today, {}), weekly_event_bucket(counts, symptom, metrics))
+    store_weekly_days(producer_id, days)
+
+
+def recompute_weekly_days(producer_id: int, since: str) -> dict[str, Any]:
+    # Reconstruye los baldes desde el historial. Es lo que evita el resumen
+    # incremental en cada turno; queda para `compact-weekly-summary --rebuild`.
+    db = get_db()
+    days: dict[str, Any] = {}
+
+    def add(day: str, bucket: dict[str, Any]) -> None:
+        merge_weekly_bucket(days.setdefault(day, {}), bucket)
+
+    for row in db.execute(
+        """
+        SELECT substr(created_at, 1, 10) AS day, COUNT(*) AS total
+        FROM messages
+        WHERE producer_id = ? AND created_at >= ? AND direction = 'usuario'
+        GROUP BY day
+        """,
+        (producer_id, since),
+    ):
+        add(row["day"], {"mensajes": row["total"]})
+    for row in db.execute(
+        """
+        SELECT substr(created_at, 1, 10) AS day, COUNT(*) AS total,
+               SUM(level = 'alto') AS high
+        FROM alerts
+        WHERE producer_id = ? AND created_at >= ?
+        GROUP BY day
+        """,
+        (producer_id, since),
+    ):
+        add(row["day"], {"alertas": row["total"], "alertas_altas": row["high"]})
+    for row in db.execute(
+        """
+        SELECT substr(created_at, 1, 10) AS day, metrics_json
+        FROM daily_logs
+        WHERE producer_id = ? AND created_at >= ?
+        """,
+        (producer_id, since),
+    ):
+        metrics = json.loads(row["metrics_json"] or "{}")
+        add(row["day"], weekly_event_bucket({"bitacoras": 1}, metrics=metrics))
+    for row in db.execute(
+        """
+        SELECT completion_date AS day, COUNT(*) AS total
+        FROM producer_tasks
+        WHERE producer_id = ? AND status = 'COMPLETADO' AND completion_date >= ?
+        GROUP BY day
+        """,
+        (producer_id, since),
+    ):
+        add(row["day"], {"tareas_completadas": row["total"]})
+    for row in db.execute(
+        """
+        SELECT substr(updated_at, 1, 10) AS day, cultivo, sintoma
+        FROM forms
+        WHERE producer_id = ? AND updated_at >= ? AND sintoma IS NOT NULL
+        """,
+        (producer_id, since),
+    ):
+        add(row["day"], weekly_event_bucket({}, symptom_label(row["cultivo"], row["sintoma"])))
+    return days
+
+
+def symptom_label(crop: str | None, symptom: str) -> str:
+    return f"{crop}—{symptom}" if crop else symptom
+
+
+def summarize_week(days: dict[str, Any]) -> str:
+    since, _ = weekly_window()
+    total: dict[str, Any] = {}
+    for day, bucket in days.items():
+        if day >= since:
+            merge_weekly_bucket(total, bucket)
+    parts = []
+    symptoms = sorted(total.get("sintomas", {}).items(), key=lambda item: (-item[1], item[0]))
+    if symptoms:
+        parts.append(
+            ", ".join(
+                f"{name} ({count} {'vez' if count == 1 else 'veces'})"
+                for name, count in symptoms
+            )
+        )
+    if total.get("alertas"):
+        parts.append(f"alertas {total['alertas']} (altas {total.get('alertas_altas', 0)})")
+    if total.get("bitacoras"):
+        metrics = "".join(
+            f", {name} prom {amount / count:.1f} ({low:g}–{high:g})"
+            for name, (count, amount, low, high) in sorted(total.get("metricas", {}).items())
+        )
+        parts.append(f"bitácoras {total['bitacoras']}{metrics}")
+    if total.get("tareas_completadas"):
+        parts.append(f"tareas completadas {total['tareas_completadas']}")
+    # "mensajes" se cuenta en los baldes pero no va al texto: el texto es parte
+    # de la llave del cache de respuestas y cambiaría en cada turno.
+    if not parts:
+        return WEEKLY_SUMMARY_EMPTY
+    return "7d: " + "; ".join(parts) + "."
+
+
+def compact_weekly_summaries(rebuild: bool = False) -> dict[str, int]:
+    db = get_db()
+    since, _ = weekly_window()
+    stats = {"rebuilt": 0, "pruned": 0, "removed": 0, "kept": 0}
+    with write_transaction():
+        if rebuild:
+            db.execute("DELETE FROM producer_weekly_summary")
+            for row in db.execute("SELECT id FROM producers").fetchall():
+                days = recompute_weekly_days(row["id"], since)
+                if days:
+                    store_weekly_days(row["id"], days)
+                    stats["rebuilt"] += 1
+        rows = db.execute(
+            "SELECT producer_id, days_json FROM producer_weekly_summary"
+        ).fetchall()
+        for row in rows:
+            days = json.loads(row["days_json"])
+            current = {day: bucket for day, bucket in days.items() if day >= since}
+            if not current:
+                db.execute(
+                    "DELETE FROM producer_weekly_summary WHERE producer_id = ?",
+                    (row["producer_id"],),
+                )
+                stats["removed"] += 1
+            elif len(current) < len(days):
+                store_weekly_days(row["producer_id"], current)
+                stats["pruned"] += 1
+            else:
+                stats["kept"] += 1
+    return stats
+
+
+@app.cli.command("compact-weekly-summary")
+@click.option("--rebuild", is_flag=True, help="Recalcula los 7 días desde el historial.")
+def compact_weekly_summary_command(rebuild: bool) -> None:
+    # Tarea nocturna: descarta baldes fuera de la ventana y borra productores
+    # sin actividad en 7 días. --rebuild llena la tabla en bases existentes.
+    migrate_db()
+    start = time.perf_counter()
+    stats = compact_weekly_summaries(rebuild)
+    click.echo(
+        f"reconstruidos {stats['rebuilt']}, podados {stats['pruned']}, "
+        f"borrados {stats['removed']}, sin cambios {stats['kept']} "
+        f"en {time.perf_counter() - start:.1f} s"
+    )
 
 
 def evaluate_plan_progress(
@@ -736,237 +2079,2660 @@ def recent_chat(producer_id: int, limit: int = 6) -> list[str]:
     return [f'{row["direction"]}: {row["content"]}' for row in items]
 
 
-def build_context(role: str, phone: str, last_user_message: str) -> dict[str, Any]:
-    producer = get_or_create_producer(phone)
-    form_state = get_or_create_form(producer["id"])
-    active_plan = get_active_plan(producer["id"])
-    logs = recent_daily_logs(producer["id"])
-    plan_evaluation = evaluate_plan_progress(active_plan, logs)
+# Todo lo que un turno lee de la base sale de una sola sentencia: SQLite la
+# ejecuta dentro de una transacción de lectura implícita, así que el contexto
+# es una foto consistente aunque otro turno escriba en paralelo.
+TURN_SNAPSHOT_SQL = """
+WITH producer AS (
+    SELECT * FROM producers WHERE phone = :phone
+)
+SELECT
+    (
+        SELECT json_object(
+            'id', id, 'phone', phone, 'name', name, 'zone', zone,
+            'preferred_language', preferred_language, 'main_crops', main_crops,
+            'allowed', allowed, 'status', status, 'timezone', timezone,
+            'last_checkin_date', last_checkin_date, 'assigned_role', assigned_role,
+            'enable_formulario', enable_formulario,
+            'enable_consulta', enable_consulta,
+            'enable_intervencion', enable_intervencion,
+            'created_at', created_at
+        )
+        FROM producer
+    ) AS producer,
+    (
+        SELECT json_object(
+            'id', id, 'producer_id', producer_id, 'status', status,
+            'cultivo', cultivo, 'sintoma', sintoma,
+            'inicio_problema', inicio_problema, 'foto_recibida', foto_recibida,
+            'created_at', created_at, 'updated_at', updated_at
+        )
+        FROM forms
+        WHERE producer_id = (SELECT id FROM producer) AND status = 'abierto'
+        ORDER BY created_at DESC
+        LIMIT 1
+    ) AS form_state,
+    (
+        SELECT json_object(
+            'assignment_id', producer_plans.id,
+            'start_date', producer_plans.start_date,
+            'status', producer_plans.status,
+            'plan_id', plans.id,
+            'name', plans.name,
+            'description', plans.description,
+            'targets_json', plans.targets_json
+        )
+        FROM producer_plans
+        JOIN plans ON plans.id = producer_plans.plan_id
+        WHERE producer_plans.producer_id = (SELECT id FROM producer)
+          AND producer_plans.status = 'activo'
+        ORDER BY producer_plans.start_date DESC
+        LIMIT 1
+    ) AS active_plan,
+    (
+        SELECT json_group_array(json(item))
+        FROM (
+            SELECT json_object(
+                'id', id, 'plan_id', plan_id, 'log_date', log_date, 'notes', notes,
+                'metrics_json', metrics_json, 'created_at', created_at
+            ) AS item
+            FROM daily_logs
+            WHERE producer_id = (SELECT id FROM producer)
+            ORDER BY log_date DESC, created_at DESC
+            LIMIT :log_limit
+        )
+    ) AS daily_logs,
+    (
+        SELECT json_group_array(line)
+        FROM (
+            SELECT direction || ': ' || content AS line
+            FROM (
+                SELECT direction, content, created_at, id
+                FROM messages
+                WHERE producer_id = (SELECT id FROM producer)
+                ORDER BY created_at DESC
+                LIMIT :chat_limit
+            )
+            ORDER BY created_at ASC, id ASC
+        )
+    ) AS recent_chat,
+    (
+        SELECT json_object(
+            'id', id, 'producer_id', producer_id, 'template_id', template_id,
+            'task_name', task_name, 'order_sequence', order_sequence,
+            'status', status, 'estimated_date', estimated_date,
+            'completion_date', completion_date, 'progress_pct', progress_pct,
+            'blocker_reason', blocker_reason,
+            'created_at', created_at, 'updated_at', updated_at
+        )
+        FROM producer_tasks
+        WHERE producer_id = (SELECT id FROM producer)
+          AND status IN ('PENDIENTE', 'EN_PROGRESO', 'BLOQUEADO')
+        ORDER BY order_sequence ASC
+        LIMIT 1
+    ) AS active_task,
+    (
+        SELECT days_json
+        FROM producer_weekly_summary
+        WHERE producer_id = (SELECT id FROM producer)
+    ) AS weekly_days,
+    (
+        SELECT summary
+        FROM chat_summaries
+        WHERE producer_id = (SELECT id FROM producer)
+    ) AS chat_summary
+"""
+
+
+@dataclass
+class TurnSnapshot:
+    producer: dict[str, Any]
+    form_state: dict[str, Any]
+    active_plan: dict[str, Any] | None
+    daily_logs: list[dict[str, Any]]
+    recent_chat: list[str]
+    active_task: dict[str, Any] | None
+    weekly_days: dict[str, Any]
+    chat_summary: str | None
+    message: str = ""
+    received_at: str | None = None
+    # Clave de idempotencia del turno (ruta, clave) y si un intento anterior
+    # ya guardó el mensaje entrante.
+    inbound_key: tuple[str, str] | None = None
+    inbound_saved: bool = False
+
+    def add_chat(self, direction: str, content: str, limit: int = 6) -> None:
+        self.recent_chat = (self.recent_chat + [f"{direction}: {content}"])[-limit:]
+
+
+def load_turn_snapshot(
+    phone: str, log_limit: int = 3, chat_limit: int = 6
+) -> TurnSnapshot:
+    db = get_db()
+    params = {"phone": phone, "log_limit": log_limit, "chat_limit": chat_limit}
+    row = db.execute(TURN_SNAPSHOT_SQL, params).fetchone()
+    if row["producer"] is None or row["form_state"] is None:
+        # Primer mensaje del productor o formulario recién cerrado: se crean
+        # una sola vez y se vuelve a leer la foto completa.
+        producer = get_or_create_producer(phone)
+        get_or_create_form(producer["id"])
+        row = db.execute(TURN_SNAPSHOT_SQL, params).fetchone()
+
+    active_plan = json.loads(row["active_plan"]) if row["active_plan"] else None
+    if active_plan:
+        active_plan["targets"] = json.loads(active_plan.pop("targets_json") or "{}")
+    logs: list[dict[str, Any]] = []
+    for item in json.loads(row["daily_logs"] or "[]"):
+        item["metrics"] = json.loads(item.pop("metrics_json") or "{}")
+        logs.append(item)
+    return TurnSnapshot(
+        producer=json.loads(row["producer"]),
+        form_state=json.loads(row["form_state"]),
+        active_plan=active_plan,
+        daily_logs=logs,
+        recent_chat=json.loads(row["recent_chat"] or "[]"),
+        active_task=json.loads(row["active_task"]) if row["active_task"] else None,
+        weekly_days=json.loads(row["weekly_days"] or "{}"),
+        chat_summary=row["chat_summary"],
+    )
+
+
+def build_context(
+    role: str,
+    phone: str,
+    last_user_message: str,
+    snapshot: TurnSnapshot | None = None,
+) -> dict[str, Any]:
+    snapshot = snapshot or load_turn_snapshot(phone)
+    producer = snapshot.producer
+    logs = snapshot.daily_logs
+    plan_evaluation = evaluate_plan_progress(snapshot.active_plan, logs)
     context: dict[str, Any] = {
         "role": role,
-        "producer": producer,
-        "form_state": form_state,
-        "recent_chat": recent_chat(producer["id"]),
-        "active_task": get_active_task(producer["id"]),
+        "producer": dict(producer),
+        "form_state": dict(snapshot.form_state),
+        "chat_summary": snapshot.chat_summary,
+        "recent_chat": list(snapshot.recent_chat),
+        "active_task": snapshot.active_task,
         "daily_logs": logs,
-        "active_plan": active_plan,
+        "active_plan": snapshot.active_plan,
         "plan_evaluation": plan_evaluation,
         "daily_prompt_needed": should_prompt_daily_checkin(producer),
         "weekly_summary": None,
         "last_user_message": last_user_message,
     }
 
-    if role == "consulta":
-        context["weekly_summary"] = "7d: sin datos suficientes registrados."
+    if role in ("consulta", "intervencion"):
+        context["weekly_summary"] = summarize_week(snapshot.weekly_days)
     if role == "intervencion":
         context["recent_chat"] = []
-        context["weekly_summary"] = "7d: sin datos suficientes registrados."
 
     return context
 
 
+def fit_turn_context(role: str, context: dict[str, Any]) -> dict[str, Any]:
+    # Antes de pedir el slot del modelo: contar tokens (quizá vía /tokenize)
+    # no debe ocuparlo. run_mml y stream_mml reciben el contexto ya ajustado.
+    agent_config = get_agent_config(role)
+    with AGENT_STAGE_SECONDS.time("fit_context", role):
+        return fit_context(role, context, agent_config["prompt"], agent_config["max_tokens"])
+
+
 def run_mml(role: str, context: dict[str, Any]) -> dict[str, Any]:
     agent_config = get_agent_config(role)
     system_prompt = agent_config["prompt"]
+    session_key = session_cache_key(role, context, system_prompt)
+    schema = mml_output_schema(role) if GRAMMAR_ENABLED else None
     if MODEL_API_URL:
-        return call_model_api(system_prompt, context, agent_config["max_tokens"])
+        return call_model_api(system_prompt, context, agent_config["max_tokens"], schema)
     llm = get_local_llm()
-    response = llm.create_chat_completion(
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": json.dumps(context, ensure_ascii=False)},
-        ],
-        temperature=0.2,
-        max_tokens=agent_config["max_tokens"],
-    )
+    grammar = get_role_grammar(role) if GRAMMAR_ENABLED else None
+    with AGENT_STAGE_SECONDS.time("serialize", role):
+        user_content = serialize_context(context)
+    # model_lock: espera por el modelo local; model empieza con el lock tomado.
+    lock_started = time.perf_counter()
+    with _LOCAL_LLM_LOCK:
+        AGENT_STAGE_SECONDS.observe(time.perf_counter() - lock_started, "model_lock", role)
+        with AGENT_STAGE_SECONDS.time("model", role):
+            restore_session(llm, role, system_prompt, session_key)
+            before = llama_perf(llm)
+            response = llm.create_chat_completion(
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_content},
+                ],
+                temperature=0.2,
+                max_tokens=agent_config["max_tokens"],
+                grammar=grammar,
+            )
+            usage = (response.get("usage") or {}) | perf_usage(before, llama_perf(llm))
+            remember_session(llm, session_key)
+    observe_model_usage(role, usage)
     content = response["choices"][0]["message"]["content"] or "{}"
     try:
-        return json.loads(content)
-    except json.JSONDecodeError as exc:
-        raise RuntimeError("Respuesta inválida desde el modelo local.") from exc
+        with AGENT_STAGE_SECONDS.time("parse", role):
+            return json.loads(content)
+    except json.JSONDecodeError as exc:
+        raise RuntimeError("Respuesta inválida desde el modelo local.") from exc
+
+
+_LOCAL_LLM: Llama | None = None
+_LOCAL_LLM_LOCK = threading.Lock()
+_LOCAL_LLM_LOAD_LOCK = threading.Lock()
+# role -> (huella del prompt, estado KV con el prompt de sistema ya evaluado)
+_PREFIX_STATES: dict[str, tuple[str, LlamaState]] = {}
+# Roles cuyo prompt se editó en /admin; su prefijo se rehace en el próximo turno.
+_STALE_PREFIXES: set[str] = set()
+_ACTIVE_PREFIX: tuple[str, str] | None = None
+# Clave de SESSION_CACHE cuyo estado está cargado en el Llama local.
+_ACTIVE_SESSION: str | None = None
+_ROLE_GRAMMARS: dict[str, LlamaGrammar] = {}
+
+
+class LlamaSessionCache:
+    # LRU de LlamaState por productor y rol. Al pasar de max_bytes, los más
+    # viejos se escriben a disco y se leen de vuelta con mmap; al pasar de
+    # disk_bytes se borran. Los scores solo valen para el último token
+    # evaluado y el turno siguiente siempre evalúa al menos uno, así que no se
+    # guardan: al restaurar se pasa una vista de un arreglo de ceros compartido
+    # con las filas que espera load_state (min(n_tokens, filas de llm.scores)).
+
+    def __init__(self, max_bytes: int, disk_bytes: int, directory: Path) -> None:
+        self.max_bytes = max_bytes
+        self.disk_bytes = disk_bytes
+        self.directory = directory
+        self.memory: OrderedDict[str, LlamaState] = OrderedDict()
+        self.disk: OrderedDict[str, int] = OrderedDict()
+        self.memory_used = 0
+        self.disk_used = 0
+        self.zeros: np.ndarray | None = None
+        self.lock = threading.Lock()
+        self.directory_ready = False
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.spills = 0
+        self.evictions = 0
+
+    @staticmethod
+    def state_bytes(state: LlamaState) -> int:
+        return state.llama_state_size + getattr(state.input_ids, "nbytes", 0)
+
+    def path(self, key: str) -> Path:
+        return self.directory / f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}.llstate"
+
+    def get(self, key: str) -> LlamaState | None:
+        with self.lock:
+            state = self.memory.get(key)
+            if state is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return state
+            if key not in self.disk:
+                self.misses += 1
+                return None
+            self.disk_used -= self.disk.pop(key)
+            try:
+                state = self.read(self.path(key))
+            except (OSError, ValueError, KeyError, struct.error):
+                # Archivo borrado, truncado o ajeno: se trata como fallo.
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self.add(key, state)
+            return state
+
+    def put(self, key: str, state: LlamaState) -> None:
+        with self.lock:
+            state.scores = None
+            if key in self.disk:
+                self.disk_used -= self.disk.pop(key)
+                self.path(key).unlink(missing_ok=True)
+            self.add(key, state)
+
+    def add(self, key: str, state: LlamaState) -> None:
+        previous = self.memory.pop(key, None)
+        if previous is not None:
+            self.memory_used -= self.state_bytes(previous)
+        self.memory[key] = state
+        self.memory_used += self.state_bytes(state)
+        while self.memory_used > self.max_bytes and len(self.memory) > 1:
+            old_key, old_state = self.memory.popitem(last=False)
+            self.memory_used -= self.state_bytes(old_state)
+            self.spill(old_key, old_state)
+
+    def spill(self, key: str, state: LlamaState) -> None:
+        if not self.directory_ready:
+            # Los archivos de un proceso anterior no están en el índice.
+            self.directory.mkdir(parents=True, exist_ok=True)
+            for stale in self.directory.glob("*.llstate"):
+                stale.unlink()
+            self.directory_ready = True
+        # [u64 largo][cabecera JSON][input_ids int32][estado]. La cabecera
+        # es JSON y no pickle: el directorio puede ser escribible por otros.
+        input_ids = np.ascontiguousarray(state.input_ids, dtype=np.intc)
+        header = json.dumps(
+            {
+                "n_tokens": state.n_tokens,
+                "llama_state_size": state.llama_state_size,
+                "seed": state.seed,
+                "input_ids": len(input_ids),
+            }
+        ).encode("utf-8")
+        with open(self.path(key), "wb") as handle:
+            handle.write(struct.pack("<Q", len(header)))
+            handle.write(header)
+            handle.write(input_ids.tobytes())
+            handle.write(state.llama_state)
+        size = self.state_bytes(state)
+        self.disk[key] = size
+        self.disk_used += size
+        self.spills += 1
+        while self.disk_used > self.disk_bytes and self.disk:
+            old_key, old_size = self.disk.popitem(last=False)
+            self.disk_used -= old_size
+            self.path(old_key).unlink(missing_ok=True)
+            self.evictions += 1
+
+    def read(self, path: Path) -> LlamaState:
+        # input_ids y llama_state quedan como vistas del mmap, sin copiar: el
+        # mapa vive mientras el estado lo use (el archivo ya borrado se libera
+        # al soltarlo) y load_state copia una sola vez al contexto.
+        with open(path, "rb") as handle:
+            mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        path.unlink(missing_ok=True)
+        (header_size,) = struct.unpack_from("<Q", mapped, 0)
+        meta = json.loads(mapped[8 : 8 + header_size])
+        offset = 8 + header_size
+        input_ids = np.frombuffer(mapped, dtype=np.intc, count=meta["input_ids"], offset=offset)
+        offset += input_ids.nbytes
+        if len(mapped) - offset != meta["llama_state_size"]:
+            raise ValueError(f"estado incompleto en {path.name}")
+        state = LlamaState.__new__(LlamaState)
+        state.input_ids = input_ids
+        state.scores = None
+        state.n_tokens = meta["n_tokens"]
+        state.llama_state = memoryview(mapped)[offset:]
+        state.llama_state_size = meta["llama_state_size"]
+        state.seed = meta["seed"]
+        return state
+
+    def zero_scores(self, rows: int, n_vocab: int) -> np.ndarray:
+        with self.lock:
+            if self.zeros is None or self.zeros.shape[0] < rows or self.zeros.shape[1] != n_vocab:
+                self.zeros = np.zeros((rows, n_vocab), dtype=np.single)
+            return self.zeros[:rows]
+
+    def stats(self) -> dict[str, Any]:
+        with self.lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "memory_entries": len(self.memory),
+                "memory_mb": round(self.memory_used / 2**20, 1),
+                "memory_limit_mb": round(self.max_bytes / 2**20, 1),
+                "disk_entries": len(self.disk),
+                "disk_mb": round(self.disk_used / 2**20, 1),
+                "disk_limit_mb": round(self.disk_bytes / 2**20, 1),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "spills": self.spills,
+                "evictions": self.evictions,
+                "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+SESSION_CACHE = LlamaSessionCache(
+    SESSION_CACHE_MAX_MB * 2**20, SESSION_CACHE_DISK_MB * 2**20, SESSION_CACHE_DIR
+)
+
+
+def session_cache_key(role: str, context: dict[str, Any], system_prompt: str) -> str | None:
+    producer_id = (context.get("producer") or {}).get("id")
+    if not SESSION_CACHE_ENABLED or producer_id is None:
+        return None
+    return f"{producer_id}:{role}:{prompt_fingerprint(system_prompt)}"
+
+
+def restore_session(llm: Llama, role: str, system_prompt: str, key: str | None) -> None:
+    # Con el estado del turno anterior del productor cargado, generate solo
+    # evalúa desde el primer token que cambió. Sin estado, el del rol.
+    global _ACTIVE_PREFIX, _ACTIVE_SESSION
+    if key is not None and key == _ACTIVE_SESSION:
+        return
+    state = SESSION_CACHE.get(key) if key is not None else None
+    if state is None:
+        load_prefix_state(llm, role, system_prompt)
+        return
+    rows, n_vocab = llm.scores.shape
+    state.scores = SESSION_CACHE.zero_scores(min(state.n_tokens, rows), n_vocab)
+    llm.load_state(state)
+    _ACTIVE_PREFIX = (role, prompt_fingerprint(system_prompt))
+    _ACTIVE_SESSION = key
+
+
+def remember_session(llm: Llama, key: str | None) -> None:
+    global _ACTIVE_SESSION
+    if key is not None:
+        SESSION_CACHE.put(key, llm.save_state())
+        _ACTIVE_SESSION = key
+
+
+_MODEL_API_SESSION: requests.Session | None = None
+
+
+# Campos que ve el modelo por rol (docs/contrato-mml.md, "Qué enviar por
+# rol"), en orden fijo y con llave corta. Lo estable va primero y el mensaje
+# al final, así turnos seguidos comparten el mayor prefijo posible.
+COMPACT_CONTEXT_FIELDS: dict[str, tuple[str, ...]] = {
+    "formulario": (
+        "role",
+        "producer",
+        "form_state",
+        "active_task",
+        "daily_prompt_needed",
+        "chat_summary",
+        "recent_chat",
+        "last_user_message",
+    ),
+    "consulta": (
+        "role",
+        "producer",
+        "weekly_summary",
+        "chat_summary",
+        "recent_chat",
+        "last_user_message",
+    ),
+    "intervencion": (
+        "role",
+        "producer",
+        "weekly_summary",
+        "chat_summary",
+        "daily_logs",
+        "last_user_message",
+    ),
+}
+COMPACT_KEYS = {
+    "role": "role",
+    "producer": "prod",
+    "form_state": "form",
+    "active_task": "tarea",
+    "daily_prompt_needed": "pedir_bitacora",
+    "weekly_summary": "sem7d",
+    "daily_logs": "logs",
+    "chat_summary": "hist",
+    "recent_chat": "chat",
+    "last_user_message": "msg",
+}
+CHAT_SPEAKERS = {"usuario": "U", "asistente": "A"}
+
+
+def compact_producer(producer: dict[str, Any]) -> dict[str, Any]:
+    crops = producer.get("main_crops")
+    if isinstance(crops, str):
+        try:
+            crops = json.loads(crops)
+        except json.JSONDecodeError:
+            crops = [crops]
+    return {
+        "nombre": producer.get("name"),
+        "zona": producer.get("zone"),
+        "idioma": producer.get("preferred_language"),
+        "cultivos": crops,
+    }
+
+
+def compact_form(form: dict[str, Any]) -> dict[str, Any]:
+    # Mismas llaves que actualizar_formulario en la salida.
+    return {
+        "cultivo": form.get("cultivo"),
+        "sintoma": form.get("sintoma"),
+        "inicio_problema": form.get("inicio_problema"),
+        "foto_recibida": bool(form.get("foto_recibida")),
+    }
+
+
+def compact_task(task: dict[str, Any]) -> dict[str, Any]:
+    # task_id se conserva: actualizar_tarea lo necesita.
+    return {
+        "task_id": task.get("id"),
+        "nombre": task.get("task_name"),
+        "estado": task.get("status"),
+        "fecha": task.get("estimated_date"),
+        "avance": task.get("progress_pct"),
+        "bloqueo": task.get("blocker_reason"),
+    }
+
+
+def compact_chat(lines: list[str]) -> list[str]:
+    compacted = []
+    for line in lines:
+        speaker, _, text = line.partition(": ")
+        compacted.append(f"{CHAT_SPEAKERS.get(speaker, speaker)}: {text}")
+    return compacted
+
+
+def compact_logs(logs: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    return [
+        {"fecha": log.get("log_date"), "notas": log.get("notes"), "metricas": log.get("metrics")}
+        for log in logs
+    ]
+
+
+COMPACT_ENCODERS: dict[str, Callable[[Any], Any]] = {
+    "producer": compact_producer,
+    "form_state": compact_form,
+    "active_task": compact_task,
+    "recent_chat": compact_chat,
+    "daily_logs": compact_logs,
+}
+
+
+def without_empty(value: Any) -> Any:
+    if isinstance(value, dict):
+        cleaned = {key: without_empty(item) for key, item in value.items()}
+        return {key: item for key, item in cleaned.items() if item not in (None, "", [], {})}
+    if isinstance(value, list):
+        return [without_empty(item) for item in value]
+    return value
+
+
+def compact_context(context: dict[str, Any]) -> dict[str, Any]:
+    # Sin "role" (fragmentos sueltos del presupuestador) se codifican todos
+    # los campos presentes, sin filtrar por rol.
+    fields = COMPACT_CONTEXT_FIELDS.get(context.get("role"), tuple(context))
+    compacted: dict[str, Any] = {}
+    for name in fields:
+        value = context.get(name)
+        if value is None or name not in COMPACT_KEYS:
+            continue
+        encoder = COMPACT_ENCODERS.get(name)
+        compacted[COMPACT_KEYS[name]] = encoder(value) if encoder else value
+    return without_empty(compacted)
+
+
+def encode_context(context: dict[str, Any]) -> dict[str, Any]:
+    return compact_context(context) if COMPACT_CONTEXT_ENABLED else context
+
+
+def dump_context(value: Any) -> str:
+    if COMPACT_CONTEXT_ENABLED:
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+    return json.dumps(value, ensure_ascii=False)
+
+
+def serialize_context(context: dict[str, Any]) -> str:
+    return dump_context(encode_context(context))
+
+
+class TokenCounter:
+    # Conteo con el tokenizador del modelo y cache LRU por fragmento: el
+    # perfil del productor o el plan activo casi no cambian entre turnos.
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.counts: OrderedDict[str, int] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def count_many(self, texts: list[str]) -> list[int]:
+        keys = [hashlib.sha1(text.encode("utf-8")).hexdigest() for text in texts]
+        results: dict[str, int] = {}
+        with self.lock:
+            for key in keys:
+                if key in self.counts:
+                    self.counts.move_to_end(key)
+                    results[key] = self.counts[key]
+                    self.hits += 1
+        missing = {key: text for key, text in zip(keys, texts) if key not in results}
+        if missing:
+            counted = tokenize_counts(list(missing.values()))
+            with self.lock:
+                for key, count in zip(missing, counted):
+                    self.misses += 1
+                    results[key] = count
+                    self.counts[key] = count
+                    self.counts.move_to_end(key)
+                while len(self.counts) > self.size:
+                    self.counts.popitem(last=False)
+        return [results[key] for key in keys]
+
+    def count(self, text: str) -> int:
+        return self.count_many([text])[0]
+
+    def stats(self) -> dict[str, Any]:
+        with self.lock:
+            return {"entries": len(self.counts), "hits": self.hits, "misses": self.misses}
+
+
+def approximate_tokens(text: str) -> int:
+    # ~3 caracteres por token en español: sobreestima un poco, del lado seguro.
+    return len(text) // 3 + 1
+
+
+def tokenize_counts(texts: list[str]) -> list[int]:
+    if MODEL_API_URL:
+        try:
+            response = get_model_api_session().post(
+                f"{MODEL_API_URL.rstrip('/')}/tokenize", json={"texts": texts}, timeout=10
+            )
+            response.raise_for_status()
+            return [int(count) for count in response.json()["counts"]]
+        except (requests.RequestException, KeyError, ValueError):
+            return [approximate_tokens(text) for text in texts]
+    try:
+        llm = get_local_llm()
+    except RuntimeError:
+        return [approximate_tokens(text) for text in texts]
+    return [
+        len(llm.tokenize(text.encode("utf-8"), add_bos=False, special=False))
+        for text in texts
+    ]
+
+
+TOKEN_COUNTER = TokenCounter(TOKEN_COUNT_CACHE_SIZE)
+TOKENS_SAVED = Histogram((0, 16, 32, 64, 128, 256, 512, 1024, 2048))
+CONTEXT_BUDGET_TOTALS = {"turns": 0, "trimmed": 0, "over_budget": 0}
+_CONTEXT_BUDGET_LOCK = threading.Lock()
+
+
+def context_tokens(context: dict[str, Any]) -> int:
+    # Suma por campo: cada fragmento se cachea por separado. Las llaves y
+    # comas del objeto completo agregan unos pocos tokens que cubre el margen.
+    encoded = encode_context(context)
+    fragments = [dump_context({key: value}) for key, value in encoded.items()]
+    return sum(TOKEN_COUNTER.count_many(fragments))
+
+
+def shorten_log_notes(context: dict[str, Any]) -> bool:
+    changed = False
+    for log in context.get("daily_logs") or []:
+        notes = log.get("notes") or ""
+        if len(notes) > 80:
+            log["notes"] = notes[:79] + "…"
+            changed = True
+    return changed
+
+
+def keep_target_metrics(context: dict[str, Any]) -> bool:
+    # Solo las métricas que el plan activo evalúa. Sin metas no hay con qué
+    # elegir y se dejan todas.
+    targets = set(((context.get("active_plan") or {}).get("targets") or {}))
+    if not targets:
+        return False
+    changed = False
+    for log in context.get("daily_logs") or []:
+        metrics = log.get("metrics") or {}
+        kept = {key: value for key, value in metrics.items() if key in targets}
+        if kept != metrics:
+            log["metrics"] = kept
+            changed = True
+    return changed
+
+
+def drop_oldest_log(context: dict[str, Any]) -> bool:
+    logs = context.get("daily_logs") or []
+    if len(logs) <= 1:
+        return False
+    logs.pop()
+    return True
+
+
+def drop_oldest_chat(context: dict[str, Any]) -> bool:
+    chat = context.get("recent_chat") or []
+    if len(chat) <= 1:
+        return False
+    chat.pop(0)
+    return True
+
+
+def drop_plan_description(context: dict[str, Any]) -> bool:
+    plan = context.get("active_plan") or {}
+    return plan.pop("description", None) is not None
+
+
+def summarize_producer(context: dict[str, Any]) -> bool:
+    producer = context.get("producer") or {}
+    summary = {
+        key: producer.get(key)
+        for key in ("name", "zone", "preferred_language", "main_crops")
+    }
+    if summary == producer:
+        return False
+    context["producer"] = summary
+    return True
+
+
+# Campo del contexto que cambia cada reducción. Si el rol no lo envía al
+# modelo (COMPACT_CONTEXT_FIELDS) la reducción no se intenta: no ahorra
+# tokens y costaría un recuento.
+TRIM_STEP_FIELDS: dict[Callable[[dict[str, Any]], bool], str] = {
+    shorten_log_notes: "daily_logs",
+    keep_target_metrics: "daily_logs",
+    drop_oldest_log: "daily_logs",
+    drop_oldest_chat: "recent_chat",
+    drop_plan_description: "active_plan",
+    summarize_producer: "producer",
+}
+
+
+def drop_field(name: str) -> Callable[[dict[str, Any]], bool]:
+    def reduce(context: dict[str, Any]) -> bool:
+        return context.pop(name, None) is not None
+
+    TRIM_STEP_FIELDS[reduce] = name
+    return reduce
+
+
+# Reducciones por rol, de menor a mayor valor perdido. Cada una se repite
+# mientras cambie algo y el contexto siga sin caber. form_state y
+# last_user_message nunca se recortan.
+CONTEXT_TRIM_ORDER: dict[str, tuple[Callable[[dict[str, Any]], bool], ...]] = {
+    "formulario": (
+        shorten_log_notes,
+        keep_target_metrics,
+        drop_plan_description,
+        drop_field("plan_evaluation"),
+        drop_oldest_log,
+        drop_field("chat_summary"),
+        drop_oldest_chat,
+        summarize_producer,
+    ),
+    "consulta": (
+        drop_field("active_task"),
+        shorten_log_notes,
+        drop_plan_description,
+        drop_field("plan_evaluation"),
+        keep_target_metrics,
+        drop_oldest_log,
+        drop_field("chat_summary"),
+        drop_oldest_chat,
+        summarize_producer,
+    ),
+    "intervencion": (
+        drop_field("active_task"),
+        shorten_log_notes,
+        drop_plan_description,
+        summarize_producer,
+        keep_target_metrics,
+        drop_field("chat_summary"),
+        drop_oldest_log,
+    ),
+}
+
+
+def context_budget(system_prompt: str, max_tokens: int) -> int:
+    if CONTEXT_TOKEN_BUDGET > 0:
+        return CONTEXT_TOKEN_BUDGET
+    return N_CTX - max_tokens - TOKEN_COUNTER.count(system_prompt) - CONTEXT_TOKEN_MARGIN
+
+
+def fit_context(
+    role: str, context: dict[str, Any], system_prompt: str, max_tokens: int
+) -> dict[str, Any]:
+    if not CONTEXT_BUDGET_ENABLED:
+        return context
+    budget = context_budget(system_prompt, max_tokens)
+    before = context_tokens(context)
+    fitted = context
+    tokens = before
+    if tokens > budget:
+        fitted = copy.deepcopy(context)
+        sent = COMPACT_CONTEXT_FIELDS.get(role) if COMPACT_CONTEXT_ENABLED else None
+        for reduce in CONTEXT_TRIM_ORDER.get(role, ()):
+            if sent is not None and TRIM_STEP_FIELDS[reduce] not in sent:
+                continue
+            while tokens > budget and reduce(fitted):
+                tokens = context_tokens(fitted)
+            if tokens <= budget:
+                break
+    saved = before - tokens
+    TOKENS_SAVED.observe(saved)
+    with _CONTEXT_BUDGET_LOCK:
+        CONTEXT_BUDGET_TOTALS["turns"] += 1
+        CONTEXT_BUDGET_TOTALS["trimmed"] += saved > 0
+        CONTEXT_BUDGET_TOTALS["over_budget"] += tokens > budget
+    app.logger.info(
+        "contexto %s: %s tokens (presupuesto %s, ahorrados %s)", role, tokens, budget, saved
+    )
+    return fitted
+
+
+def get_model_api_session() -> requests.Session:
+    # Una sesión por proceso: reutiliza conexiones keep-alive (y TLS) hacia
+    # MODEL_API_URL y reintenta con backoff los fallos de conexión y 502/503.
+    # /chat no es idempotente: un timeout de lectura (o un 504 del proxy)
+    # puede llegar con el modelo aún generando, así que no se reintenta.
+    global _MODEL_API_SESSION
+    if _MODEL_API_SESSION is None:
+        retry = Retry(
+            total=MODEL_API_RETRIES,
+            read=0,
+            backoff_factor=MODEL_API_BACKOFF,
+            status_forcelist=(502, 503),
+            allowed_methods=frozenset({"POST"}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=MODEL_API_POOL_SIZE, max_retries=retry
+        )
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _MODEL_API_SESSION = session
+    return _MODEL_API_SESSION
+
+
+def encode_model_frame(header: dict[str, Any], user_content: str) -> bytes:
+    head = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    body = user_content.encode("utf-8")
+    return struct.pack(">I", len(head)) + head + struct.pack(">I", len(body)) + body
+
+
+def post_model_api(
+    path: str,
+    system_prompt: str,
+    context: dict[str, Any],
+    max_tokens: int,
+    schema: dict[str, Any] | None,
+    stream: bool = False,
+) -> requests.Response:
+    url = f"{MODEL_API_URL.rstrip('/')}{path}"
+    session = get_model_api_session()
+    role = str(context.get("role") or "default")
+    with AGENT_STAGE_SECONDS.time("serialize", role):
+        if MODEL_API_WIRE == "frame":
+            header = {
+                "system": system_prompt,
+                "role": context.get("role"),
+                "max_tokens": max_tokens,
+                "schema": schema,
+            }
+            body = encode_model_frame(header, serialize_context(context))
+            content_type = MODEL_FRAME_CONTENT_TYPE
+        else:
+            payload = {
+                "system": system_prompt,
+                "context": encode_context(context),
+                "max_tokens": max_tokens,
+                "schema": schema,
+            }
+            body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            content_type = "application/json"
+    headers = {"Content-Type": content_type}
+    if stream:
+        return session.post(url, data=body, headers=headers, stream=True, timeout=120)
+    with AGENT_STAGE_SECONDS.time("model", role):
+        return session.post(url, data=body, headers=headers, timeout=120)
+
+
+def call_model_api(
+    system_prompt: str,
+    context: dict[str, Any],
+    max_tokens: int,
+    schema: dict[str, Any] | None = None,
+) -> dict[str, Any]:
+    role = str(context.get("role") or "default")
+    response = post_model_api("/chat", system_prompt, context, max_tokens, schema)
+    response.raise_for_status()
+    data = response.json()
+    observe_model_usage(role, data.get("usage") or {})
+    content = data.get("content") or "{}"
+    try:
+        with AGENT_STAGE_SECONDS.time("parse", role):
+            return json.loads(content)
+    except json.JSONDecodeError as exc:
+        raise RuntimeError("Respuesta inválida desde la API del modelo.") from exc
+
+
+def stream_mml(role: str, context: dict[str, Any]) -> Iterator[str]:
+    agent_config = get_agent_config(role)
+    system_prompt = agent_config["prompt"]
+    session_key = session_cache_key(role, context, system_prompt)
+    schema = mml_output_schema(role) if GRAMMAR_ENABLED else None
+    if MODEL_API_URL:
+        yield from stream_model_api(
+            system_prompt, context, agent_config["max_tokens"], schema
+        )
+        return
+    llm = get_local_llm()
+    grammar = get_role_grammar(role) if GRAMMAR_ENABLED else None
+    with AGENT_STAGE_SECONDS.time("serialize", role):
+        user_content = serialize_context(context)
+    lock_started = time.perf_counter()
+    with _LOCAL_LLM_LOCK:
+        AGENT_STAGE_SECONDS.observe(time.perf_counter() - lock_started, "model_lock", role)
+        started = time.perf_counter()
+        restore_session(llm, role, system_prompt, session_key)
+        before = llama_perf(llm)
+        first_token = True
+        for chunk in llm.create_chat_completion(
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_content},
+            ],
+            temperature=0.2,
+            max_tokens=agent_config["max_tokens"],
+            grammar=grammar,
+            stream=True,
+        ):
+            piece = chunk["choices"][0]["delta"].get("content")
+            if piece:
+                if first_token:
+                    AGENT_STAGE_SECONDS.observe(time.perf_counter() - started, "first_token", role)
+                    first_token = False
+                yield piece
+        AGENT_STAGE_SECONDS.observe(time.perf_counter() - started, "model", role)
+        observe_model_usage(role, perf_usage(before, llama_perf(llm)))
+        remember_session(llm, session_key)
+
+
+def stream_model_api(
+    system_prompt: str,
+    context: dict[str, Any],
+    max_tokens: int,
+    schema: dict[str, Any] | None = None,
+) -> Iterator[str]:
+    role = str(context.get("role") or "default")
+    started = time.perf_counter()
+    first_token = True
+    with post_model_api(
+        "/chat/stream", system_prompt, context, max_tokens, schema, stream=True
+    ) as response:
+        response.raise_for_status()
+        response.encoding = "utf-8"
+        event = None
+        for line in response.iter_lines(decode_unicode=True):
+            if not line:
+                event = None
+            elif line.startswith("event:"):
+                event = line[len("event:"):].strip()
+            elif line.startswith("data:"):
+                data = json.loads(line[len("data:"):])
+                if event == "error":
+                    raise RuntimeError(data.get("error") or "Error en la API del modelo.")
+                if event == "done":
+                    AGENT_STAGE_SECONDS.observe(time.perf_counter() - started, "model", role)
+                    observe_model_usage(role, data.get("usage") or {})
+                    return
+                if first_token:
+                    AGENT_STAGE_SECONDS.observe(time.perf_counter() - started, "first_token", role)
+                    first_token = False
+                yield data.get("delta", "")
+
+
+class JSONFieldExtractor:
+    # Lee un documento JSON por fragmentos y devuelve el valor de una clave
+    # string de primer nivel apenas se cierran sus comillas, sin esperar al
+    # resto del documento.
+
+    def __init__(self, field: str) -> None:
+        self.field = field
+        self.value: str | None = None
+        self.stack: list[str] = []
+        self.in_string = False
+        self.escaped = False
+        self.is_key = False
+        self.expect_key = False
+        self.last_key: str | None = None
+        self.buffer: list[str] = []
+
+    def feed(self, text: str) -> str | None:
+        if self.value is not None:
+            return None
+        for ch in text:
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+                    found = self._close_string()
+                    if found is not None:
+                        return found
+                    continue
+                self.buffer.append(ch)
+            elif ch == '"':
+                self.in_string = True
+                self.is_key = self.expect_key
+                self.buffer = []
+            elif ch in "{[":
+                self.stack.append(ch)
+                self.expect_key = ch == "{"
+            elif ch in "}]":
+                if self.stack:
+                    self.stack.pop()
+                self.expect_key = False
+            elif ch == ",":
+                self.expect_key = bool(self.stack) and self.stack[-1] == "{"
+            elif ch == ":":
+                self.expect_key = False
+        return None
+
+    def _close_string(self) -> str | None:
+        text = json.loads('"' + "".join(self.buffer) + '"')
+        if self.is_key:
+            if len(self.stack) == 1:
+                self.last_key = text
+            return None
+        if len(self.stack) == 1 and self.last_key == self.field:
+            self.value = text
+            return text
+        return None
+
+
+def get_local_llm() -> Llama:
+    global _LOCAL_LLM
+    with _LOCAL_LLM_LOAD_LOCK:
+        if _LOCAL_LLM is None:
+            if not Path(LOCAL_MODEL_PATH).exists():
+                raise RuntimeError(
+                    f"No se encontró el modelo local en {LOCAL_MODEL_PATH}."
+                )
+            _LOCAL_LLM = Llama(
+                model_path=LOCAL_MODEL_PATH,
+                n_ctx=N_CTX,
+                n_threads=N_THREADS,
+                use_mlock=MODEL_MLOCK,
+            )
+    return _LOCAL_LLM
+
+
+def prompt_fingerprint(system_prompt: str) -> str:
+    return hashlib.sha1(system_prompt.encode("utf-8")).hexdigest()
+
+
+def load_prefix_state(llm: Llama, role: str, system_prompt: str) -> None:
+    # Llama.generate reutiliza el prefijo común entre los tokens cargados y el
+    # prompt nuevo, así que basta con dejar el KV del prompt de sistema del rol
+    # en el contexto para evaluar solo el JSON de la petición.
+    global _ACTIVE_PREFIX, _ACTIVE_SESSION
+    _ACTIVE_SESSION = None
+    if role in _STALE_PREFIXES:
+        _STALE_PREFIXES.discard(role)
+        _PREFIX_STATES.pop(role, None)
+        if _ACTIVE_PREFIX and _ACTIVE_PREFIX[0] == role:
+            _ACTIVE_PREFIX = None
+    if not PREFIX_CACHE_ENABLED:
+        return
+    fingerprint = prompt_fingerprint(system_prompt)
+    if _ACTIVE_PREFIX == (role, fingerprint):
+        return
+    cached = _PREFIX_STATES.get(role)
+    if cached and cached[0] == fingerprint:
+        llm.load_state(cached[1])
+    else:
+        llm.reset()
+        llm.create_chat_completion(
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": ""},
+            ],
+            temperature=0,
+            max_tokens=1,
+        )
+        _PREFIX_STATES[role] = (fingerprint, llm.save_state())
+    _ACTIVE_PREFIX = (role, fingerprint)
+
+
+def invalidate_prefix_state(role: str) -> None:
+    # Sin _LOCAL_LLM_LOCK: guardar en /admin no espera a que termine la
+    # generación en curso. load_prefix_state descarta el estado, ya con el lock.
+    _STALE_PREFIXES.add(role)
+
+
+def get_role_grammar(role: str) -> LlamaGrammar:
+    # Compilar el esquema a GBNF es caro; el esquema solo depende del rol.
+    grammar = _ROLE_GRAMMARS.get(role)
+    if grammar is None:
+        grammar = LlamaGrammar.from_json_schema(
+            json.dumps(mml_output_schema(role)), verbose=False
+        )
+        _ROLE_GRAMMARS[role] = grammar
+    return grammar
+
+
+PROMPT_TOKENS_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096)
+CHAT_SUMMARY_PROMPT_TOKENS = Histogram(PROMPT_TOKENS_BUCKETS)
+CHAT_SUMMARY_SECONDS = Histogram(WAIT_SECONDS_BUCKETS)
+
+
+def in_chat_summary_hours() -> bool:
+    if not CHAT_SUMMARY_HOURS:
+        return True
+    start, end = (int(hour) for hour in CHAT_SUMMARY_HOURS.split("-", 1))
+    hour = datetime.now(ZoneInfo(DEFAULT_TIMEZONE)).hour
+    if start <= end:
+        return start <= hour <= end
+    return hour >= start or hour <= end
+
+
+def chat_summary_candidates(limit: int) -> list[sqlite3.Row]:
+    # Productores con al menos CHAT_SUMMARY_MIN_MESSAGES mensajes más viejos
+    # que los CHAT_SUMMARY_KEEP que ya van crudos en el contexto.
+    return get_db().execute(
+        """
+        SELECT producers.id AS producer_id,
+               COALESCE(chat_summaries.last_message_id, 0) AS watermark,
+               chat_summaries.summary
+        FROM producers
+        LEFT JOIN chat_summaries ON chat_summaries.producer_id = producers.id
+        WHERE (
+            SELECT COUNT(*)
+            FROM messages
+            WHERE messages.producer_id = producers.id
+              AND messages.id > COALESCE(chat_summaries.last_message_id, 0)
+        ) >= ?
+        ORDER BY producers.id
+        LIMIT ?
+        """,
+        (CHAT_SUMMARY_KEEP + CHAT_SUMMARY_MIN_MESSAGES, limit),
+    ).fetchall()
+
+
+def messages_to_summarize(producer_id: int, watermark: int) -> list[sqlite3.Row]:
+    # Hasta el mensaje que queda justo antes de los CHAT_SUMMARY_KEEP más
+    # nuevos (NULL si no hay tantos: nada que resumir).
+    return get_db().execute(
+        """
+        SELECT id, direction, content
+        FROM messages
+        WHERE producer_id = :producer_id AND id > :watermark
+          AND id <= (
+              SELECT id FROM messages
+              WHERE producer_id = :producer_id
+              ORDER BY id DESC
+              LIMIT 1 OFFSET :keep
+          )
+        ORDER BY id
+        LIMIT :batch
+        """,
+        {
+            "producer_id": producer_id,
+            "watermark": watermark,
+            "keep": CHAT_SUMMARY_KEEP,
+            "batch": CHAT_SUMMARY_BATCH,
+        },
+    ).fetchall()
+
+
+def generate_chat_summary(
+    previous: str | None, lines: list[str]
+) -> tuple[str, dict[str, int]]:
+    start = time.perf_counter()
+    if MODEL_API_URL:
+        # Como run_mml: con el modelo en el servicio 1 este proceso no lo
+        # carga. El resumen y los mensajes van como "hist" y "chat".
+        context = {"role": "resumen", "chat_summary": previous, "recent_chat": lines}
+        response = post_model_api(
+            "/chat", CHAT_SUMMARY_PROMPT, context, CHAT_SUMMARY_MAX_TOKENS, None
+        )
+        response.raise_for_status()
+        data = response.json()
+        elapsed = time.perf_counter() - start
+        usage = data.get("usage") or {}
+        content = data.get("content")
+    else:
+        parts = [f"Resumen anterior:\n{previous}"] if previous else []
+        parts.append("Mensajes:\n" + "\n".join(lines))
+        llm = get_local_llm()
+        with _LOCAL_LLM_LOCK:
+            # El prompt de resumen deja su propio prefijo; el próximo turno
+            # recarga el de su rol desde _PREFIX_STATES.
+            load_prefix_state(llm, "resumen", CHAT_SUMMARY_PROMPT)
+            start = time.perf_counter()
+            response = llm.create_chat_completion(
+                messages=[
+                    {"role": "system", "content": CHAT_SUMMARY_PROMPT},
+                    {"role": "user", "content": "\n\n".join(parts)},
+                ],
+                temperature=0.2,
+                max_tokens=CHAT_SUMMARY_MAX_TOKENS,
+            )
+            elapsed = time.perf_counter() - start
+        usage = response.get("usage") or {}
+        content = response["choices"][0]["message"]["content"]
+    metrics = {
+        "prompt_tokens": int(usage.get("prompt_tokens", 0)),
+        "completion_tokens": int(usage.get("completion_tokens", 0)),
+        "generation_ms": int(1000 * elapsed),
+    }
+    return (content or "").strip(), metrics
+
+
+def summarize_producer_chat(candidate: sqlite3.Row) -> dict[str, int] | None:
+    rows = messages_to_summarize(candidate["producer_id"], candidate["watermark"])
+    if not rows:
+        return None
+    lines = compact_chat([f"{row['direction']}: {row['content']}" for row in rows])
+    # El modelo corre fuera de la transacción; la escritura solo avanza la
+    # marca de agua si nadie la movió mientras tanto.
+    summary, metrics = generate_chat_summary(candidate["summary"], lines)
+    if not summary:
+        return None
+    with write_transaction() as db:
+        db.execute(
+            """
+            INSERT INTO chat_summaries (
+                producer_id, summary, last_message_id, messages_summarized,
+                prompt_tokens, completion_tokens, generation_ms, updated_at
+            )
+            VALUES (:producer_id, :summary, :last_id, :count,
+                    :prompt_tokens, :completion_tokens, :generation_ms, :now)
+            ON CONFLICT(producer_id) DO UPDATE
+            SET summary = excluded.summary,
+                last_message_id = excluded.last_message_id,
+                messages_summarized = chat_summaries.messages_summarized
+                                      + excluded.messages_summarized,
+                prompt_tokens = excluded.prompt_tokens,
+                completion_tokens = excluded.completion_tokens,
+                generation_ms = excluded.generation_ms,
+                updated_at = excluded.updated_at
+            WHERE chat_summaries.last_message_id = :watermark
+            """,
+            {
+                "producer_id": candidate["producer_id"],
+                "summary": summary,
+                "last_id": rows[-1]["id"],
+                "count": len(rows),
+                "watermark": candidate["watermark"],
+                "now": utc_now(),
+            }
+            | metrics,
+        )
+    CHAT_SUMMARY_PROMPT_TOKENS.observe(metrics["prompt_tokens"])
+    CHAT_SUMMARY_SECONDS.observe(metrics["generation_ms"] / 1000)
+    app.logger.info(
+        "resumen de chat %s: %s mensajes, %s tokens de prompt, %s generados en %s ms",
+        candidate["producer_id"],
+        len(rows),
+        metrics["prompt_tokens"],
+        metrics["completion_tokens"],
+        metrics["generation_ms"],
+    )
+    return metrics | {"messages": len(rows)}
+
+
+def summarize_chats(limit: int) -> dict[str, int]:
+    totals = {
+        "producers": 0,
+        "messages": 0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "generation_ms": 0,
+    }
+    for candidate in chat_summary_candidates(limit):
+        result = summarize_producer_chat(candidate)
+        if result:
+            totals["producers"] += 1
+            for key in ("messages", "prompt_tokens", "completion_tokens", "generation_ms"):
+                totals[key] += result[key]
+    return totals
+
+
+@app.cli.command("summarize-chats")
+@click.option("--limit", default=200, show_default=True, help="Productores por corrida.")
+@click.option("--force", is_flag=True, help="Corre fuera de CHAT_SUMMARY_HOURS.")
+def summarize_chats_command(limit: int, force: bool) -> None:
+    # Tarea fuera de horario: condensa los mensajes viejos de cada productor
+    # en chat_summaries. Se puede repetir; cada productor retoma desde su
+    # marca de agua.
+    if not force and not in_chat_summary_hours():
+        click.echo(f"fuera de CHAT_SUMMARY_HOURS ({CHAT_SUMMARY_HOURS}); usa --force")
+        return
+    migrate_db()
+    totals = summarize_chats(limit)
+    seconds = totals["generation_ms"] / 1000
+    click.echo(
+        f"{totals['producers']} productores, {totals['messages']} mensajes, "
+        f"{totals['prompt_tokens']} tokens de prompt, "
+        f"{totals['completion_tokens']} generados en {seconds:.1f} s"
+    )
+    if totals["producers"]:
+        prompt_tokens = CHAT_SUMMARY_PROMPT_TOKENS.stats()
+        generation = CHAT_SUMMARY_SECONDS.stats()
+        click.echo(
+            f"tokens de prompt p50 {prompt_tokens['p50']} p99 {prompt_tokens['p99']}; "
+            f"generación p50 {generation['p50']} s p99 {generation['p99']} s; "
+            f"{totals['completion_tokens'] / max(seconds, 0.001):.1f} tokens/s"
+        )
+
+
+def get_agent_config(role: str) -> dict[str, Any]:
+    db = get_db()
+    row = db.execute("SELECT * FROM agent_configs WHERE role = ?", (role,)).fetchone()
+    if row:
+        return dict(row)
+    return {"role": role, "enabled": 1, "prompt": PROMPTS[role], "max_tokens": 300}
+
+
+def apply_model_actions(
+    snapshot: TurnSnapshot, model_output: dict[str, Any]
+) -> dict[str, Any]:
+    producer = snapshot.producer
+    actions = model_output.get("acciones", {})
+    updates = actions.get("actualizar_formulario", {})
+    db = get_db()
+    if updates:
+        valid = {
+            "cultivo": updates.get("cultivo"),
+            "sintoma": updates.get("sintoma"),
+            "inicio_problema": updates.get("inicio_problema"),
+            "foto_recibida": updates.get("foto_recibida"),
+        }
+        if valid["foto_recibida"] is not None:
+            valid["foto_recibida"] = int(bool(valid["foto_recibida"]))
+        # Solo se escriben los campos que trae el modelo: lo guardado mientras
+        # generaba (/form/update, el panel u otro turno) se conserva.
+        form = db.execute(
+            """
+            UPDATE forms
+            SET cultivo = COALESCE(?, cultivo),
+                sintoma = COALESCE(?, sintoma),
+                inicio_problema = COALESCE(?, inicio_problema),
+                foto_recibida = COALESCE(?, foto_recibida),
+                updated_at = ?
+            WHERE id = ?
+            RETURNING cultivo
+            """,
+            (
+                valid["cultivo"],
+                valid["sintoma"],
+                valid["inicio_problema"],
+                valid["foto_recibida"],
+                utc_now(),
+                snapshot.form_state["id"],
+            ),
+        ).fetchone()
+        # Un síntoma repetido en cada turno del formulario no es una vez más.
+        new_symptom = valid["sintoma"] and valid["sintoma"] != snapshot.form_state.get("sintoma")
+        if new_symptom and form is not None:
+            record_weekly_event(
+                producer["id"], {}, symptom_label(form["cultivo"], valid["sintoma"])
+            )
+    alert = actions.get("alerta")
+    if alert:
+        db.execute(
+            """
+            INSERT INTO alerts (producer_id, level, reason, action, message, status, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                producer["id"],
+                alert.get("nivel", "medio"),
+                alert.get("motivo", "sin motivo"),
+                alert.get("accion_recomendada", "sin accion"),
+                model_output.get("respuesta_chat", ""),
+                "abierta",
+                utc_now(),
+            ),
+        )
+        record_weekly_event(
+            producer["id"], {"alertas": 1, "alertas_altas": int(alert.get("nivel") == "alto")}
+        )
+    bitacora = actions.get("bitacora")
+    if bitacora:
+        plan = snapshot.active_plan
+        log_date = bitacora.get("fecha") or date.today().isoformat()
+        notes = bitacora.get("notas") or ""
+        metrics = bitacora.get("metricas") or {}
+        log_type_id = bitacora.get("log_type_id")
+        save_daily_log(
+            producer_id=producer["id"],
+            plan_id=plan["plan_id"] if plan else None,
+            log_type_id=int(log_type_id) if log_type_id else None,
+            log_date=log_date,
+            notes=notes,
+            metrics=metrics,
+            commit=False,
+        )
+    tarea = actions.get("actualizar_tarea")
+    if tarea:
+        status = tarea.get("status")
+        task_id = tarea.get("task_id")
+        if not task_id or not status:
+            raise RuntimeError("actualizar_tarea requiere task_id y status.")
+        update_task_status(
+            task_id=int(task_id),
+            status=str(status),
+            progress_pct=tarea.get("avance"),
+            blocker_reason=tarea.get("motivo"),
+            commit=False,
+        )
+    return model_output
+
+
+# sin_cargar | cargando | listo | error, con los tiempos de carga y calentamiento.
+_READINESS: dict[str, Any] = {"status": "sin_cargar"}
+_READINESS_LOCK = threading.Lock()
+
+
+def warm_up_local(prompts: dict[str, str]) -> dict[str, dict[str, float]]:
+    # Una generación corta por rol: lee los pesos desde el mmap y deja en
+    # _PREFIX_STATES el prefijo KV de cada rol para su primer turno.
+    llm = get_local_llm()
+    timings: dict[str, dict[str, float]] = {}
+    for role, prompt in prompts.items():
+        with _LOCAL_LLM_LOCK:
+            start = time.perf_counter()
+            load_prefix_state(llm, role, prompt)
+            first_token = None
+            for chunk in llm.create_chat_completion(
+                messages=[
+                    {"role": "system", "content": prompt},
+                    {"role": "user", "content": "hola"},
+                ],
+                temperature=0,
+                max_tokens=WARMUP_MAX_TOKENS,
+                stream=True,
+            ):
+                if first_token is None and chunk["choices"][0]["delta"].get("content"):
+                    first_token = time.perf_counter() - start
+            total = time.perf_counter() - start
+        if first_token is None:
+            first_token = total
+        timings[role] = {
+            "first_token_ms": round(1000 * first_token, 1),
+            "total_ms": round(1000 * total, 1),
+        }
+        app.logger.info(
+            "calentamiento %s: primer token en %.0f ms, total %.0f ms",
+            role,
+            1000 * first_token,
+            1000 * total,
+        )
+    return timings
+
+
+def warm_up_model_api(prompts: dict[str, str]) -> dict[str, dict[str, float]]:
+    session = get_model_api_session()
+    deadline = time.monotonic() + MODEL_API_READY_TIMEOUT
+    while True:
+        try:
+            if session.get(f"{MODEL_API_URL}/health/ready", timeout=5).ok:
+                break
+        except requests.RequestException:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError(
+                f"El servicio del modelo no estuvo listo en {MODEL_API_READY_TIMEOUT} s."
+            )
+        time.sleep(2)
+    response = session.post(
+        f"{MODEL_API_URL}/warmup", json={"prompts": prompts}, timeout=MODEL_API_READY_TIMEOUT
+    )
+    response.raise_for_status()
+    timings = response.json()["warmup"]
+    for role, timing in timings.items():
+        app.logger.info(
+            "calentamiento remoto %s: primer token en %.0f ms, total %.0f ms",
+            role,
+            timing["first_token_ms"],
+            timing["total_ms"],
+        )
+    return timings
+
+
+def start_model() -> None:
+    with _READINESS_LOCK:
+        _READINESS["status"] = "cargando"
+    try:
+        with app.app_context():
+            prompts = {role: get_agent_config(role)["prompt"] for role in PROMPTS}
+        start = time.perf_counter()
+        if MODEL_API_URL:
+            timings = warm_up_model_api(prompts)
+        else:
+            get_local_llm()
+            app.logger.info(
+                "modelo local cargado en %.2f s (mlock %s)",
+                time.perf_counter() - start,
+                MODEL_MLOCK,
+            )
+            timings = warm_up_local(prompts)
+    except Exception as exc:
+        app.logger.exception("no se pudo preparar el modelo")
+        with _READINESS_LOCK:
+            _READINESS.update(status="error", error=str(exc))
+        return
+    with _READINESS_LOCK:
+        _READINESS.update(
+            status="listo",
+            ready_seconds=round(time.perf_counter() - start, 2),
+            warmup=timings,
+        )
+
+
+@app.get("/health")
+@app.get("/health/live")
+def health() -> Any:
+    return jsonify({"status": "ok", "time": utc_now()})
+
+
+@app.get("/health/ready")
+def health_ready() -> Any:
+    # Sin carga anticipada el modelo se prepara en el primer turno, como
+    # antes; basta con que la base responda.
+    with _READINESS_LOCK:
+        state = dict(_READINESS)
+    ready = state["status"] == "listo" or (
+        not MODEL_EAGER_LOAD and state["status"] != "error"
+    )
+    try:
+        get_db().execute("SELECT 1")
+    except sqlite3.Error as exc:
+        ready = False
+        state["database_error"] = str(exc)
+    return jsonify(state | {"ready": ready}), 200 if ready else 503
+
+
+class AgentTurnError(Exception):
+    def __init__(self, message: str, status: int) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+_IDEMPOTENCY_LOCK = threading.Lock()
+_IDEMPOTENCY_PURGED_AT = 0.0
+IDEMPOTENCY_COUNTS = {"claimed": 0, "replayed": 0, "in_progress": 0, "purged": 0}
+
+
+def idempotency_key(payload: dict[str, Any]) -> str | None:
+    key = request.headers.get("Idempotency-Key") or payload.get("message_id")
+    return str(key)[:200] if key else None
+
+
+def purge_inbound_keys(db: sqlite3.Connection, now: str) -> None:
+    # A lo más una vez por IDEMPOTENCY_PURGE_SECONDS y por lotes, para no
+    # alargar la transacción de un turno.
+    global _IDEMPOTENCY_PURGED_AT
+    with _IDEMPOTENCY_LOCK:
+        if time.monotonic() - _IDEMPOTENCY_PURGED_AT < IDEMPOTENCY_PURGE_SECONDS:
+            return
+        _IDEMPOTENCY_PURGED_AT = time.monotonic()
+    purged = db.execute(
+        """
+        DELETE FROM inbound_keys
+        WHERE rowid IN (
+            SELECT rowid FROM inbound_keys WHERE expires_at < ? LIMIT 1000
+        )
+        """,
+        (now,),
+    ).rowcount
+    with _IDEMPOTENCY_LOCK:
+        IDEMPOTENCY_COUNTS["purged"] += purged
+
+
+def claim_inbound_key(route: str, key: str) -> sqlite3.Row | None:
+    # None: la clave es nueva (o venció) y este request procesa el mensaje.
+    # Si no, la fila guardada: completada con su respuesta, o en proceso.
+    now = datetime.now(timezone.utc)
+    with write_transaction() as db:
+        purge_inbound_keys(db, now.isoformat())
+        claimed = db.execute(
+            """
+            INSERT INTO inbound_keys (key, route, status, lease_until, expires_at, created_at)
+            VALUES (:key, :route, 'en_proceso', :lease_until, :expires_at, :now)
+            ON CONFLICT (key, route) DO UPDATE SET
+                status = 'en_proceso', response_status = NULL, response_json = NULL,
+                message_saved = inbound_keys.message_saved
+                    AND inbound_keys.expires_at >= :now,
+                lease_until = excluded.lease_until, expires_at = excluded.expires_at,
+                created_at = excluded.created_at
+            WHERE inbound_keys.expires_at < :now
+               OR inbound_keys.status = 'reintentable'
+               OR (inbound_keys.status = 'en_proceso' AND inbound_keys.lease_until < :now)
+            RETURNING message_saved
+            """,
+            {
+                "key": key,
+                "route": route,
+                "now": now.isoformat(),
+                "lease_until": (now + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)).isoformat(),
+                "expires_at": (now + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS)).isoformat(),
+            },
+        ).fetchone()
+        stored = None
+        if claimed:
+            # El turno lo lee al armar su foto (ver start_agent_turn).
+            g.inbound_key = (route, key)
+            g.inbound_saved = bool(claimed["message_saved"])
+        else:
+            stored = db.execute(
+                """
+                UPDATE inbound_keys SET duplicates = duplicates + 1
+                WHERE key = ? AND route = ?
+                RETURNING status, response_status, response_json
+                """,
+                (key, route),
+            ).fetchone()
+    with _IDEMPOTENCY_LOCK:
+        if stored is None:
+            IDEMPOTENCY_COUNTS["claimed"] += 1
+        elif stored["status"] == "en_proceso":
+            IDEMPOTENCY_COUNTS["in_progress"] += 1
+        else:
+            IDEMPOTENCY_COUNTS["replayed"] += 1
+    return stored
+
+
+def is_transient_response(status: int, body: Any) -> bool:
+    # Cola llena, tiempo agotado, 5xx y la respuesta fija del límite de
+    # turnos: el reintento tiene que volver a procesar el mensaje.
+    if status in (409, 429) or status >= 500:
+        return True
+    model_output = body.get("model_output") if isinstance(body, dict) else None
+    return bool(isinstance(model_output, dict) and model_output.get("rate_limited"))
+
+
+def complete_inbound_key(route: str, key: str, status: int, body: Any) -> None:
+    # Una respuesta transitoria libera la clave sin borrarla, para conservar
+    # message_saved. Solo se guardan los campos que recibe el cliente.
+    with write_transaction() as db:
+        if is_transient_response(status, body):
+            db.execute(
+                """
+                UPDATE inbound_keys SET status = 'reintentable'
+                WHERE key = ? AND route = ? AND status = 'en_proceso'
+                """,
+                (key, route),
+            )
+            return
+        if isinstance(body, dict):
+            body = {field: value for field, value in body.items() if field != "context"}
+        db.execute(
+            """
+            UPDATE inbound_keys
+            SET status = 'completado', response_status = ?, response_json = ?
+            WHERE key = ? AND route = ?
+            """,
+            (status, json.dumps(body, ensure_ascii=False), key, route),
+        )
+
+
+def duplicate_response(stored: sqlite3.Row) -> Any:
+    if stored["status"] == "en_proceso":
+        return jsonify({"error": "mensaje en proceso", "duplicate": True}), 409
+    response = make_response(stored["response_json"], stored["response_status"])
+    response.mimetype = "application/json"
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+def idempotent(view: Callable[[], Any]) -> Callable[[], Any]:
+    # Un reintento con la misma clave recibe la respuesta guardada del
+    # primero, sin volver a guardar el mensaje ni llamar al modelo.
+    @wraps(view)
+    def wrapper() -> Any:
+        key = idempotency_key(request.get_json(force=True) or {})
+        if not key:
+            return view()
+        stored = claim_inbound_key(request.path, key)
+        if stored is not None:
+            return duplicate_response(stored)
+        try:
+            response = make_response(view())
+        except BaseException:
+            complete_inbound_key(request.path, key, 500, None)
+            raise
+        complete_inbound_key(request.path, key, response.status_code, response.get_json())
+        return response
+
+    return wrapper
+
+
+def start_agent_turn(
+    payload: dict[str, Any],
+) -> tuple[TurnSnapshot, str, dict[str, Any]]:
+    role = payload.get("role")
+    phone = payload.get("phone")
+    message = payload.get("message", "")
+
+    if not phone:
+        raise AgentTurnError("phone requerido", 400)
+
+    started = time.perf_counter()
+    snapshot = load_turn_snapshot(phone)
+    producer = snapshot.producer
+    role = role or producer.get("assigned_role") or "formulario"
+    if role not in PROMPTS:
+        raise AgentTurnError("role invalido", 400)
+    AGENT_STAGE_SECONDS.observe(time.perf_counter() - started, "snapshot", role)
+
+    # El mensaje entrante se guarda junto con el resto del turno, en la
+    # transacción de finish_agent_turn (o solo, si el turno falla).
+    snapshot.message = message
+    snapshot.received_at = utc_now()
+    snapshot.inbound_key = g.get("inbound_key")
+    snapshot.inbound_saved = g.get("inbound_saved", False)
+    if not snapshot.inbound_saved:
+        # Si no, ya está en la foto desde el intento anterior.
+        snapshot.add_chat("usuario", message)
+
+    with AGENT_STAGE_SECONDS.time("build_context", role):
+        context = build_context(role, phone, message, snapshot)
+    denied = turn_denied_reason(producer, role)
+    if denied:
+        save_inbound_message(snapshot)
+        raise AgentTurnError(denied, 403)
+    return snapshot, role, context
+
+
+def start_ingest_turn(payload: dict[str, Any]) -> tuple[TurnSnapshot, str]:
+    # /ingest solo valida y guarda el mensaje: la foto completa y el contexto
+    # los arma el worker al procesar el turno. Basta el productor.
+    phone = payload.get("phone")
+    if not phone:
+        raise AgentTurnError("phone requerido", 400)
+    producer = get_or_create_producer(phone)
+    role = payload.get("role") or producer.get("assigned_role") or "formulario"
+    if role not in PROMPTS:
+        raise AgentTurnError("role invalido", 400)
+    snapshot = TurnSnapshot(
+        producer=producer,
+        form_state={},
+        active_plan=None,
+        daily_logs=[],
+        recent_chat=[],
+        active_task=None,
+        weekly_days={},
+        chat_summary=None,
+        message=payload.get("message", ""),
+        received_at=utc_now(),
+    )
+    denied = turn_denied_reason(producer, role)
+    if denied:
+        save_inbound_message(snapshot)
+        raise AgentTurnError(denied, 403)
+    return snapshot, role
+
+
+def turn_denied_reason(producer: dict[str, Any], role: str) -> str | None:
+    agent_config = get_agent_config(role)
+    if not producer.get("allowed"):
+        return "productor no autorizado"
+    if producer.get("status") != "activo":
+        return "productor inactivo"
+    if not agent_config.get("enabled"):
+        return f"agente {role} desactivado"
+    if role == "formulario" and not producer.get("enable_formulario"):
+        return "agente formulario desactivado"
+    if role == "consulta" and not producer.get("enable_consulta"):
+        return "agente consulta desactivado"
+    if role == "intervencion" and not producer.get("enable_intervencion"):
+        return "agente intervencion desactivado"
+    return None
+
+
+def insert_inbound_message(snapshot: TurnSnapshot) -> None:
+    if snapshot.inbound_saved:
+        return
+    db = get_db()
+    db.execute(
+        """
+        INSERT INTO messages (producer_id, direction, content, status, created_at)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        (
+            snapshot.producer["id"],
+            "usuario",
+            snapshot.message,
+            "recibido",
+            snapshot.received_at or utc_now(),
+        ),
+    )
+    if snapshot.inbound_key:
+        db.execute(
+            "UPDATE inbound_keys SET message_saved = 1 WHERE route = ? AND key = ?",
+            snapshot.inbound_key,
+        )
+    record_weekly_event(snapshot.producer["id"], {"mensajes": 1})
+
+
+def insert_outbound_message(producer_id: int, content: str, status: str) -> int:
+    row = get_db().execute(
+        """
+        INSERT INTO messages (producer_id, direction, content, status, created_at)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        (producer_id, "asistente", content, status, utc_now()),
+    )
+    return row.lastrowid
+
+
+def save_inbound_message(snapshot: TurnSnapshot) -> None:
+    # Turno fallido: se conserva al menos lo que escribió el productor.
+    with write_transaction():
+        insert_inbound_message(snapshot)
+
+
+def finish_agent_turn(
+    snapshot: TurnSnapshot, model_output: dict[str, Any]
+) -> dict[str, Any]:
+    role = str(model_output.get("role") or snapshot.producer.get("assigned_role") or "formulario")
+    try:
+        with AGENT_STAGE_SECONDS.time("apply_actions", role), write_transaction():
+            insert_inbound_message(snapshot)
+            model_output = apply_model_actions(snapshot, model_output)
+            insert_outbound_message(
+                snapshot.producer["id"], model_output["respuesta_chat"], "enviado"
+            )
+    except Exception:
+        save_inbound_message(snapshot)
+        raise
+    if (model_output.get("acciones") or {}).get("alerta"):
+        PUSH.notify()
+    return model_output
 
 
-_LOCAL_LLM: Llama | None = None
+def sse_event(
+    data: dict[str, Any], event: str | None = None, event_id: str | None = None
+) -> str:
+    prefix = f"id: {event_id}\n" if event_id else ""
+    prefix += f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
 
 
-def call_model_api(system_prompt: str, context: dict[str, Any], max_tokens: int) -> dict[str, Any]:
-    payload = {
-        "system": system_prompt,
-        "context": context,
-        "max_tokens": max_tokens,
-    }
-    response = requests.post(f"{MODEL_API_URL.rstrip('/')}/chat", json=payload, timeout=120)
-    response.raise_for_status()
-    data = response.json()
-    content = data.get("content") or "{}"
+# Respuesta de una petición cuyo mensaje respondió otra de la misma ráfaga.
+COALESCED_RESPONSE = {"coalesced": True, "model_output": None}
+
+
+def coalesced_events() -> str:
+    return sse_event({"coalesced": True}, "agrupado") + sse_event({"model_output": None}, "done")
+
+
+@app.post("/agent")
+@idempotent
+def agent() -> Any:
+    request_started = time.perf_counter()
+    payload = coalesce_payload(request.get_json(force=True))
+    if payload is None:
+        return jsonify(COALESCED_RESPONSE)
     try:
-        return json.loads(content)
-    except json.JSONDecodeError as exc:
-        raise RuntimeError("Respuesta inválida desde la API del modelo.") from exc
+        snapshot, role, context = start_agent_turn(payload)
+    except AgentTurnError as exc:
+        return jsonify({"error": str(exc)}), exc.status
+
+    cache_key = response_cache_key(role, context)
+    cache_version = response_cache_version(role, context)
+    model_output = RESPONSE_CACHE.get(cache_key, cache_version) if cache_key else None
+    if model_output is None:
+        try:
+            model_context = fit_turn_context(role, context)
+            with RATE_LIMITER.admit(snapshot.producer["id"]), MODEL_SCHEDULER.slot(
+                role, request_deadline()
+            ):
+                started = time.perf_counter()
+                model_output = run_mml(role, model_context)
+        except RateLimitedError as exc:
+            # Sin modelo ni acciones: solo queda el mensaje del productor. La
+            # clave de idempotencia no se completa (is_transient_response).
+            save_inbound_message(snapshot)
+            return jsonify({"context": context, "model_output": rate_limited_output(role, exc)})
+        except ModelQueueError as exc:
+            save_inbound_message(snapshot)
+            return jsonify({"error": str(exc)}), exc.status
+        except Exception:
+            save_inbound_message(snapshot)
+            raise
+        if cache_key and is_cacheable_output(model_output):
+            RESPONSE_CACHE.put(
+                cache_key, cache_version, model_output, time.perf_counter() - started
+            )
+    model_output = finish_agent_turn(snapshot, model_output)
+    AGENT_REQUEST_SECONDS.observe(time.perf_counter() - request_started, "/agent", role)
+
+    return jsonify({"context": context, "model_output": model_output})
 
 
-def get_local_llm() -> Llama:
-    global _LOCAL_LLM
-    if _LOCAL_LLM is None:
-        if not Path(LOCAL_MODEL_PATH).exists():
-            raise RuntimeError(
-                f"No se encontró el modelo local en {LOCAL_MODEL_PATH}."
+@app.post("/agent/stream")
+def agent_stream() -> Any:
+    # Envía respuesta_chat como evento SSE apenas el modelo cierra ese campo;
+    # las acciones se aplican después, con el documento JSON completo.
+    request_started = time.perf_counter()
+    payload = request.get_json(force=True)
+    key = idempotency_key(payload)
+    if key:
+        stored = claim_inbound_key(request.path, key)
+        if stored is not None and stored["response_status"] == 200:
+            # Repetición de un turno ya terminado: mismos eventos, sin modelo.
+            model_output = json.loads(stored["response_json"])["model_output"]
+            if model_output is None:
+                return Response(coalesced_events(), mimetype="text/event-stream")
+            replay = sse_event(
+                {"respuesta_chat": model_output.get("respuesta_chat", "")}, "respuesta_chat"
+            ) + sse_event({"model_output": model_output}, "done")
+            return Response(replay, mimetype="text/event-stream")
+        if stored is not None:
+            return duplicate_response(stored)
+    try:
+        coalesced = coalesce_payload(payload)
+        if coalesced is None:
+            if key:
+                complete_inbound_key(request.path, key, 200, COALESCED_RESPONSE)
+            return Response(coalesced_events(), mimetype="text/event-stream")
+        snapshot, role, context = start_agent_turn(coalesced)
+    except AgentTurnError as exc:
+        if key:
+            complete_inbound_key(request.path, key, exc.status, {"error": str(exc)})
+        return jsonify({"error": str(exc)}), exc.status
+    except BaseException:
+        if key:
+            complete_inbound_key(request.path, key, 500, None)
+        raise
+
+    cache_key = response_cache_key(role, context)
+    cache_version = response_cache_version(role, context)
+    cached = RESPONSE_CACHE.get(cache_key, cache_version) if cache_key else None
+    deadline = request_deadline()
+    finished: dict[str, Any] = {}
+
+    def events() -> Iterator[str]:
+        model_output = cached
+        if model_output is None:
+            extractor = JSONFieldExtractor("respuesta_chat")
+            pieces: list[str] = []
+            try:
+                model_context = fit_turn_context(role, context)
+                # El slot se libera también si el cliente corta el stream.
+                with RATE_LIMITER.admit(snapshot.producer["id"]), MODEL_SCHEDULER.slot(
+                    role, deadline
+                ):
+                    started = time.perf_counter()
+                    for piece in stream_mml(role, model_context):
+                        pieces.append(piece)
+                        reply = extractor.feed(piece)
+                        if reply is not None:
+                            yield sse_event({"respuesta_chat": reply}, "respuesta_chat")
+                model_output = json.loads("".join(pieces) or "{}")
+            except RateLimitedError as exc:
+                save_inbound_message(snapshot)
+                model_output = rate_limited_output(role, exc)
+                finished["model_output"] = model_output
+                yield sse_event({"respuesta_chat": exc.reply}, "respuesta_chat")
+                yield sse_event({"model_output": model_output}, "done")
+                return
+            except json.JSONDecodeError:
+                save_inbound_message(snapshot)
+                yield sse_event({"error": "Respuesta inválida desde el modelo."}, "error")
+                return
+            except Exception as exc:
+                save_inbound_message(snapshot)
+                yield sse_event({"error": str(exc)}, "error")
+                return
+            if extractor.value is None:
+                yield sse_event(
+                    {"respuesta_chat": model_output.get("respuesta_chat", "")},
+                    "respuesta_chat",
+                )
+            if cache_key and is_cacheable_output(model_output):
+                RESPONSE_CACHE.put(
+                    cache_key, cache_version, model_output, time.perf_counter() - started
+                )
+        else:
+            yield sse_event(
+                {"respuesta_chat": model_output.get("respuesta_chat", "")},
+                "respuesta_chat",
             )
-        _LOCAL_LLM = Llama(
-            model_path=LOCAL_MODEL_PATH,
-            n_ctx=N_CTX,
-            n_threads=N_THREADS,
+        try:
+            model_output = finish_agent_turn(snapshot, model_output)
+        except Exception as exc:
+            yield sse_event({"error": str(exc)}, "error")
+            return
+        finished["model_output"] = model_output
+        AGENT_REQUEST_SECONDS.observe(
+            time.perf_counter() - request_started, "/agent/stream", role
         )
-    return _LOCAL_LLM
+        yield sse_event({"model_output": model_output}, "done")
+
+    def keyed_events() -> Iterator[str]:
+        # También si el cliente corta: sin turno terminado la clave se libera.
+        try:
+            yield from events()
+        finally:
+            if finished:
+                complete_inbound_key("/agent/stream", key, 200, finished)
+            else:
+                complete_inbound_key("/agent/stream", key, 500, None)
 
+    stream = keyed_events() if key else events()
+    return Response(stream_with_context(stream), mimetype="text/event-stream")
 
-def get_agent_config(role: str) -> dict[str, Any]:
-    db = get_db()
-    row = db.execute("SELECT * FROM agent_configs WHERE role = ?", (role,)).fetchone()
-    if row:
-        return dict(row)
-    return {"role": role, "enabled": 1, "prompt": PROMPTS[role], "max_tokens": 300}
 
+JOB_FAILED_REPLY = "Ocurrió un error al procesar tu mensaje. Intenta más tarde."
 
-def apply_model_actions(phone: str, model_output: dict[str, Any]) -> dict[str, Any]:
-    producer = get_or_create_producer(phone)
-    form = get_or_create_form(producer["id"])
-    actions = model_output.get("acciones", {})
-    updates = actions.get("actualizar_formulario", {})
-    if updates:
-        db = get_db()
-        valid = {
-            "cultivo": updates.get("cultivo"),
-            "sintoma": updates.get("sintoma"),
-            "inicio_problema": updates.get("inicio_problema"),
-            "foto_recibida": updates.get("foto_recibida"),
-        }
-        for key, value in valid.items():
-            if value is not None:
-                form[key] = value
+
+def claim_agent_job() -> dict[str, Any] | None:
+    now = datetime.now(timezone.utc)
+    failed = False
+    with write_transaction() as db:
+        # Un trabajo cuyo worker murió sin terminar cuenta como intento
+        # fallido al vencer su lease: si tumba al worker cada vez, termina en
+        # fallido y no bloquea para siempre los turnos siguientes del productor.
+        expired = db.execute(
+            """
+            SELECT * FROM agent_jobs
+            WHERE status = 'en_proceso' AND locked_at < ?
+            """,
+            ((now - timedelta(seconds=AGENT_JOB_LEASE_SECONDS)).isoformat(),),
+        ).fetchall()
+        for job in expired:
+            failed = mark_agent_job_failed(dict(job), "lease vencido", now) or failed
+        # Orden por productor: no se toma un trabajo mientras haya uno
+        # anterior del mismo productor pendiente (p. ej. esperando reintento)
+        # o en proceso.
+        rows = db.execute(
+            """
+            UPDATE agent_jobs
+            SET status = 'en_proceso', locked_at = :now, updated_at = :now,
+                attempts = attempts + 1
+            WHERE id = (
+                SELECT job.id
+                FROM agent_jobs AS job
+                WHERE job.status = 'pendiente'
+                  AND job.available_at <= :now
+                  AND NOT EXISTS (
+                      SELECT 1 FROM agent_jobs AS earlier
+                      WHERE earlier.producer_id = job.producer_id
+                        AND earlier.status IN ('pendiente', 'en_proceso')
+                        AND earlier.id < job.id
+                  )
+                ORDER BY job.id
+                LIMIT 1
+            )
+            RETURNING *
+            """,
+            {"now": now.isoformat()},
+        ).fetchall()
+    if failed:
+        PUSH.notify()
+    return dict(rows[0]) if rows else None
+
+
+def process_agent_job(job: dict[str, Any]) -> None:
+    # El mensaje entrante ya quedó guardado en /ingest, así que la foto lo
+    # incluye en recent_chat.
+    role = job["role"]
+    request_started = time.perf_counter()
+    snapshot = load_turn_snapshot(job["phone"])
+    AGENT_STAGE_SECONDS.observe(time.perf_counter() - request_started, "snapshot", role)
+    with AGENT_STAGE_SECONDS.time("build_context", role):
+        context = build_context(role, job["phone"], job["message"], snapshot)
+    context = fit_turn_context(role, context)
+    try:
+        with RATE_LIMITER.admit(snapshot.producer["id"]), MODEL_SCHEDULER.slot(role):
+            model_output = run_mml(role, context)
+    except RateLimitedError as exc:
+        # La respuesta fija sale por el outbox como cualquier otra.
+        model_output = rate_limited_output(role, exc)
+    with AGENT_STAGE_SECONDS.time("apply_actions", role), write_transaction() as db:
+        model_output = apply_model_actions(snapshot, model_output)
+        message_id = insert_outbound_message(
+            snapshot.producer["id"], model_output["respuesta_chat"], "pendiente"
+        )
         db.execute(
             """
-            UPDATE forms
-            SET cultivo = ?, sintoma = ?, inicio_problema = ?, foto_recibida = ?, updated_at = ?
+            UPDATE agent_jobs
+            SET status = 'completado', reply_message_id = ?, updated_at = ?
             WHERE id = ?
             """,
-            (
-                form.get("cultivo"),
-                form.get("sintoma"),
-                form.get("inicio_problema"),
-                int(bool(form.get("foto_recibida"))),
-                utc_now(),
-                form["id"],
-            ),
+            (message_id, utc_now(), job["id"]),
         )
-        db.commit()
-    alert = actions.get("alerta")
-    if alert:
-        db = get_db()
+    AGENT_REQUEST_SECONDS.observe(time.perf_counter() - request_started, "job", role)
+    PUSH.notify()
+
+
+def fail_agent_job(job: dict[str, Any], error: str) -> None:
+    now = datetime.now(timezone.utc)
+    with write_transaction():
+        failed = mark_agent_job_failed(job, error, now)
+    if failed:
+        PUSH.notify()
+
+
+def mark_agent_job_failed(job: dict[str, Any], error: str, now: datetime) -> bool:
+    # Dentro de la transacción de quien llama. True si el turno agotó sus
+    # intentos y se encoló la disculpa.
+    db = get_db()
+    if job["attempts"] < AGENT_JOB_MAX_ATTEMPTS:
+        delay = AGENT_JOB_BACKOFF * 2 ** (job["attempts"] - 1)
         db.execute(
             """
-            INSERT INTO alerts (producer_id, level, reason, action, message, status, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
+            UPDATE agent_jobs
+            SET status = 'pendiente', available_at = ?, last_error = ?, updated_at = ?
+            WHERE id = ?
             """,
             (
-                producer["id"],
-                alert.get("nivel", "medio"),
-                alert.get("motivo", "sin motivo"),
-                alert.get("accion_recomendada", "sin accion"),
-                model_output.get("respuesta_chat", ""),
-                "abierta",
-                utc_now(),
+                (now + timedelta(seconds=delay)).isoformat(),
+                error,
+                now.isoformat(),
+                job["id"],
             ),
         )
-        db.commit()
-    bitacora = actions.get("bitacora")
-    if bitacora:
-        plan = get_active_plan(producer["id"])
-        log_date = bitacora.get("fecha") or date.today().isoformat()
-        notes = bitacora.get("notas") or ""
-        metrics = bitacora.get("metricas") or {}
-        log_type_id = bitacora.get("log_type_id")
-        save_daily_log(
-            producer_id=producer["id"],
-            plan_id=plan["plan_id"] if plan else None,
-            log_type_id=int(log_type_id) if log_type_id else None,
-            log_date=log_date,
-            notes=notes,
-            metrics=metrics,
-        )
-    tarea = actions.get("actualizar_tarea")
-    if tarea:
-        status = tarea.get("status")
-        task_id = tarea.get("task_id")
-        if not task_id or not status:
-            raise RuntimeError("actualizar_tarea requiere task_id y status.")
-        update_task_status(
-            task_id=int(task_id),
-            status=str(status),
-            progress_pct=tarea.get("avance"),
-            blocker_reason=tarea.get("motivo"),
-        )
-    return model_output
+        return False
+    message_id = insert_outbound_message(job["producer_id"], JOB_FAILED_REPLY, "pendiente")
+    db.execute(
+        """
+        UPDATE agent_jobs
+        SET status = 'fallido', last_error = ?, reply_message_id = ?, updated_at = ?
+        WHERE id = ?
+        """,
+        (error, message_id, now.isoformat(), job["id"]),
+    )
+    return True
+
+
+class AgentJobQueue:
+    def __init__(self, workers: int) -> None:
+        self.workers = workers
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.threads: list[threading.Thread] = []
+
+    def start(self) -> None:
+        with self.lock:
+            if self.threads or self.workers <= 0:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(
+                    target=self._run, name=f"agent-job-{index}", daemon=True
+                )
+                thread.start()
+                self.threads.append(thread)
+
+    def notify(self) -> None:
+        self.wakeup.set()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                with app.app_context():
+                    worked = self._run_one()
+            except Exception:
+                app.logger.exception("Error en la cola de turnos")
+                worked = False
+            if not worked:
+                self.wakeup.wait(AGENT_JOB_POLL_SECONDS)
+                self.wakeup.clear()
+
+    def _run_one(self) -> bool:
+        job = claim_agent_job()
+        if job is None:
+            return False
+        try:
+            process_agent_job(job)
+        except Exception as exc:
+            app.logger.exception("Falló el trabajo %s", job["id"])
+            fail_agent_job(job, str(exc))
+        return True
 
 
-@app.get("/health")
-def health() -> Any:
-    return jsonify({"status": "ok", "time": utc_now()})
+AGENT_JOBS = AgentJobQueue(AGENT_WORKERS)
 
 
-@app.post("/agent")
-def agent() -> Any:
-    payload = request.get_json(force=True)
-    role = payload.get("role")
-    phone = payload.get("phone")
-    message = payload.get("message", "")
+@app.before_request
+def start_agent_jobs() -> None:
+    # Arranca en el primer request del proceso que sirve, no al importar:
+    # así ni el recargador de debug ni los scripts ejecutan turnos.
+    AGENT_JOBS.start()
 
-    if not phone:
-        return jsonify({"error": "phone requerido"}), 400
 
-    producer = get_or_create_producer(phone)
-    role = role or producer.get("assigned_role") or "formulario"
-    if role not in PROMPTS:
-        return jsonify({"error": "role invalido"}), 400
+@app.post("/ingest")
+@idempotent
+def ingest() -> Any:
+    try:
+        snapshot, role = start_ingest_turn(request.get_json(force=True))
+    except AgentTurnError as exc:
+        return jsonify({"error": str(exc)}), exc.status
+
+    received_at = datetime.fromisoformat(snapshot.received_at)
+    with write_transaction() as db:
+        insert_inbound_message(snapshot)
+        pending = None
+        if AGENT_COALESCE_MS > 0:
+            # Solo se agrega a un turno que ningún worker tomó todavía y que
+            # no es un reintento.
+            pending = db.execute(
+                """
+                SELECT id, created_at
+                FROM agent_jobs
+                WHERE producer_id = ? AND role = ?
+                  AND status = 'pendiente' AND attempts = 0
+                ORDER BY id DESC
+                LIMIT 1
+                """,
+                (snapshot.producer["id"], role),
+            ).fetchone()
+        if pending:
+            job_id = pending["id"]
+            db.execute(
+                """
+                UPDATE agent_jobs
+                SET message = message || char(10) || ?,
+                    merged_count = merged_count + 1,
+                    available_at = ?, updated_at = ?
+                WHERE id = ?
+                """,
+                (
+                    snapshot.message,
+                    coalesce_until(datetime.fromisoformat(pending["created_at"]), received_at),
+                    snapshot.received_at,
+                    job_id,
+                ),
+            )
+        else:
+            job_id = db.execute(
+                """
+                INSERT INTO agent_jobs (
+                    producer_id, phone, role, message, status, attempts,
+                    available_at, created_at, updated_at
+                )
+                VALUES (?, ?, ?, ?, 'pendiente', 0, ?, ?, ?)
+                """,
+                (
+                    snapshot.producer["id"],
+                    snapshot.producer["phone"],
+                    role,
+                    snapshot.message,
+                    coalesce_until(received_at, received_at),
+                    snapshot.received_at,
+                    snapshot.received_at,
+                ),
+            ).lastrowid
+    AGENT_JOBS.notify()
+    return (
+        jsonify({"job_id": job_id, "status": "pendiente", "coalesced": bool(pending)}),
+        202,
+    )
 
+
+def coalesce_until(first_at: datetime, last_at: datetime) -> str:
+    # Cada mensaje nuevo corre la ventana, pero nunca más allá del máximo
+    # contado desde el primero.
+    until = min(
+        last_at + timedelta(milliseconds=AGENT_COALESCE_MS),
+        first_at + timedelta(milliseconds=max(AGENT_COALESCE_MAX_MS, AGENT_COALESCE_MS)),
+    )
+    return until.isoformat()
+
+
+class TurnCoalescer:
+    # Ráfagas de /agent y /agent/stream por (teléfono, rol). La primera
+    # petición abre la ráfaga y espera a que pase AGENT_SYNC_COALESCE_MS sin
+    # mensajes nuevos (con el mismo tope que coalesce_until); las que llegan
+    # mientras tanto agregan su texto y responden sin turno propio.
+    def __init__(self, window_ms: int, max_ms: int) -> None:
+        self.window = window_ms / 1000
+        self.max_wait = max(max_ms, window_ms) / 1000
+        self.cond = threading.Condition()
+        self.bursts: dict[tuple[str, str], dict[str, Any]] = {}
+        self.saved = 0
+
+    def join(self, key: tuple[str, str], message: str) -> list[str] | None:
+        # Mensajes de la ráfaga para quien la abrió; None si se agregó a otra.
+        now = time.monotonic()
+        with self.cond:
+            burst = self.bursts.get(key)
+            if burst is not None:
+                burst["messages"].append(message)
+                burst["until"] = min(now + self.window, burst["first"] + self.max_wait)
+                self.saved += 1
+                return None
+            burst = {"messages": [message], "first": now, "until": now + self.window}
+            self.bursts[key] = burst
+            # Cada mensaje agregado corre "until"; se vuelve a esperar lo que falte.
+            remaining = burst["until"] - now
+            while remaining > 0:
+                self.cond.wait(remaining)
+                remaining = burst["until"] - time.monotonic()
+            del self.bursts[key]
+            return burst["messages"]
+
+
+TURN_COALESCER = TurnCoalescer(AGENT_SYNC_COALESCE_MS, AGENT_COALESCE_MAX_MS)
+
+
+def coalesce_payload(payload: dict[str, Any]) -> dict[str, Any] | None:
+    # None: el mensaje quedó en la ráfaga de otra petición, que responde.
+    if AGENT_SYNC_COALESCE_MS <= 0 or not payload.get("phone"):
+        return payload
+    key = (str(payload["phone"]), str(payload.get("role") or ""))
+    messages = TURN_COALESCER.join(key, str(payload.get("message", "")))
+    if messages is None:
+        return None
+    return payload | {"message": "\n".join(messages)}
+
+
+@app.get("/stats/agent-jobs")
+def agent_job_stats() -> Any:
     db = get_db()
-    db.execute(
+    by_status = {
+        row["status"]: row["total"]
+        for row in db.execute(
+            "SELECT status, COUNT(*) AS total FROM agent_jobs GROUP BY status"
+        ).fetchall()
+    }
+    merged = db.execute(
+        "SELECT COALESCE(SUM(merged_count), 0) FROM agent_jobs"
+    ).fetchone()[0]
+    return jsonify(
+        {
+            "jobs": by_status,
+            "llm_calls_saved": merged + TURN_COALESCER.saved,
+            "llm_calls_saved_sync": TURN_COALESCER.saved,
+        }
+    )
+
+
+@app.get("/stats/idempotency")
+def idempotency_stats() -> Any:
+    # Cada repetición respondida con lo guardado (o rechazada por estar en
+    # proceso) es una llamada al modelo que no se hizo.
+    with _IDEMPOTENCY_LOCK:
+        counts = dict(IDEMPOTENCY_COUNTS)
+    keys = get_db().execute("SELECT COUNT(*) FROM inbound_keys").fetchone()[0]
+    return jsonify(
+        counts | {"keys": keys, "model_calls_saved": counts["replayed"] + counts["in_progress"]}
+    )
+
+
+@app.get("/agent/jobs/<int:job_id>")
+def agent_job_status(job_id: int) -> Any:
+    row = get_db().execute(
         """
-        INSERT INTO messages (producer_id, direction, content, status, created_at)
-        VALUES (?, ?, ?, ?, ?)
+        SELECT id, role, status, attempts, merged_count, last_error,
+               reply_message_id, created_at, updated_at
+        FROM agent_jobs
+        WHERE id = ?
         """,
-        (producer["id"], "usuario", message, "recibido", utc_now()),
-    )
-    db.commit()
+        (job_id,),
+    ).fetchone()
+    if not row:
+        return jsonify({"error": "trabajo no encontrado"}), 404
+    return jsonify(dict(row))
 
-    context = build_context(role, phone, message)
-    agent_config = get_agent_config(role)
-    if not producer.get("allowed"):
-        return jsonify({"error": "productor no autorizado"}), 403
-    if producer.get("status") != "activo":
-        return jsonify({"error": "productor inactivo"}), 403
-    if not agent_config.get("enabled"):
-        return jsonify({"error": f"agente {role} desactivado"}), 403
-    if role == "formulario" and not producer.get("enable_formulario"):
-        return jsonify({"error": "agente formulario desactivado"}), 403
-    if role == "consulta" and not producer.get("enable_consulta"):
-        return jsonify({"error": "agente consulta desactivado"}), 403
-    if role == "intervencion" and not producer.get("enable_intervencion"):
-        return jsonify({"error": "agente intervencion desactivado"}), 403
 
-    model_output = run_mml(role, context)
-    model_output = apply_model_actions(phone, model_output)
+@app.get("/outbox/pending")
+def outbox_pending() -> Any:
+    rows = get_db().execute(
+        """
+        SELECT messages.id, messages.content, producers.phone
+        FROM messages
+        JOIN producers ON producers.id = messages.producer_id
+        WHERE messages.direction = 'asistente' AND messages.status = 'pendiente'
+        ORDER BY messages.created_at ASC
+        """
+    ).fetchall()
+    return jsonify({"messages": [dict(row) for row in rows]})
+
+
+class PushNotifier:
+    # Despierta a los /push/stream abiertos cuando se confirma una alerta o
+    # una respuesta pendiente. Cada llamada a notify sube la versión; quien
+    # consulta la base después de leerla no pierde un aviso que llegue entre
+    # la consulta y el wait.
+    def __init__(self) -> None:
+        self.cond = threading.Condition()
+        self.version = 0
+        # Alertas liberadas por /alerts/ack: tienen id menor que el cursor,
+        # así que se avisan con un evento aparte.
+        self.released = 0
+        self.listeners = 0
+        self.notifications = 0
+        self.wakeups = 0
+        self.heartbeats = 0
+
+    def notify(self) -> None:
+        with self.cond:
+            self.version += 1
+            self.notifications += 1
+            self.cond.notify_all()
+
+    def notify_released(self) -> None:
+        with self.cond:
+            self.released += 1
+            self.version += 1
+            self.notifications += 1
+            self.cond.notify_all()
+
+    def wait(self, version: int, timeout: float) -> bool:
+        with self.cond:
+            woken = self.cond.wait_for(lambda: self.version != version, timeout)
+            if woken:
+                self.wakeups += 1
+            else:
+                self.heartbeats += 1
+            return woken
+
+    @contextmanager
+    def listening(self) -> Iterator[None]:
+        with self.cond:
+            self.listeners += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.listeners -= 1
+
+    def stats(self) -> dict[str, int]:
+        with self.cond:
+            return {
+                "listeners": self.listeners,
+                "notifications": self.notifications,
+                "wakeups": self.wakeups,
+                "heartbeats": self.heartbeats,
+            }
+
 
-    db.execute(
+PUSH = PushNotifier()
+
+
+def parse_push_cursor(raw: str | None) -> tuple[int, int]:
+    # "<última alerta>.<último mensaje>" ya avisados a este consumidor.
+    try:
+        alert_id, message_id = (raw or "0.0").split(".")
+        return int(alert_id), int(message_id)
+    except ValueError:
+        return 0, 0
+
+
+def pending_since(alert_cursor: int, message_cursor: int) -> tuple[list[dict], list[int]]:
+    db = get_db()
+    alerts = db.execute(
         """
-        INSERT INTO messages (producer_id, direction, content, status, created_at)
-        VALUES (?, ?, ?, ?, ?)
+        SELECT id, level
+        FROM alerts
+        WHERE status = 'abierta' AND sent_at IS NULL AND id > ?
+        ORDER BY id
+        LIMIT ?
+        """,
+        (alert_cursor, PUSH_BATCH),
+    ).fetchall()
+    # Con el cursor en 0 (consumidor nuevo) el rango por id recorrería todo
+    # el historial; el índice parcial solo tiene las pendientes.
+    messages = db.execute(
+        """
+        SELECT id
+        FROM messages INDEXED BY idx_messages_outbox
+        WHERE direction = 'asistente' AND status = 'pendiente' AND id > ?
+        ORDER BY id
+        LIMIT ?
         """,
-        (producer["id"], "asistente", model_output["respuesta_chat"], "enviado", utc_now()),
+        (message_cursor, PUSH_BATCH),
+    ).fetchall()
+    return [dict(row) for row in alerts], [row["id"] for row in messages]
+
+
+@app.get("/push/stream")
+def push_stream() -> Any:
+    # Avisa por SSE que hay alertas o respuestas pendientes nuevas; el envío
+    # sigue por /alerts/claim y /outbox/pending. El id de cada evento es el
+    # cursor: al reconectar con Last-Event-ID (o ?cursor=) solo llega lo
+    # posterior. "liberadas" (sin id) avisa que un ack devolvió alertas a la
+    # cola.
+    alert_cursor, message_cursor = parse_push_cursor(
+        request.headers.get("Last-Event-ID") or request.args.get("cursor")
+    )
+
+    def events() -> Iterator[str]:
+        nonlocal alert_cursor, message_cursor
+        released = PUSH.released
+        with PUSH.listening():
+            while True:
+                version = PUSH.version
+                if PUSH.released != released:
+                    released = PUSH.released
+                    yield sse_event({"released": True}, "liberadas")
+                # Conexión del pool solo durante la consulta, no mientras espera.
+                with app.app_context():
+                    alerts, messages = pending_since(alert_cursor, message_cursor)
+                if alerts or messages:
+                    alert_cursor = max([alert_cursor] + [alert["id"] for alert in alerts])
+                    message_cursor = max([message_cursor] + messages)
+                    yield sse_event(
+                        {"alerts": alerts, "messages": messages},
+                        "pendientes",
+                        f"{alert_cursor}.{message_cursor}",
+                    )
+                    continue
+                if not PUSH.wait(version, PUSH_HEARTBEAT_SECONDS):
+                    yield ": ping\n\n"
+
+    return Response(
+        events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"}
+    )
+
+
+@app.get("/stats/push")
+def push_stats() -> Any:
+    return jsonify(PUSH.stats())
+
+
+@app.post("/outbox/<int:message_id>/sent")
+def outbox_mark_sent(message_id: int) -> Any:
+    db = get_db()
+    db.execute(
+        "UPDATE messages SET status = 'enviado' WHERE id = ? AND direction = 'asistente'",
+        (message_id,),
     )
     db.commit()
+    return jsonify({"status": "ok"})
 
-    return jsonify({"context": context, "model_output": model_output})
+
+@app.get("/stats/response-cache")
+def response_cache_stats() -> Any:
+    return jsonify(RESPONSE_CACHE.stats())
+
+
+@app.get("/stats/rate-limit")
+def rate_limit_stats() -> Any:
+    return jsonify(RATE_LIMITER.stats())
+
+
+@app.get("/stats/session-cache")
+def session_cache_stats() -> Any:
+    return jsonify(SESSION_CACHE.stats() | {"enabled": SESSION_CACHE_ENABLED})
+
+
+@app.get("/stats/model-queue")
+def model_queue_stats() -> Any:
+    return jsonify(MODEL_SCHEDULER.stats())
+
+
+@app.get("/metrics")
+def metrics() -> Any:
+    # Formato de texto de Prometheus: las familias del turno más lo que ya
+    # miden el planificador, los caches y el limitador.
+    lines: list[str] = []
+    for family in METRIC_FAMILIES:
+        lines += family.render()
+    for name, help_text, attribute in (
+        ("model_queue_wait_seconds", "Espera por un slot del modelo.", "wait_seconds"),
+        ("model_queue_length", "Cola del rol al llegar un turno.", "queue_length"),
+    ):
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for role, histogram in getattr(MODEL_SCHEDULER, attribute).items():
+            lines += render_histogram(name, {"role": role}, histogram)
+    with MODEL_SCHEDULER.cond:
+        queue = {
+            outcome: dict(getattr(MODEL_SCHEDULER, outcome))
+            for outcome in ("dispatched", "shed", "expired")
+        }
+    cache = RESPONSE_CACHE.stats()
+    limiter = RATE_LIMITER.stats()
+    with _IDEMPOTENCY_LOCK:
+        idempotency = dict(IDEMPOTENCY_COUNTS)
+    push = PUSH.stats()
+    counters = {
+        "model_queue_turns_total": (
+            "Turnos por rol y resultado en la cola del modelo.",
+            [
+                ({"role": role, "outcome": outcome}, count)
+                for outcome, counts in queue.items()
+                for role, count in counts.items()
+            ],
+        ),
+        "response_cache_lookups_total": (
+            "Consultas al cache de respuestas.",
+            [({"result": result}, cache[result]) for result in ("hits", "misses", "stale")],
+        ),
+        "rate_limit_turns_total": (
+            "Turnos por decisión del limitador.",
+            [({"result": result}, limiter[result]) for result in ("admitted", "limited", "busy")],
+        ),
+        "idempotency_keys_total": (
+            "Claves de idempotencia por resultado.",
+            [({"result": result}, count) for result, count in sorted(idempotency.items())],
+        ),
+        "push_notifications_total": (
+            "Avisos publicados en /push/stream.",
+            [({}, push["notifications"])],
+        ),
+    }
+    for name, (help_text, samples) in counters.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+        lines += [f"{name}{prometheus_labels(labels)} {value}" for labels, value in samples]
+    lines += [
+        "# HELP rate_limit_inflight Turnos en curso dentro del límite global.",
+        "# TYPE rate_limit_inflight gauge",
+        f"rate_limit_inflight {limiter['inflight']}",
+    ]
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+@app.get("/stats/context-budget")
+def context_budget_stats() -> Any:
+    with _CONTEXT_BUDGET_LOCK:
+        totals = dict(CONTEXT_BUDGET_TOTALS)
+    return jsonify(
+        totals
+        | {"tokens_saved": TOKENS_SAVED.stats(), "token_cache": TOKEN_COUNTER.stats()}
+    )
+
+
+@app.get("/stats/chat-summaries")
+def chat_summary_stats() -> Any:
+    row = get_db().execute(
+        """
+        SELECT COUNT(*) AS producers,
+               COALESCE(SUM(messages_summarized), 0) AS messages_summarized,
+               COALESCE(AVG(prompt_tokens), 0) AS avg_prompt_tokens,
+               COALESCE(MAX(prompt_tokens), 0) AS max_prompt_tokens,
+               COALESCE(AVG(completion_tokens), 0) AS avg_completion_tokens,
+               COALESCE(AVG(generation_ms), 0) AS avg_generation_ms,
+               COALESCE(MAX(generation_ms), 0) AS max_generation_ms,
+               MAX(updated_at) AS last_run
+        FROM chat_summaries
+        """
+    ).fetchone()
+    return jsonify(dict(row))
+
+
+@app.get("/stats/db")
+def db_stats() -> Any:
+    return jsonify(get_db_pool().stats())
 
 
 @app.post("/form/update")
@@ -1029,7 +4795,11 @@ def create_alert() -> Any:
             utc_now(),
         ),
     )
+    record_weekly_event(
+        producer["id"], {"alertas": 1, "alertas_altas": int(alert.get("nivel") == "alto")}
+    )
     db.commit()
+    PUSH.notify()
     return jsonify({"status": "ok"})
 
 
@@ -1080,6 +4850,8 @@ def assign_plan() -> Any:
 
 @app.get("/alerts/pending")
 def alerts_pending() -> Any:
+    # Sondeo anterior a /alerts/claim; omite las alertas con lease vigente
+    # para no duplicar envíos si conviven ambos consumidores.
     db = get_db()
     rows = db.execute(
         """
@@ -1088,12 +4860,122 @@ def alerts_pending() -> Any:
         FROM alerts
         JOIN producers ON producers.id = alerts.producer_id
         WHERE alerts.status = 'abierta' AND alerts.sent_at IS NULL
+          AND alerts.lease_until < ?
         ORDER BY alerts.created_at ASC
-        """
+        """,
+        (utc_now(),),
     ).fetchall()
     return jsonify({"alerts": [dict(row) for row in rows]})
 
 
+def claim_alerts(consumer: str, limit: int, lease_seconds: int) -> list[dict[str, Any]]:
+    now = datetime.now(timezone.utc)
+    with write_transaction() as db:
+        # Entregada ALERT_MAX_DELIVERIES veces sin confirmación: se da por
+        # fallida en lugar de reenviarla para siempre.
+        db.execute(
+            """
+            UPDATE alerts INDEXED BY idx_alerts_outbox
+            SET status = 'fallida'
+            WHERE status = 'abierta' AND sent_at IS NULL
+              AND lease_until > '' AND lease_until < ?
+              AND delivery_attempts >= ?
+            """,
+            (now.isoformat(), ALERT_MAX_DELIVERIES),
+        )
+        # INDEXED BY: sin él el planificador prefiere el índice por estado y
+        # ordena todas las pendientes en vez de leer solo el lote.
+        rows = db.execute(
+            """
+            UPDATE alerts
+            SET lease_until = :until, claimed_by = :consumer,
+                delivery_attempts = delivery_attempts + 1
+            WHERE id IN (
+                SELECT id
+                FROM alerts INDEXED BY idx_alerts_outbox
+                WHERE status = 'abierta' AND sent_at IS NULL AND lease_until < :now
+                ORDER BY lease_until, id
+                LIMIT :limit
+            )
+            RETURNING id, message, level, reason, action, delivery_attempts,
+                      (SELECT phone FROM producers WHERE producers.id = alerts.producer_id)
+                          AS phone
+            """,
+            {
+                "now": now.isoformat(),
+                "until": (now + timedelta(seconds=lease_seconds)).isoformat(),
+                "consumer": consumer,
+                "limit": limit,
+            },
+        ).fetchall()
+    return sorted((dict(row) for row in rows), key=lambda alert: alert["id"])
+
+
+@app.post("/alerts/claim")
+def alerts_claim() -> Any:
+    payload = request.get_json(silent=True) or {}
+    consumer = str(payload.get("consumer") or request.remote_addr or "desconocido")
+    try:
+        limit = min(int(payload.get("limit", ALERT_CLAIM_MAX)), ALERT_CLAIM_MAX)
+        lease_seconds = int(payload.get("lease_seconds", ALERT_LEASE_SECONDS))
+    except (TypeError, ValueError):
+        return jsonify({"error": "limit y lease_seconds deben ser enteros"}), 400
+    if limit <= 0 or lease_seconds <= 0:
+        return jsonify({"error": "limit y lease_seconds deben ser positivos"}), 400
+    alerts = claim_alerts(consumer, limit, lease_seconds)
+    return jsonify({"alerts": alerts, "lease_seconds": lease_seconds})
+
+
+@app.post("/alerts/ack")
+def alerts_ack() -> Any:
+    # sent: enviadas; failed: no se pudieron enviar y vuelven a la cola de
+    # inmediato (sin esperar el lease). Repetir un ack no cambia nada. Solo
+    # quien tiene el lease puede confirmar o liberar: un bridge con el lease
+    # vencido no cierra ni devuelve a la cola una alerta que ya reclamó otro.
+    payload = request.get_json(force=True)
+    consumer = payload.get("consumer")
+    if not consumer:
+        return jsonify({"error": "consumer requerido"}), 400
+    try:
+        sent = [int(alert_id) for alert_id in payload.get("sent") or []]
+        failed = [int(alert_id) for alert_id in payload.get("failed") or []]
+    except (TypeError, ValueError):
+        return jsonify({"error": "sent y failed deben ser listas de ids"}), 400
+    acked = released = 0
+    with write_transaction() as db:
+        if sent:
+            acked = db.execute(
+                f"""
+                UPDATE alerts SET sent_at = ?, status = 'enviada'
+                WHERE sent_at IS NULL AND claimed_by = ?
+                  AND id IN ({','.join('?' * len(sent))})
+                """,
+                (utc_now(), str(consumer), *sent),
+            ).rowcount
+        if failed:
+            released = db.execute(
+                f"""
+                UPDATE alerts SET lease_until = ''
+                WHERE status = 'abierta' AND sent_at IS NULL
+                  AND claimed_by = ? AND delivery_attempts < ?
+                  AND id IN ({','.join('?' * len(failed))})
+                """,
+                (str(consumer), ALERT_MAX_DELIVERIES, *failed),
+            ).rowcount
+            db.execute(
+                f"""
+                UPDATE alerts SET status = 'fallida'
+                WHERE status = 'abierta' AND sent_at IS NULL
+                  AND claimed_by = ? AND delivery_attempts >= ?
+                  AND id IN ({','.join('?' * len(failed))})
+                """,
+                (str(consumer), ALERT_MAX_DELIVERIES, *failed),
+            )
+    if released:
+        PUSH.notify_released()
+    return jsonify({"acked": acked, "released": released})
+
+
 @app.post("/alerts/<int:alert_id>/sent")
 def alert_mark_sent(alert_id: int) -> Any:
     db = get_db()
@@ -1114,7 +4996,12 @@ def admin_dashboard() -> Any:
         "alerts": db.execute("SELECT COUNT(*) FROM alerts").fetchone()[0],
         "messages": db.execute("SELECT COUNT(*) FROM messages").fetchone()[0],
     }
-    return render_template("dashboard.html", counts=counts)
+    return render_template(
+        "dashboard.html",
+        counts=counts,
+        response_cache=RESPONSE_CACHE.stats(),
+        rate_limiter=RATE_LIMITER.stats(),
+    )
 
 
 @app.get("/admin/producers")
@@ -1533,6 +5420,9 @@ def admin_agents_update(role: str) -> Any:
         (enabled, prompt, max_tokens, role),
     )
     db.commit()
+    invalidate_prefix_state(role)
+    # Las respuestas guardadas salieron del prompt anterior.
+    RESPONSE_CACHE.clear_role(role)
     return redirect(url_for("admin_agents"))
 
 
@@ -1619,7 +5509,7 @@ def admin_alert_status(alert_id: int) -> Any:
 def close_db(exception: Exception | None) -> None:
     db = g.pop("db", None)
     if db is not None:
-        db.close()
+        g.pop("db_pool").release(db)
 
 
 if __name__ == "__main__":
@@ -1627,4 +5517,8 @@ if __name__ == "__main__":
     migrate_db()
     with app.app_context():
         ensure_agent_defaults()
+    # Con debug el proceso que sirve es el hijo del recargador; el padre solo
+    # vigila archivos y no debe cargar el modelo.
+    if MODEL_EAGER_LOAD and is_running_from_reloader():
+        threading.Thread(target=start_model, name="model-warmup", daemon=True).start()
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -3,15 +3,61 @@ import os
 
 from llama_cpp import Llama
 
+from app import PROMPTS, ROLE_ACTIONS, get_role_grammar
+
 MODEL_PATH = os.getenv(
     "MODEL_PATH", "models/qwen2.5-3b-instruct-q4_k_m.gguf"
 )
 N_CTX = int(os.getenv("N_CTX", "2048"))
 N_THREADS = int(os.getenv("N_THREADS", "1"))
+# Repeticiones por rol al comparar la salida con y sin gramática (0 = omitir).
+MML_RUNS = int(os.getenv("MML_RUNS", "3"))
+MML_MAX_TOKENS = int(os.getenv("MML_MAX_TOKENS", "300"))
 
+ROLE_MESSAGES = {
+    "formulario": "mi papa tiene hojas amarillas desde hace 3 dias",
+    "consulta": "¿cuándo riego la papa?",
+    "intervencion": "las manchas siguen igual que la semana pasada",
+}
 
-def main() -> None:
-    llm = Llama(model_path=MODEL_PATH, n_ctx=N_CTX, n_threads=N_THREADS)
+
+def role_context(role: str) -> dict:
+    return {
+        "role": role,
+        "producer": {
+            "id": 1,
+            "zone": "Cusco - San Sebastián",
+            "preferred_language": "es",
+            "main_crops": ["papa", "maiz"],
+        },
+        "form_state": {
+            "cultivo": None,
+            "sintoma": None,
+            "inicio_problema": None,
+            "foto_recibida": False,
+        },
+        "recent_chat": [] if role == "intervencion" else ["usuario: hola"],
+        "weekly_summary": "7d: papa—amarillamiento (2 veces), sin mejora reportada.",
+        "last_user_message": ROLE_MESSAGES[role],
+    }
+
+
+def is_valid_output(role: str, content: str) -> bool:
+    try:
+        data = json.loads(content)
+    except json.JSONDecodeError:
+        return False
+    if not isinstance(data, dict):
+        return False
+    if not isinstance(data.get("respuesta_chat"), str):
+        return False
+    actions = data.get("acciones")
+    if not isinstance(actions, dict) or not set(ROLE_ACTIONS[role]) <= set(actions):
+        return False
+    return isinstance(data.get("estado"), dict)
+
+
+def check_json_object(llm: Llama) -> None:
     messages = [
         {
             "role": "system",
@@ -38,5 +84,38 @@ def main() -> None:
     print(json.dumps(data, ensure_ascii=False, indent=2))
 
 
+def compare_mml_grammar(llm: Llama) -> None:
+    print(f"{'role':<14}{'modo':<10}{'JSON válido':>12}{'tokens prom':>13}")
+    for role, system_prompt in PROMPTS.items():
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": json.dumps(role_context(role), ensure_ascii=False)},
+        ]
+        for mode, grammar in (("libre", None), ("gramática", get_role_grammar(role))):
+            valid = 0
+            tokens = 0
+            for _ in range(MML_RUNS):
+                response = llm.create_chat_completion(
+                    messages=messages,
+                    temperature=0.2,
+                    max_tokens=MML_MAX_TOKENS,
+                    grammar=grammar,
+                )
+                content = response["choices"][0]["message"]["content"] or ""
+                valid += is_valid_output(role, content)
+                tokens += response["usage"]["completion_tokens"]
+            print(
+                f"{role:<14}{mode:<10}{f'{valid}/{MML_RUNS}':>12}"
+                f"{tokens / MML_RUNS:>13.1f}"
+            )
+
+
+def main() -> None:
+    llm = Llama(model_path=MODEL_PATH, n_ctx=N_CTX, n_threads=N_THREADS)
+    check_json_object(llm)
+    if MML_RUNS > 0:
+        compare_mml_grammar(llm)
+
+
 if __name__ == "__main__":
     main()
@@ -1,9 +1,27 @@
 import axios from "axios";
+import { hostname } from "node:os";
+import { StringDecoder } from "node:string_decoder";
 import qrcode from "qrcode-terminal";
 import { Client, LocalAuth } from "whatsapp-web.js";
 
 const FLASK_URL = process.env.FLASK_URL ?? "http://localhost:5000";
 const DEFAULT_ROLE = process.env.DEFAULT_ROLE;
+// ingest: /ingest responde 202 y la respuesta llega por /outbox/pending.
+// stream: espera el turno en /agent/stream (requiere generación rápida).
+const AGENT_MODE = process.env.AGENT_MODE ?? "ingest";
+const OUTBOX_POLL_MS = Number(process.env.OUTBOX_POLL_MS ?? 2000);
+// Alertas: cada bridge reclama un lote con lease en /alerts/claim; si se cae
+// antes de confirmar, otro las vuelve a reclamar al vencer el lease.
+const BRIDGE_ID = process.env.BRIDGE_ID ?? `${hostname()}-${process.pid}`;
+const ALERT_POLL_MS = Number(process.env.ALERT_POLL_MS ?? 10000);
+const ALERT_BATCH = Number(process.env.ALERT_BATCH ?? 20);
+const ALERT_LEASE_SECONDS = Number(process.env.ALERT_LEASE_SECONDS ?? 60);
+// push: /push/stream avisa apenas hay alertas o respuestas pendientes. Con el
+// stream conectado los sondeos se espacian: respuestas cada OUTBOX_SWEEP_MS
+// (reintenta envíos fallidos) y alertas cada ALERT_SWEEP_MS (leases vencidos).
+const PUSH_ENABLED = (process.env.PUSH_ENABLED ?? "1") === "1";
+const OUTBOX_SWEEP_MS = Number(process.env.OUTBOX_SWEEP_MS ?? 30000);
+const ALERT_SWEEP_MS = Number(process.env.ALERT_SWEEP_MS ?? 60000);
 
 const client = new Client({
   authStrategy: new LocalAuth(),
@@ -18,43 +36,245 @@ client.on("ready", () => {
   console.log("WhatsApp bridge listo.");
 });
 
+function parseSseEvent(raw) {
+  let event = "message";
+  let id = null;
+  const data = [];
+  for (const line of raw.split("\n")) {
+    if (line.startsWith("event:")) {
+      event = line.slice("event:".length).trim();
+    } else if (line.startsWith("data:")) {
+      data.push(line.slice("data:".length));
+    } else if (line.startsWith("id:")) {
+      id = line.slice("id:".length).trim();
+    }
+  }
+  return { event, id, data: data.length ? JSON.parse(data.join("\n")) : null };
+}
+
+// Consume /agent/stream y llama a onReply apenas llega respuesta_chat, sin
+// esperar a que el modelo termine de generar las acciones.
+async function streamAgent(payload, onReply) {
+  const response = await axios.post(`${FLASK_URL}/agent/stream`, payload, {
+    responseType: "stream",
+    timeout: 120000,
+    // El backend descarta el turno si sigue en cola cuando este cliente ya
+    // se habría rendido.
+    headers: { "X-Deadline-Ms": "120000" },
+  });
+  const decoder = new StringDecoder("utf8");
+  let buffer = "";
+  let replied = false;
+  for await (const chunk of response.data) {
+    buffer += decoder.write(chunk);
+    let separator;
+    while ((separator = buffer.indexOf("\n\n")) !== -1) {
+      const { event, data } = parseSseEvent(buffer.slice(0, separator));
+      buffer = buffer.slice(separator + 2);
+      if (event === "error") {
+        throw new Error(data?.error ?? "Error del agente");
+      }
+      if (event === "agrupado") {
+        // Otro mensaje de la misma ráfaga responde por este.
+        replied = true;
+      }
+      if (event === "respuesta_chat" && !replied) {
+        replied = true;
+        await onReply(data.respuesta_chat || "No pude procesar el mensaje.");
+      }
+    }
+  }
+  return replied;
+}
+
 client.on("message", async (message) => {
+  let replied = false;
   try {
+    // El id del mensaje hace idempotente el turno: si whatsapp-web.js lo
+    // entrega dos veces, el backend responde lo ya generado.
     const payload = {
       phone: message.from,
       message: message.body ?? "",
+      message_id: message.id?._serialized,
     };
     if (DEFAULT_ROLE) {
       payload.role = DEFAULT_ROLE;
     }
 
-    const response = await axios.post(`${FLASK_URL}/agent`, payload, {
-      timeout: 15000,
-    });
-    const modelOutput = response.data.model_output;
-    const reply = modelOutput?.respuesta_chat ?? "No pude procesar el mensaje.";
+    if (AGENT_MODE === "ingest") {
+      await axios.post(`${FLASK_URL}/ingest`, payload, { timeout: 10000 });
+      return;
+    }
 
-    await message.reply(reply);
+    replied = await streamAgent(payload, async (reply) => {
+      replied = true;
+      await message.reply(reply);
+    });
+    if (!replied) {
+      await message.reply("No pude procesar el mensaje.");
+    }
   } catch (error) {
+    if (error?.response?.status === 409) {
+      // Otro intento del mismo mensaje sigue en proceso y responderá él.
+      return;
+    }
     console.error("Error al procesar mensaje:", error?.message ?? error);
-    await message.reply("Ocurrió un error. Intenta más tarde.");
+    if (!replied) {
+      await message.reply("Ocurrió un error. Intenta más tarde.");
+    }
   }
 });
 
 client.initialize();
 
-setInterval(async () => {
+let outboxBusy = false;
+let lastOutboxDrain = 0;
+let outboxAgain = false;
+
+// Un envío lento no debe solaparse con el siguiente sondeo y duplicar
+// mensajes; un aviso que llega a mitad de un envío repite la vuelta.
+async function drainOutbox() {
+  if (outboxBusy) {
+    outboxAgain = true;
+    return;
+  }
+  outboxBusy = true;
   try {
-    const response = await axios.get(`${FLASK_URL}/alerts/pending`, { timeout: 10000 });
-    const alerts = response.data.alerts ?? [];
-    for (const alert of alerts) {
-      const text =
-        alert.message ||
-        `Alerta ${alert.level}: ${alert.reason}. Acción: ${alert.action}`;
-      await client.sendMessage(alert.phone, text);
-      await axios.post(`${FLASK_URL}/alerts/${alert.id}/sent`, null, { timeout: 10000 });
-    }
+    do {
+      outboxAgain = false;
+      lastOutboxDrain = Date.now();
+      const response = await axios.get(`${FLASK_URL}/outbox/pending`, { timeout: 10000 });
+      const messages = response.data.messages ?? [];
+      for (const outbound of messages) {
+        await client.sendMessage(outbound.phone, outbound.content);
+        await axios.post(`${FLASK_URL}/outbox/${outbound.id}/sent`, null, { timeout: 10000 });
+      }
+    } while (outboxAgain);
+  } catch (error) {
+    console.error("Error enviando respuestas:", error?.message ?? error);
+  } finally {
+    outboxBusy = false;
+  }
+}
+
+let alertsBusy = false;
+let alertsAgain = false;
+let lastAlertDrain = 0;
+
+async function drainAlerts() {
+  if (alertsBusy) {
+    alertsAgain = true;
+    return;
+  }
+  alertsBusy = true;
+  try {
+    do {
+      alertsAgain = false;
+      lastAlertDrain = Date.now();
+      const response = await axios.post(
+        `${FLASK_URL}/alerts/claim`,
+        { consumer: BRIDGE_ID, limit: ALERT_BATCH, lease_seconds: ALERT_LEASE_SECONDS },
+        { timeout: 10000 },
+      );
+      const alerts = response.data.alerts ?? [];
+      const sent = [];
+      const failed = [];
+      for (const alert of alerts) {
+        const text =
+          alert.message ||
+          `Alerta ${alert.level}: ${alert.reason}. Acción: ${alert.action}`;
+        try {
+          await client.sendMessage(alert.phone, text);
+          sent.push(alert.id);
+        } catch (error) {
+          console.error(`Error enviando alerta ${alert.id}:`, error?.message ?? error);
+          failed.push(alert.id);
+        }
+      }
+      // Un solo ack por lote; si falla, el lease vence y se reintenta.
+      if (sent.length || failed.length) {
+        await axios.post(
+          `${FLASK_URL}/alerts/ack`,
+          { consumer: BRIDGE_ID, sent, failed },
+          { timeout: 10000 },
+        );
+      }
+      if (alerts.length === ALERT_BATCH) {
+        alertsAgain = true;
+      }
+    } while (alertsAgain);
   } catch (error) {
     console.error("Error enviando alertas:", error?.message ?? error);
+  } finally {
+    alertsBusy = false;
+  }
+}
+
+let pushConnected = false;
+let pushCursor = null;
+
+// Mantiene abierto /push/stream y reconecta desde el último cursor; mientras
+// está caído vuelven los sondeos periódicos.
+async function listenPush() {
+  let delay = 1000;
+  for (;;) {
+    try {
+      const headers = pushCursor ? { "Last-Event-ID": pushCursor } : {};
+      const response = await axios.get(`${FLASK_URL}/push/stream`, {
+        responseType: "stream",
+        headers,
+      });
+      pushConnected = true;
+      delay = 1000;
+      // Lo pendiente antes de conectar solo llega si no hay cursor.
+      drainAlerts();
+      drainOutbox();
+      const decoder = new StringDecoder("utf8");
+      let buffer = "";
+      for await (const chunk of response.data) {
+        buffer += decoder.write(chunk);
+        let separator;
+        while ((separator = buffer.indexOf("\n\n")) !== -1) {
+          const { event, id, data } = parseSseEvent(buffer.slice(0, separator));
+          buffer = buffer.slice(separator + 2);
+          if (event === "liberadas") {
+            // Alertas devueltas a la cola por un ack: no avanzan el cursor.
+            drainAlerts();
+            continue;
+          }
+          if (event !== "pendientes") {
+            continue;
+          }
+          pushCursor = id ?? pushCursor;
+          if (data.alerts?.length) {
+            drainAlerts();
+          }
+          if (data.messages?.length) {
+            drainOutbox();
+          }
+        }
+      }
+    } catch (error) {
+      console.error("Stream de avisos cortado:", error?.message ?? error);
+    }
+    pushConnected = false;
+    await new Promise((resolve) => setTimeout(resolve, delay));
+    delay = Math.min(delay * 2, 30000);
+  }
+}
+
+if (PUSH_ENABLED) {
+  listenPush();
+}
+
+setInterval(() => {
+  if (!pushConnected || Date.now() - lastOutboxDrain >= OUTBOX_SWEEP_MS) {
+    drainOutbox();
+  }
+}, OUTBOX_POLL_MS);
+
+setInterval(() => {
+  if (!pushConnected || Date.now() - lastAlertDrain >= ALERT_SWEEP_MS) {
+    drainAlerts();
   }
-}, 10000);
+}, ALERT_POLL_MS);